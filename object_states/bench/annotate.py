@@ -0,0 +1,53 @@
+'''Per-frame drawing time: DetectionAnnotator (supervision) vs FastDetectionAnnotator.
+
+``diff`` is the mean absolute pixel difference between the two outputs (0-255), as a
+check that they still look the same.
+
+usage: python -m object_states.bench.annotate --n-objects '[5,20,50]' --size 640x480
+'''
+import time
+import numpy as np
+import pandas as pd
+import supervision as sv
+
+from ..util.synthetic import SyntheticScene
+from ..util.video import DetectionAnnotator, FastDetectionAnnotator
+
+
+def time_annotator(ann, frames, detections, labels, **kw):
+    outs = []
+    t0 = time.perf_counter()
+    for frame, dets, names in zip(frames, detections, labels):
+        outs.append(ann.annotate(frame.copy(), dets, names, by_track=True, **kw))
+    return (time.perf_counter() - t0) / len(frames) * 1000, outs
+
+
+def main(n_objects=(5, 20, 50), n_frames=60, size='640x480', out_csv=None):
+    W, H = map(int, size.split('x'))
+    rows = []
+    for n in n_objects:
+        scene = SyntheticScene(size=(W, H), n_objects=n)
+        frames, detections, labels = [], [], []
+        for i in range(n_frames):
+            xyxy, masks, track_ids = scene.objects(i)
+            frames.append(scene.frame(i))
+            detections.append(sv.Detections(xyxy=xyxy, mask=masks, class_id=track_ids, tracker_id=track_ids))
+            labels.append([f'{t} object' for t in track_ids])
+
+        ms_sv, out_sv = time_annotator(DetectionAnnotator(), frames, detections, labels)
+        canvas = np.zeros((H, W, 3), dtype=np.uint8)
+        ms_fast, out_fast = time_annotator(FastDetectionAnnotator(), frames, detections, labels, out=canvas)
+        # out_fast all point to the canvas, so only the last frame can be compared
+        diff = np.abs(out_sv[-1].astype(int) - out_fast[-1].astype(int)).mean()
+        rows.append({'n_objects': n, 'sv_ms': ms_sv, 'fast_ms': ms_fast, 'speedup': ms_sv / ms_fast, 'diff': diff})
+        print(rows[-1])
+
+    df = pd.DataFrame(rows).set_index('n_objects')
+    print(df.to_string(float_format='%.2f'))
+    if out_csv:
+        df.to_csv(out_csv)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(main)
@@ -0,0 +1,84 @@
+'''Throughput of Perception on CPU for each cpu_profile setting.
+
+Each setting is applied on top of the previous one, and runs in its own process
+(interop threads can only be set once per process).
+
+usage: python -m object_states.bench.cpu_profile --n-frames 100 --state-db v0
+'''
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import numpy as np
+import pandas as pd
+import supervision as sv
+
+from ..util.synthetic import synthetic_video
+
+
+# cumulative settings - each row adds one thing to the one before it
+SETTINGS = [
+    ('baseline', None),
+    ('threads', {'inference_mode': False, 'channels_last': False}),
+    ('+inference_mode', {'channels_last': False}),
+    ('+channels_last', {}),
+    ('+compile', {'compile': ['clip', 'egohos']}),
+]
+
+
+def run_setting(name, cpu_profile, src, n_frames=100, warmup=5, size=480, **kw):
+    import torch
+    from ..inference import Perception
+    from ..inference.vocab import VOCAB
+
+    kw.setdefault('vocabulary', VOCAB)
+    model = Perception(cpu_profile=cpu_profile, device='cpu', **kw)
+    info = sv.VideoInfo.from_video_path(src)
+    W, H = int(info.width * size / info.height) // 16 * 16, size
+
+    times = []
+    for i, frame in enumerate(sv.get_video_frames_generator(src)):
+        if i >= n_frames + warmup:
+            break
+        frame = cv2.resize(frame, (W, H))
+        t0 = time.perf_counter()
+        model.predict(frame, i / info.fps)
+        if i >= warmup:
+            times.append(time.perf_counter() - t0)
+    times = np.array(times)
+    return {
+        'setting': name,
+        'fps': len(times) / times.sum(),
+        'mean_ms': times.mean() * 1e3,
+        'p95_ms': np.percentile(times, 95) * 1e3,
+        'threads': torch.get_num_threads(),
+        'profile': repr(model.detector.cpu_profile),
+    }
+
+
+def main(src=None, n_frames=100, warmup=5, threads=None, workers=1, state_db=None, out_csv=None, **kw):
+    src = src or synthetic_video('bench/synthetic.mp4', n_frames=n_frames + warmup)
+
+    rows = []
+    profile = {'threads': threads, 'workers': workers}
+    for name, setting in SETTINGS:
+        if setting is not None:
+            profile = {**profile, 'inference_mode': True, 'channels_last': True, **setting}
+        # fresh process per setting
+        with ProcessPoolExecutor(1, mp_context=mp.get_context('spawn')) as pool:
+            row = pool.submit(
+                run_setting, name, setting and profile, src,
+                n_frames=n_frames, warmup=warmup, state_db_fname=state_db, **kw).result()
+        print(row)
+        rows.append(row)
+
+    df = pd.DataFrame(rows).set_index('setting')
+    df['speedup'] = df.fps / df.fps.iloc[0]
+    print(df[['fps', 'mean_ms', 'p95_ms', 'speedup', 'threads']].to_string(float_format='%.2f'))
+    if out_csv:
+        df.to_csv(out_csv)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(main)
@@ -0,0 +1,71 @@
+'''raw_run's depth fusion on a synthetic recording: aligning depth frames to main frames and lifting boxes to 3D.
+
+``closest_scan_us`` / ``closest_bisect_us`` compare the old linear scan over the depth history to ``StreamAligner``'s bisect.
+``error_m`` is the distance between the lifted box centers and the true 3D points.
+
+usage: python -m object_states.bench.depth --n-frames 300 --n-objects 20
+'''
+import time
+import numpy as np
+import pandas as pd
+
+from ..util.synthetic import synthetic_recording
+from ..util.timeseries import StreamAligner, DepthLifter
+
+
+def closest_scan(history, t):
+    return min(history, key=lambda k: abs(t - k), default=None)
+
+
+def main(n_frames=300, n_objects=20, history=16, depth_size='320x288', stride=1, out_csv=None):
+    dw, dh = map(int, depth_size.split('x'))
+    streams = StreamAligner({'depthlt': 300}, maxlen={'depthlt': history, 'depthltCal': 1})
+    lifter = DepthLifter(stride=stride)
+    scan_history = {}
+    t_scan = t_bisect = t_lift = 0
+    errors, n_valid, n_boxes, n_main = [], 0, 0, 0
+    for sid, t, msg in synthetic_recording(n_frames, n_objects=n_objects, depth_size=(dw, dh)):
+        if sid != 'main':
+            streams.add(sid, t, msg)
+            if sid == 'depthlt':
+                scan_history[t] = msg
+                while len(scan_history) > history:
+                    scan_history.pop(next(iter(scan_history)))
+            continue
+        n_main += 1
+
+        t0 = time.perf_counter()
+        closest_scan(scan_history, t)
+        t1 = time.perf_counter()
+        depth, calib = streams.align(t, ['depthlt', 'depthltCal'])
+        t2 = time.perf_counter()
+        t_scan += t1 - t0
+        t_bisect += t2 - t1
+        if depth is None or calib is None:
+            continue
+
+        image_params = {'cam2world': msg['cam2world'], 'focal': [msg['focalX'], msg['focalY']], 'principal': [msg['principalX'], msg['principalY']]}
+        t0 = time.perf_counter()
+        xyz, dist, valid = lifter.lift(msg['xyxy'], image_params, depth, calib)
+        t_lift += time.perf_counter() - t0
+        errors.append(np.linalg.norm(xyz - msg['xyz'], axis=1)[valid])
+        n_valid += valid.sum()
+        n_boxes += len(valid)
+
+    errors = np.concatenate(errors) if errors else np.zeros(0)
+    df = pd.DataFrame([{
+        'closest_scan_us': t_scan / n_main * 1e6,
+        'closest_bisect_us': t_bisect / n_main * 1e6,
+        'lift_ms': t_lift / max(n_main, 1) * 1e3,
+        'valid': n_valid / max(n_boxes, 1),
+        'error_m_mean': errors.mean() if len(errors) else np.nan,
+        'error_m_max': errors.max() if len(errors) else np.nan,
+    }])
+    print(df.T.to_string(float_format='%.4f', header=False))
+    if out_csv:
+        df.to_csv(out_csv, index=False)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(main)
@@ -0,0 +1,67 @@
+'''Video encode throughput: opencv (sv.VideoSink, mp4v) vs piping to ffmpeg.
+
+``write_fps`` is how fast the main loop can hand off frames (what inference sees),
+``fps`` includes waiting for the encoder to finish.
+
+usage: python -m object_states.bench.encode --n-frames 600 --size 960x480
+'''
+import os
+import time
+import tempfile
+import pandas as pd
+import supervision as sv
+
+from ..util.synthetic import synthetic_frames
+from ..util.video import VideoSink, has_ffmpeg
+
+
+# (name, backend, ffmpeg options)
+SETTINGS = [
+    ('opencv-mp4v', 'opencv', {}),
+    ('ffmpeg-x264-ultrafast', 'ffmpeg', {'preset': 'ultrafast'}),
+    ('ffmpeg-x264-veryfast', 'ffmpeg', {'preset': 'veryfast'}),
+    ('ffmpeg-x264-veryfast-1thread', 'ffmpeg', {'preset': 'veryfast', 'threads': 1}),
+    ('ffmpeg-mpeg4', 'ffmpeg', {'codec': 'mpeg4', 'preset': None, 'crf': None}),
+]
+
+
+def encode(frames, out_path, fps=30, backend='opencv', **kw):
+    H, W = frames[0].shape[:2]
+    info = sv.VideoInfo(width=W, height=H, fps=fps)
+    t0 = time.perf_counter()
+    with VideoSink(out_path, info, backend=backend, **kw) as s:
+        for frame in frames:
+            s.write_frame(frame)
+        t_write = time.perf_counter() - t0
+    t_total = time.perf_counter() - t0
+    return {
+        'write_fps': len(frames) / t_write,
+        'fps': len(frames) / t_total,
+        'size_mb': os.path.getsize(out_path) / 1e6,
+    }
+
+
+def main(n_frames=300, size='960x480', out_dir=None, out_csv=None):
+    W, H = map(int, size.split('x'))
+    frames = list(synthetic_frames(n_frames, size=(W, H)))
+    settings = [x for x in SETTINGS if x[1] != 'ffmpeg' or has_ffmpeg()]
+    if len(settings) < len(SETTINGS):
+        print("ffmpeg not found - only benchmarking opencv")
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, backend, kw in settings:
+            row = encode(frames, os.path.join(out_dir or tmp, f'{name}.mp4'), backend=backend, **kw)
+            rows.append({'setting': name, **row})
+            print(rows[-1])
+
+    df = pd.DataFrame(rows).set_index('setting')
+    df['speedup'] = df.fps / df.fps.iloc[0]
+    print(df.to_string(float_format='%.2f'))
+    if out_csv:
+        df.to_csv(out_csv)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(main)
@@ -0,0 +1,259 @@
+'''Microbenchmarks for the utilities that keep showing up in profiles, on synthetic inputs at three sizes.
+
+Each benchmark's ``setup(size)`` builds its inputs and returns the call to time (and the input sizes).
+Calls are timed with ``timeit`` (``autorange`` picks the loop count, then the best / median of ``repeat`` runs).
+Results go to a JSON file, so two runs (e.g. before and after a change) can be compared with ``--compare``.
+
+usage:
+    python -m object_states.bench.micro --out-json bench/micro_before.json
+    python -m object_states.bench.micro --out-json bench/micro_after.json --compare bench/micro_before.json
+    python -m object_states.bench.micro 'eta_*' mask_iou --sizes small,medium
+
+Benchmarks whose module can't be imported (e.g. fiftyone isn't installed) are reported as skipped.
+'''
+import os
+import time
+import fnmatch
+import platform
+import timeit
+import numpy as np
+import pandas as pd
+
+from ..util.synthetic import SyntheticScene
+from .pipeline import save_json, load_json
+
+SIZES = ['small', 'medium', 'large']
+
+# frame sizes (w, h)
+FRAMES = {'small': (320, 240), 'medium': (960, 540), 'large': (1920, 1080)}
+
+
+def scene_objects(size, n_objects=5, seed=0):
+    '''Boxes (xyxy), masks and track ids of a synthetic frame.'''
+    return SyntheticScene(FRAMES[size], n_objects, seed).objects(0)
+
+
+# ---------------------------------------------------------------------------- #
+#                                      NMS                                     #
+# ---------------------------------------------------------------------------- #
+
+
+def bench_asymmetric_nms(size):
+    import torch
+    from ..util.nms import asymmetric_nms
+    n = {'small': 10, 'medium': 100, 'large': 1000}[size]
+    rng = np.random.default_rng(0)
+    xy = rng.uniform(0, 900, (n, 2))
+    wh = rng.uniform(10, 200, (n, 2))
+    boxes = torch.as_tensor(np.concatenate([xy, xy + wh], 1), dtype=torch.float32)
+    scores = torch.as_tensor(rng.uniform(0, 1, n), dtype=torch.float32)
+    priority = torch.as_tensor(rng.integers(0, 3, n))
+    return lambda: asymmetric_nms(boxes, scores, priority, iou_threshold=0.85), {'n': n}
+
+
+def bench_mask_iou(size):
+    import torch
+    from ..util.nms import mask_iou
+    n, m = {'small': (5, 5), 'medium': (10, 10), 'large': (15, 10)}[size]
+    _, a, _ = scene_objects(size, n, seed=0)
+    _, b, _ = scene_objects(size, m, seed=1)
+    a, b = torch.as_tensor(a), torch.as_tensor(b)
+    return lambda: mask_iou(a, b), {'n': n, 'm': m, 'frame': FRAMES[size]}
+
+
+# ---------------------------------------------------------------------------- #
+#                                      ETA                                     #
+# ---------------------------------------------------------------------------- #
+
+
+def bench_eta_binary_mask_to_polygon(size):
+    from ..util import eta_format as eta
+    xyxy, masks, _ = scene_objects(size, 1)
+    return lambda: eta.binary_mask_to_polygon(masks[0], xyxy[0]), {'frame': FRAMES[size], 'area': int(masks[0].sum())}
+
+
+def bench_eta_polygon_to_binary_mask(size):
+    from ..util import eta_format as eta
+    xyxy, masks, _ = scene_objects(size, 1)
+    poly = eta.binary_mask_to_polygon(masks[0], xyxy[0])
+    shape = masks.shape[1:]
+    return lambda: eta.polygon_to_binary_mask(poly, shape), {'frame': FRAMES[size], 'points': sum(len(p) // 2 for p in poly)}
+
+
+def bench_eta_get_frame_objects(size):
+    from ..util import eta_format as eta
+    n = {'small': 5, 'medium': 20, 'large': 50}[size]
+    xyxy, masks, track_ids = scene_objects(size, n)
+    shape = masks.shape[1:]
+    base = eta.eta_base()
+    eta.add_frame(base, 0, [
+        eta.object(int(t), 'object', b, m.astype(np.uint8), 1., shape=shape)
+        for b, m, t in zip(xyxy, masks, track_ids)])
+    return lambda: eta.get_frame_objects(base, 0, shape), {'n': n, 'frame': FRAMES[size]}
+
+
+# ---------------------------------------------------------------------------- #
+#                                Format convert                                #
+# ---------------------------------------------------------------------------- #
+
+
+def fo_detections(size, n):
+    import fiftyone as fo
+    from ..util.format_convert import xyxy2xywhn
+    xyxy, masks, track_ids = scene_objects(size, n)
+    xyxy = xyxy.astype(int)
+    xywhn = xyxy2xywhn(xyxy.astype(float), masks.shape[1:])
+    return fo.Detections(detections=[
+        fo.Detection(label='object', bounding_box=list(b), mask=m[y1:y2, x1:x2], index=int(t), confidence=1.)
+        for b, m, t, (x1, y1, x2, y2) in zip(xywhn, masks, track_ids, xyxy)])
+
+
+def bench_fo_to_sv(size):
+    from ..util.format_convert import fo_to_sv
+    n = {'small': 5, 'medium': 20, 'large': 50}[size]
+    dets = fo_detections(size, n)
+    W, H = FRAMES[size]
+    return lambda: fo_to_sv(dets, (H, W)), {'n': n, 'frame': FRAMES[size]}
+
+
+def bench_xyxy2xywhn(size):
+    from ..util.format_convert import xyxy2xywhn
+    n = {'small': 10, 'medium': 1000, 'large': 100000}[size]
+    xyxy = np.random.default_rng(0).uniform(0, 500, (n, 4))
+    # it converts in place, so this includes a copy
+    return lambda: xyxy2xywhn(xyxy.copy(), (540, 960)), {'n': n}
+
+
+def bench_detection2mask(size):
+    from ..util.format_convert import detection2mask
+    d = fo_detections(size, 1).detections[0]
+    return lambda: detection2mask(d, FRAMES[size], (480, 270)), {'frame': FRAMES[size]}
+
+
+# ---------------------------------------------------------------------------- #
+#                                  Annotations                                 #
+# ---------------------------------------------------------------------------- #
+
+
+def bench_get_obj_anns(size):
+    from ..util.step_annotations import get_obj_anns
+    n, n_frames = {'small': (10, 100), 'medium': (50, 1000), 'large': (200, 10000)}[size]
+    start = np.sort(np.random.default_rng(0).choice(n_frames, n, replace=False))
+    df = pd.DataFrame({
+        'object': 'bowl',
+        'state': [f'state{i % 4}' for i in range(n)],
+        'start_frame': start,
+        'stop_frame': np.append(start[1:], np.nan),
+    })
+    return lambda: get_obj_anns(df, range(n_frames)), {'n_annotations': n, 'n_frames': n_frames}
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Smoothing                                  #
+# ---------------------------------------------------------------------------- #
+
+
+SERIES = {'small': (100, 10), 'medium': (10000, 50), 'large': (100000, 100)}
+
+
+def bench_moving_average(size):
+    from ..eval import moving_average
+    a = np.random.default_rng(0).uniform(0, 1, SERIES[size])
+    return lambda: moving_average(a, 5), {'shape': SERIES[size]}
+
+
+def bench_exponentially_decaying_average(size):
+    from ..eval import exponentially_decaying_average
+    a = np.random.default_rng(0).uniform(0, 1, SERIES[size])
+    return lambda: exponentially_decaying_average(a, 0.9), {'shape': SERIES[size]}
+
+
+# ---------------------------------------------------------------------------- #
+#                                     Video                                    #
+# ---------------------------------------------------------------------------- #
+
+
+def bench_resize_with_pad(size):
+    from ..util.video import resize_with_pad
+    W, H = FRAMES[size]
+    image = np.random.default_rng(0).integers(0, 255, (H, W, 3), dtype=np.uint8)
+    return lambda: resize_with_pad(image, (224, 224)), {'frame': FRAMES[size], 'out': (224, 224)}
+
+
+BENCHMARKS = {
+    'asymmetric_nms': bench_asymmetric_nms,
+    'mask_iou': bench_mask_iou,
+    'eta_binary_mask_to_polygon': bench_eta_binary_mask_to_polygon,
+    'eta_polygon_to_binary_mask': bench_eta_polygon_to_binary_mask,
+    'eta_get_frame_objects': bench_eta_get_frame_objects,
+    'fo_to_sv': bench_fo_to_sv,
+    'xyxy2xywhn': bench_xyxy2xywhn,
+    'detection2mask': bench_detection2mask,
+    'get_obj_anns': bench_get_obj_anns,
+    'moving_average': bench_moving_average,
+    'exponentially_decaying_average': bench_exponentially_decaying_average,
+    'resize_with_pad': bench_resize_with_pad,
+}
+
+
+# ---------------------------------------------------------------------------- #
+#                                     Main                                     #
+# ---------------------------------------------------------------------------- #
+
+
+def time_call(func, repeat=5):
+    '''Per-call seconds: (best, median, loops per run).'''
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    times = np.array(timer.repeat(repeat, number)) / number
+    return times.min(), np.median(times), number
+
+
+def main(*names, sizes=SIZES, repeat=5, out_json='bench/micro.json', compare=None):
+    '''
+    Arguments:
+        *names (str): Benchmarks to run (glob patterns). Default: all of them.
+        sizes (list): Input sizes (``small``, ``medium``, ``large``).
+        repeat (int): Timing runs per benchmark (each is ``autorange``'s number of loops).
+        out_json (str): Where to write the results.
+        compare (str): A previous results file. Adds its median and the speedup.
+    '''
+    sizes = sizes.split(',') if isinstance(sizes, str) else list(sizes)
+    selected = [k for k in BENCHMARKS if not names or any(fnmatch.fnmatch(k, p) for p in names)]
+    assert selected, f"No benchmarks match {names}. Available: {list(BENCHMARKS)}"
+
+    results = {}
+    for name in selected:
+        for size in sizes:
+            try:
+                func, params = BENCHMARKS[name](size)
+            except ImportError as e:
+                print(f'{name} ({size}): skipped ({e})')
+                results.setdefault(name, {})[size] = {'skipped': str(e)}
+                continue
+            best, median, number = time_call(func, repeat)
+            results.setdefault(name, {})[size] = {
+                'best_us': best * 1e6, 'median_us': median * 1e6, 'loops': number, 'repeat': repeat, 'params': params}
+            print(f'{name} ({size}): {median * 1e6:.1f} us')
+
+    save_json({
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count(), 'numpy': np.__version__},
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }, out_json)
+    print('Wrote', out_json)
+
+    df = pd.DataFrame([
+        {'benchmark': name, 'size': size, **{k: v for k, v in r.items() if k != 'params'}}
+        for name, rs in results.items() for size, r in rs.items()
+    ]).set_index(['benchmark', 'size'])
+    if compare and 'median_us' in df:
+        old = load_json(compare)['results']
+        df['before_us'] = [old.get(name, {}).get(size, {}).get('median_us', np.nan) for name, size in df.index]
+        df['speedup'] = df.before_us / df.median_us
+    print(df.to_string(float_format='%.2f'))
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(main)
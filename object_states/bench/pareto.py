@@ -0,0 +1,242 @@
+'''Throughput vs accuracy for each detection rate and tracking resolution, and the Pareto frontier.
+
+Every (detect_every, track_width) pair runs Perception over the same videos in its own process and records
+its fps, per-stage CPU time, peak memory, and tracking / state accuracy (``track_eval``) against ground truth.
+
+usage:
+    # CI: stub models on a synthetic scene (ground truth comes from the scene)
+    python -m object_states.bench.pareto --stub --n-frames 90
+    # real models on the eval set
+    python -m object_states.bench.pareto '/datasets/ptgrecipes_minieval/*.mp4' --gt /datasets/xmem_eval_gt --state-db v0
+
+The default grid matches ``config/detic_rate`` (0.5/1/2/4 fps) and the ``config/xmem_eval`` frame sizes.
+Writes ``pareto.csv`` and ``pareto.png`` to ``out_dir``.
+'''
+import os
+import glob
+import time
+import resource
+import contextlib
+import itertools
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from ..util import eta_format as eta
+from ..util.synthetic import SyntheticScene
+
+STAGES = ['detect', 'hoi', 'track', 'encode', 'state_lookup', 'merge_hoi']
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Videos                                    #
+# ---------------------------------------------------------------------------- #
+
+
+def iter_frames(src, n_frames=None, scene=None):
+    '''(frame iterator, fps) for a video file, or for the synthetic scene if ``src`` is None.'''
+    if src is None:
+        s = SyntheticScene(**scene)
+        return (s.frame(i) for i in range(n_frames)), scene.get('fps', 30)
+    import supervision as sv
+    info = sv.VideoInfo.from_video_path(src)
+    frames = sv.get_video_frames_generator(src)
+    return (itertools.islice(frames, n_frames) if n_frames else frames), info.fps
+
+
+def synthetic_labels(fname, scene, n_frames):
+    '''Write the synthetic scene's ground truth (with ``stubs.object_label``/``object_state``) as ETA labels.'''
+    from .stubs import object_label, object_state
+    s = SyntheticScene(**{k: v for k, v in scene.items() if k != 'fps'})
+    labels = eta.eta_base()
+    for i in range(n_frames):
+        xyxy, masks, track_ids = s.objects(i)
+        eta.add_frame(labels, i, [
+            eta.object(int(tid), object_label(k), box, mask.astype(np.uint8), 1., shape=masks.shape[1:], attrs=[eta.attr('state', object_state(k))])
+            for k, (box, mask, tid) in enumerate(zip(xyxy, masks, track_ids))
+        ])
+    eta.save(labels, fname)
+    return fname
+
+
+def eta_objects(detections, shape):
+    '''Perception's track detections as ETA objects (index: track id, ``state``: the most likely state).'''
+    if detections is None or not len(detections):
+        return []
+    d = detections.to('cpu')
+    states = d.pred_states if d.has('pred_states') else [None] * len(d)
+    return [
+        eta.object(
+            int(tid), label, box, (mask > 0).astype(np.uint8), float(score), shape=shape,
+            attrs=[eta.attr('state', str(max(s, key=s.get)))] if s else None)
+        for tid, label, box, mask, score, s in zip(
+            d.track_ids.numpy(), d.pred_labels, d.pred_boxes.tensor.numpy(),
+            d.pred_masks.numpy(), d.scores.numpy(), states)
+    ]
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Settings                                   #
+# ---------------------------------------------------------------------------- #
+
+
+def run_setting(detect_every, track_width, videos, gt, n_frames=None, scene=None, stub=False, iou='mask', **kw):
+    '''Run one setting over the videos (in a fresh process, so the peak memory is its own).'''
+    import torch
+    from ..inference import Perception
+    from ..util import trace
+    from .. import track_eval
+    from .stubs import stub_models, STUB_LABELS
+
+    scene = scene or {}
+    if stub:
+        kw.setdefault('vocabulary', {'tracked': STUB_LABELS})
+        kw.setdefault('device', 'cpu')
+    else:
+        from ..inference.vocab import VOCAB
+        kw.setdefault('vocabulary', VOCAB)
+    colors = SyntheticScene(**{k: v for k, v in scene.items() if k != 'fps'}).colors
+    with stub_models(colors) if stub else contextlib.nullcontext():
+        model = Perception(detect_every_n_seconds=detect_every, track_width=track_width, **kw)
+
+    tracer = trace.enable(memory_every=10, cpu=True)
+    n = 0
+    elapsed = 0.
+    counts = []
+    try:
+        for name, src in videos.items():
+            model.clear_memory()
+            frames, fps = iter_frames(src, n_frames, scene)
+            labels = eta.eta_base()
+            for i, frame in enumerate(frames):
+                trace.set_frame(i)
+                t0 = time.perf_counter()
+                with trace.span('predict'):
+                    track_detections, _, _ = model.predict(frame, i / fps)
+                elapsed += time.perf_counter() - t0
+                n += 1
+                eta.add_frame(labels, i, eta_objects(track_detections, frame.shape[:2]))
+            if gt.get(name):
+                c, _ = track_eval.evaluate(
+                    track_eval.load_labels(gt[name], masks=iou == 'mask'),
+                    track_eval.load_labels(labels, masks=iou == 'mask'), iou=iou)
+                counts.append(c)
+    finally:
+        trace.disable()
+
+    cpu = tracer.cpu_times()
+    row = {
+        'detect_every': detect_every,
+        'track_width': track_width,
+        'frames': n,
+        'fps': n / elapsed if elapsed else np.nan,
+        'cpu_ms': 1000 * cpu.get('predict', np.nan) / max(n, 1),
+        **{f'cpu_{k}_ms': 1000 * cpu.get(k, 0) / max(n, 1) for k in STAGES},
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if torch.cuda.is_available():
+        row['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2**20
+    if counts:
+        m = track_eval.metrics(track_eval.sum_counts(counts))
+        row.update({k: m[k] for k in ['HOTA', 'DetA', 'AssA', 'MOTA', 'IDF1', 'IDSW', 'StateAcc']})
+    return row
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Pareto                                    #
+# ---------------------------------------------------------------------------- #
+
+
+def pareto_front(df, x='fps', y='HOTA'):
+    '''Which rows no other row beats on both ``x`` and ``y`` (higher is better for both).'''
+    pts = df[[x, y]].to_numpy(dtype=float)
+    ok = ~np.isnan(pts).any(1)
+    better_eq = (pts[None] >= pts[:, None]).all(-1)
+    better = (pts[None] > pts[:, None]).any(-1)
+    dominated = (better_eq & better & ok[None]).any(1)
+    return ok & ~dominated
+
+
+def plot_pareto(df, fname, x='fps', y='HOTA'):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(7, 5))
+    for w, d in df.groupby('track_width', dropna=False):
+        ax.scatter(d[x], d[y], label=f'track_width={w}')
+    front = df[df.pareto].sort_values(x)
+    ax.plot(front[x], front[y], 'k--', lw=1, label='Pareto frontier')
+    for _, r in df.iterrows():
+        ax.annotate(f'{r.detect_every:g}s', (r[x], r[y]), fontsize=7, xytext=(3, 3), textcoords='offset points')
+    ax.set_xlabel(x)
+    ax.set_ylabel(y)
+    ax.set_title('detection interval (s) / tracking width')
+    ax.legend(fontsize=8)
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    fig.savefig(fname, dpi=150, bbox_inches='tight')
+    plt.close(fig)
+    return fname
+
+
+def main(*videos, gt=None, detect_every=(2, 1, 0.5, 0.25), track_width=(140, 280, 420, 700), n_frames=None,
+         stub=False, metric='HOTA', iou='mask', state_db=None, n_objects=5, size=(960, 540), fps=30,
+         out_dir='bench/pareto', **kw):
+    '''
+    Arguments:
+        *videos (str): Video files / globs. Defaults to a synthetic scene (with its own ground truth).
+        gt (str): The ground truth ETA labels for the videos (a file or dataset directory, see ``track_eval``).
+        detect_every (list): Detection intervals (seconds).
+        track_width (list): Tracking widths (None: full size).
+        n_frames (int): Only use the first N frames of each video (synthetic default: 150).
+        stub (bool): Use the stub models (``bench/stubs.py``) instead of Detic/EgoHOS/XMem/CLIP.
+        metric (str): The accuracy metric for the frontier (``HOTA``, ``MOTA``, ``IDF1``, ``StateAcc``, ...).
+        state_db (str): The state db. With ``--stub`` on the synthetic scene, a stub db is made.
+        **kw: Passed to ``Perception``.
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    scene = {'size': tuple(size), 'n_objects': n_objects, 'seed': 0, 'fps': fps}
+    if videos:
+        videos = {
+            os.path.splitext(os.path.basename(f))[0]: f
+            for v in videos for f in sorted(glob.glob(v)) or [v]}
+        from ..track_eval import label_files
+        gt_files = label_files(gt) if gt else {}
+    else:
+        n_frames = n_frames or 150
+        videos = {'synthetic': None}
+        gt_files = {'synthetic': synthetic_labels(eta.label_fname(os.path.join(out_dir, 'gt'), 'synthetic'), scene, n_frames)}
+        if stub and state_db is None:
+            from .stubs import stub_state_db
+            state_db = stub_state_db(os.path.join(out_dir, 'stub_states.lancedb'), SyntheticScene(**{k: v for k, v in scene.items() if k != 'fps'}).colors)
+    if not gt_files:
+        print("No ground truth - only measuring throughput")
+
+    rows = []
+    for d, w in itertools.product(detect_every, track_width):
+        # fresh process per setting
+        with ProcessPoolExecutor(1, mp_context=mp.get_context('spawn')) as pool:
+            row = pool.submit(
+                run_setting, d, w, videos, gt_files, n_frames=n_frames, scene=scene, stub=stub,
+                iou=iou, state_db_fname=state_db, **kw).result()
+        print(row)
+        rows.append(row)
+
+    df = pd.DataFrame(rows)
+    if metric in df.columns:
+        df['pareto'] = pareto_front(df, 'fps', metric)
+        try:
+            print('Wrote', plot_pareto(df, os.path.join(out_dir, 'pareto.png'), 'fps', metric))
+        except ImportError:
+            print("matplotlib isn't installed - not plotting")
+    else:
+        df['pareto'] = False
+    df = df.sort_values('fps', ascending=False)
+    cols = ['detect_every', 'track_width', 'fps', metric, 'cpu_ms', 'peak_rss_mb', 'pareto']
+    print(df[[c for c in cols if c in df.columns]].to_string(index=False, float_format='%.3f'))
+    df.to_csv(os.path.join(out_dir, 'pareto.csv'), index=False)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(main)
@@ -0,0 +1,205 @@
+'''End-to-end throughput of our own code, with Detic, EgoHOS, XMem and CLIP swapped for the stubs in ``bench/stubs.py``.
+
+The stub models take next to no time, so what's left is the pipeline around them: conversions, NMS, state lookup,
+serialization, drawing and writing. Each case (frame height x object count) runs on a generated video through
+``Perception.predict`` and ``run_one`` (with writers and, unless ``--no-render``, the renderer).
+
+usage:
+    python -m object_states.bench.pipeline --save-baseline bench/pipeline_baseline.json
+    # later / in CI: fails if any case got more than 10% slower
+    python -m object_states.bench.pipeline --baseline bench/pipeline_baseline.json --threshold 0.1
+
+Results (fps, ms per frame and ms per frame for each traced stage) are written to ``{out_dir}/pipeline.json``.
+Only compare against a baseline from the same machine.
+'''
+import os
+import time
+import platform
+import orjson
+import cv2
+import numpy as np
+import pandas as pd
+
+from ..util.synthetic import SyntheticScene, synthetic_video
+
+# stages that run in a background thread (not part of the per-frame latency)
+BACKGROUND = ['render', 'draw']
+
+
+# ---------------------------------------------------------------------------- #
+#                                     Cases                                    #
+# ---------------------------------------------------------------------------- #
+
+
+def build_model(n_objects, state_db, detect_every=0.5, **kw):
+    from ..inference import Perception
+    from .stubs import stub_models, STUB_LABELS
+    kw.setdefault('vocabulary', {'tracked': STUB_LABELS})
+    kw.setdefault('device', 'cpu')
+    with stub_models(None, n_objects=n_objects):
+        return Perception(detect_every_n_seconds=detect_every, state_db_fname=state_db, **kw)
+
+
+def stage_ms(tracer, n_frames, total_ms):
+    '''ms per frame for each stage, plus ``untraced``: the foreground time outside of any stage.'''
+    stages = {k: v.sum() / max(n_frames, 1) for k, v in tracer.durations().items()}
+    stages['untraced'] = max(total_ms / max(n_frames, 1) - sum(v for k, v in stages.items() if k not in BACKGROUND), 0)
+    return stages
+
+
+def bench_predict(src, size, n_objects, state_db, n_frames=60, warmup=5, **kw):
+    '''Time ``Perception.predict`` on each frame.'''
+    import supervision as sv
+    from ..util import trace
+    model = build_model(n_objects, state_db, **kw)
+    info = sv.VideoInfo.from_video_path(src)
+    W, H = int(info.width * size / info.height) // 16 * 16, size
+
+    tracer = None
+    elapsed = 0.
+    n = 0
+    try:
+        for i, frame in enumerate(sv.get_video_frames_generator(src)):
+            if i >= n_frames + warmup:
+                break
+            if i == warmup:
+                tracer = trace.enable(memory_every=0)
+            frame = cv2.resize(frame, (W, H))
+            trace.set_frame(i)
+            t0 = time.perf_counter()
+            model.predict(frame, i / info.fps)
+            if i >= warmup:
+                elapsed += time.perf_counter() - t0
+                n += 1
+    finally:
+        trace.disable()
+    return n, elapsed, tracer
+
+
+def bench_run_one(src, size, n_objects, state_db, out_dir, render=True, **kw):
+    '''Time ``run_one`` over the whole video (including its writers and the renderer).'''
+    from ..inference.run import run_one
+    from ..util import trace
+    model = build_model(n_objects, state_db, **kw)
+    tracer = trace.enable(memory_every=0)
+    try:
+        t0 = time.perf_counter()
+        run_one(
+            model, src, size=size, dataset_dir=out_dir, overwrite=True, resume=False,
+            checkpoint_every=0, render=render, skip_every=1, first_frame=0)
+        elapsed = time.perf_counter() - t0
+    finally:
+        trace.disable()
+    n = len(tracer.durations().get('track', []))
+    return n, elapsed, tracer
+
+
+def run_case(mode, src, size, n_objects, state_db, out_dir, **kw):
+    if mode == 'predict':
+        n, elapsed, tracer = bench_predict(src, size, n_objects, state_db, **kw)
+    else:
+        kw.pop('warmup', None)
+        kw.pop('n_frames', None)
+        n, elapsed, tracer = bench_run_one(
+            src, size, n_objects, state_db, os.path.join(out_dir, 'run_one', f'{size}p_{n_objects}obj'), **kw)
+    ms = 1000 * elapsed
+    return {
+        'frames': n,
+        'fps': n / elapsed if elapsed else None,
+        'ms_per_frame': ms / max(n, 1),
+        'stages': stage_ms(tracer, n, ms),
+    }
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Baseline                                   #
+# ---------------------------------------------------------------------------- #
+
+
+def compare(results, baseline, threshold=0.1, min_ms=0.5):
+    '''Compare each case's ms per frame (and each stage taking at least ``min_ms``) against the baseline.
+
+    Returns a DataFrame with one row per case/stage and ``regressed`` where it got more than ``threshold`` slower.
+    '''
+    rows = []
+    for case, r in results['cases'].items():
+        b = baseline['cases'].get(case)
+        if b is None:
+            continue
+        pairs = [('total', r['ms_per_frame'], b['ms_per_frame'])] + [
+            (k, v, b['stages'][k]) for k, v in r['stages'].items()
+            if k in b['stages'] and k not in BACKGROUND and b['stages'][k] >= min_ms]
+        for stage, ms, base_ms in pairs:
+            change = ms / base_ms - 1 if base_ms else np.nan
+            rows.append({'case': case, 'stage': stage, 'ms': ms, 'baseline_ms': base_ms, 'change': change, 'regressed': change > threshold})
+    return pd.DataFrame(rows, columns=['case', 'stage', 'ms', 'baseline_ms', 'change', 'regressed'])
+
+
+def save_json(data, fname):
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    with open(fname, 'wb') as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+    return fname
+
+
+def load_json(fname):
+    with open(fname, 'rb') as f:
+        return orjson.loads(f.read())
+
+
+def main(sizes=(240, 480, 720), n_objects=(1, 5, 20), modes=('predict', 'run_one'), n_frames=60, warmup=5,
+         detect_every=0.5, render=True, baseline=None, threshold=0.1, min_ms=0.5, save_baseline=None,
+         out_dir='bench/pipeline', **kw):
+    '''
+    Arguments:
+        sizes (list): Frame heights.
+        n_objects (list): Objects per frame (made up by the stub detector, whatever the video shows).
+        modes (list): ``predict`` (``Perception.predict`` only) and/or ``run_one`` (the full video loop).
+        n_frames (int): Frames to time. ``predict`` runs ``warmup`` frames first (``run_one`` times the whole video).
+        render (bool): Draw the debug videos in ``run_one``.
+        baseline (str): A previous ``pipeline.json`` to compare against. Exits with an error if anything regressed.
+        threshold (float): How much slower (as a fraction) a case or stage can get before it counts as a regression.
+        min_ms (float): Ignore stages that took less than this (ms per frame) in the baseline - they're mostly noise.
+        save_baseline (str): Also write the results here.
+        **kw: Passed to ``Perception``.
+    '''
+    from .stubs import stub_state_db
+    modes = [modes] if isinstance(modes, str) else modes
+    src = synthetic_video(os.path.join(out_dir, f'synthetic_{n_frames + warmup}.mp4'), n_frames=n_frames + warmup, size=(1280, 720))
+    state_db = stub_state_db(os.path.join(out_dir, 'stub_states.lancedb'), SyntheticScene(n_objects=max(n_objects)).colors)
+
+    results = {
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'cpus': os.cpu_count()},
+        'settings': {'n_frames': n_frames, 'warmup': warmup, 'detect_every': detect_every, 'render': render},
+        'cases': {},
+    }
+    for mode in modes:
+        for size in sizes:
+            for n in n_objects:
+                case = f'{mode}/{size}p/{n}obj'
+                r = results['cases'][case] = run_case(
+                    mode, src, size, n, state_db, out_dir, n_frames=n_frames, warmup=warmup,
+                    detect_every=detect_every, **({'render': render} if mode == 'run_one' else {}), **kw)
+                print(case, f"{r['fps']:.1f} fps", {k: round(v, 2) for k, v in r['stages'].items()})
+
+    print('Wrote', save_json(results, os.path.join(out_dir, 'pipeline.json')))
+    if save_baseline:
+        print('Wrote', save_json(results, save_baseline))
+
+    df = pd.DataFrame([
+        {'case': case, 'fps': r['fps'], 'ms_per_frame': r['ms_per_frame'], **r['stages']}
+        for case, r in results['cases'].items()
+    ]).set_index('case')
+    print(df.to_string(float_format='%.2f'))
+
+    if baseline:
+        cmp = compare(results, load_json(baseline), threshold, min_ms)
+        print(cmp.to_string(index=False, float_format='%.3f'))
+        bad = cmp[cmp.regressed]
+        if len(bad):
+            raise SystemExit(f'{len(bad)} regressions (> {threshold:.0%} slower than {baseline}):\n{bad.to_string(index=False)}')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(main)
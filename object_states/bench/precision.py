@@ -0,0 +1,149 @@
+'''Accuracy guard for the reduced-precision CLIP state embedding.
+
+Embeds a held-out sample of crops with fp32 and each reduced precision, then compares:
+
+ - embedding cosine similarity to fp32
+ - kNN neighbour overlap with fp32 (top-k against the state db, per object)
+ - state prediction agreement with fp32 (majority vote of the k neighbours, like ``predict_state``)
+ - state accuracy against the ground truth
+ - encoder throughput
+
+The crops are read from an imagenet-style export (``{object}__{state}/*.JPEG``, see ``util/to_imagenet.py``).
+
+usage: python -m object_states.bench.precision /datasets/annotation_final_imagenet/val --state-db v0.lancedb
+'''
+import os
+import glob
+import time
+import numpy as np
+import pandas as pd
+import torch
+import tqdm
+from PIL import Image
+
+from ..util.precision import PRECISIONS, load_clip, encode_image
+
+
+def load_crops(crop_dir, n=1000, seed=0):
+    fs = sorted(glob.glob(os.path.join(crop_dir, '*__*', '*')))
+    assert fs, f"No crops found in {crop_dir}"
+    if n and len(fs) > n:
+        fs = sorted(np.random.default_rng(seed).choice(fs, n, replace=False))
+    classes = [os.path.basename(os.path.dirname(f)).split('__', 1) for f in fs]
+    df = pd.DataFrame(classes, columns=['object', 'state'])
+    df['path'] = fs
+    return df
+
+
+def embed(paths, precision, device='cpu', batch_size=32):
+    model, preprocess = load_clip("ViT-B/32", device=device, precision=precision)
+    Z = []
+    t = 0
+    with torch.inference_mode():
+        for i in tqdm.tqdm(range(0, len(paths), batch_size), desc=precision, leave=False):
+            x = torch.stack([preprocess(Image.open(f).convert('RGB')) for f in paths[i:i+batch_size]]).to(device)
+            t0 = time.perf_counter()
+            Z.append(encode_image(model, x, precision).cpu().numpy())
+            t += time.perf_counter() - t0
+    return np.concatenate(Z), len(paths) / t
+
+
+def normalize(Z):
+    return Z / np.linalg.norm(Z, axis=-1, keepdims=True)
+
+
+def load_index(state_db, state_key='mod_state'):
+    '''Load the state db as {object: (vectors, states)}.'''
+    import lancedb
+    db = lancedb.connect(state_db)
+    index = {}
+    for name in db.table_names():
+        df = db.open_table(name).to_pandas()
+        index[name] = normalize(np.array(list(df['vector'].values), dtype=np.float32)), df[state_key].values
+    return index
+
+
+def knn(Z, X, k):
+    # the db vectors are normalized so this gives the same ranking as the L2 search
+    sim = normalize(Z) @ X.T
+    return np.argsort(-sim, axis=1)[:, :k]
+
+
+def vote(states, idx):
+    return np.array([pd.Series(s).value_counts().index[0] for s in states[idx]])
+
+
+def compare(df, Z_ref, Z, index, k=11):
+    '''Compare an embedding against the fp32 reference.'''
+    cos = (normalize(Z_ref) * normalize(Z)).sum(-1)
+    overlap = np.full(len(df), np.nan)
+    top1 = np.full(len(df), np.nan)
+    agree = np.full(len(df), np.nan)
+    correct = np.full(len(df), np.nan)
+    for obj, i in df.groupby('object').indices.items():
+        if obj not in index:
+            continue
+        X, states = index[obj]
+        kk = min(k, len(X))
+        nn_ref, nn = knn(Z_ref[i], X, kk), knn(Z[i], X, kk)
+        overlap[i] = [len(set(a) & set(b)) / kk for a, b in zip(nn_ref, nn)]
+        top1[i] = nn_ref[:, 0] == nn[:, 0]
+        y_ref, y = vote(states, nn_ref), vote(states, nn)
+        agree[i] = y_ref == y
+        correct[i] = y == df.state.values[i]
+    return {
+        'cos_mean': cos.mean(),
+        'cos_min': cos.min(),
+        f'knn{k}_overlap': np.nanmean(overlap),
+        'top1_same': np.nanmean(top1),
+        'state_agreement': np.nanmean(agree),
+        'state_accuracy': np.nanmean(correct),
+    }
+
+
+def self_index(df, Z):
+    '''Without a state db, use the fp32 sample itself as the index.'''
+    return {
+        obj: (normalize(Z[i]), df.state.values[i])
+        for obj, i in df.groupby('object').indices.items()
+    }
+
+
+def main(crop_dir, state_db=None, state_key='mod_state', precisions=PRECISIONS, n=1000, k=11,
+         device='cpu', batch_size=32, min_agreement=0.99, out_csv=None):
+    df = load_crops(crop_dir, n)
+    print(f"Using {len(df)} held-out crops from {crop_dir}")
+    print(df.groupby('object').state.value_counts())
+
+    Zs, speed = {}, {}
+    for p in ['fp32'] + [p for p in precisions if p != 'fp32']:
+        Zs[p], speed[p] = embed(df.path.tolist(), p, device, batch_size)
+
+    if state_db:
+        index = load_index(state_db, state_key)
+    else:  # no state db: index half of the fp32 sample and query with the other half
+        is_index = np.arange(len(df)) % 2 == 0
+        index = self_index(df[is_index], Zs['fp32'][is_index])
+        df = df[~is_index]
+        Zs = {p: Z[~is_index] for p, Z in Zs.items()}
+    rows = []
+    for p, Z in Zs.items():
+        rows.append({
+            'precision': p,
+            'crops_per_sec': speed[p],
+            'speedup': speed[p] / speed['fp32'],
+            **compare(df, Zs['fp32'], Z, index, k),
+        })
+    res = pd.DataFrame(rows).set_index('precision')
+    print(res.to_string(float_format='%.4f'))
+    if out_csv:
+        res.to_csv(out_csv)
+
+    failed = res.index[res.state_agreement < min_agreement].tolist()
+    if failed:
+        raise SystemExit(f"State predictions changed for {failed} (agreement < {min_agreement})")
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(main)
@@ -0,0 +1,48 @@
+'''Can a config keep up in real time? Replay a synthetic recording against a simulated model.
+
+The model takes ``infer_ms`` per frame, plus ``detect_ms`` on detection frames (every ``detect_every`` seconds).
+Each drop policy is replayed at recorded speed and reports its fps, drop rate and latency percentiles.
+
+usage: python -m object_states.bench.realtime --fps 30 --infer-ms 25 --detect-ms 80 --slo 0.2
+'''
+import time
+import pandas as pd
+
+from ..util.synthetic import synthetic_recording
+from ..inference.realtime import RealtimeReplay, POLICIES
+
+
+def simulate(policy, messages, infer_ms, detect_ms, detect_every, slo, every, speed=1):
+    replay = RealtimeReplay(
+        iter(messages), get_time=lambda t: t / 1000, speed=speed, slo=slo,
+        policy=policy, every=every, detect_every=detect_every)
+    last_detect = -1e30
+    for sid, t, msg in replay:
+        if sid != 'main':
+            continue
+        cost = infer_ms
+        if t / 1000 - last_detect >= detect_every:
+            last_detect = t / 1000
+            cost += detect_ms
+        time.sleep(cost / 1000)
+        replay.done()
+    return replay.report()
+
+
+def main(duration=10, fps=30, infer_ms=25, detect_ms=80, detect_every=0.5, slo=0.2, every=2, speed=1, out_csv=None):
+    messages = [
+        (sid, t, None) for sid, t, _ in
+        synthetic_recording(int(duration * fps), fps=fps, size=(64, 48), depth_size=(8, 6))]
+    rows = []
+    for policy in POLICIES:
+        rows.append(simulate(policy, messages, infer_ms, detect_ms, detect_every, slo, every, speed))
+        print(rows[-1])
+    df = pd.DataFrame(rows).set_index('policy')
+    print(df.to_string(float_format='%.2f'))
+    if out_csv:
+        df.to_csv(out_csv)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(main)
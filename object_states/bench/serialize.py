@@ -0,0 +1,99 @@
+'''Detection serialization: message size and time, the old per-detection loop vs util.serialize.
+
+``legacy`` is the previous ``Perception.serialize_detections`` (full-frame findContours).
+``bytes`` is the orjson message size per frame.
+
+usage: python -m object_states.bench.serialize --n-objects '[5,20]' --size 760x480
+'''
+import time
+import cv2
+import orjson
+import numpy as np
+import pandas as pd
+
+from ..util.synthetic import SyntheticScene
+from ..util.serialize import serialize_columns
+
+OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY
+
+
+# (name, serialize_columns options)
+SETTINGS = [
+    ('default', {}),
+    ('decimals=4', {'decimals': 4}),
+    ('epsilon=1,decimals=4', {'epsilon': 1, 'decimals': 4}),
+    ('epsilon=2,decimals=3', {'epsilon': 2, 'decimals': 3}),
+    ('epsilon=1,pixels', {'epsilon': 1, 'pixels': True}),
+]
+
+
+def legacy_serialize(boxes, labels, shape, scores, track_ids, masks):
+    bboxes = boxes / np.array(shape[:2][::-1] * 2, dtype=np.float32)
+    WH = np.array(shape[:2][::-1])
+    output = []
+    for i in range(len(boxes)):
+        contours = cv2.findContours(masks[i].astype(np.uint8), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[0]
+        output.append({
+            'xyxyn': bboxes[i].tolist(),
+            'label': labels[i],
+            'confidence': scores[i],
+            'segment': [np.asarray(c) / WH for c in contours],
+            'segment_track_id': track_ids[i],
+        })
+    return output
+
+
+def mask_error(out, masks, shape, pixels=False):
+    # 1 - IoU between the original masks and the filled polygons
+    H, W = shape[:2]
+    errs = []
+    for d, m in zip(out, masks):
+        pts = [np.asarray(c).reshape(-1, 2) for c in d['segment']]
+        pts = [(p if pixels else p * [W, H]).round().astype(np.int32) for p in pts]
+        filled = cv2.fillPoly(np.zeros((H, W), np.uint8), pts, 1).astype(bool)
+        errs.append(1 - (filled & m).sum() / max((filled | m).sum(), 1))
+    return float(np.mean(errs)) if errs else 0
+
+
+def main(n_objects=(5, 20), n_frames=30, size='760x480', out_csv=None):
+    W, H = map(int, size.split('x'))
+    shape = (H, W, 3)
+    rows = []
+    for n in n_objects:
+        scene = SyntheticScene(size=(W, H), n_objects=n)
+        frames = []
+        for i in range(n_frames):
+            boxes, masks, track_ids = scene.objects(i)
+            frames.append((boxes, [f'object {t}' for t in track_ids], np.random.rand(n).astype(np.float32), track_ids, masks))
+
+        funcs = [('legacy', lambda b, l, s, t, m: legacy_serialize(b, l, shape, s, t, m), {})]
+        funcs += [
+            (name, lambda b, l, s, t, m, kw=kw: serialize_columns(b, l, shape, scores=s, track_ids=t, masks=m, **kw), kw)
+            for name, kw in SETTINGS]
+        for name, func, kw in funcs:
+            t0 = time.perf_counter()
+            outs = [func(*x) for x in frames]
+            t_ser = time.perf_counter() - t0
+            msgs = [orjson.dumps(o, option=OPTIONS) for o in outs]
+            t_total = time.perf_counter() - t0
+            rows.append({
+                'n_objects': n, 'setting': name,
+                'ms': t_total / n_frames * 1000,
+                'serialize_ms': t_ser / n_frames * 1000,
+                'bytes': np.mean([len(m) for m in msgs]),
+                'mask_error': mask_error(outs[-1], frames[-1][-1], shape, kw.get('pixels')),
+            })
+            print(rows[-1])
+
+    df = pd.DataFrame(rows).set_index(['n_objects', 'setting'])
+    legacy = df.xs('legacy', level='setting')
+    df['size_ratio'] = df.bytes / legacy.bytes.reindex(df.index, level='n_objects')
+    df['speedup'] = legacy.ms.reindex(df.index, level='n_objects') / df.ms
+    print(df.to_string(float_format='%.3f'))
+    if out_csv:
+        df.to_csv(out_csv)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(main)
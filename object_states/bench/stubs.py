@@ -0,0 +1,259 @@
+'''Deterministic stand-ins for Detic, EgoHOS, XMem and CLIP, so Perception runs without weights or a GPU (e.g. in CI).
+
+.. code-block:: python
+
+    scene = SyntheticScene(size=(960, 540), n_objects=5)
+    with stub_models(scene.colors):
+        model = Perception(vocabulary={'tracked': STUB_LABELS}, state_db_fname=stub_state_db('states.lancedb', scene.colors), device='cpu')
+    model.predict(scene.frame(0), 0)
+
+ - ``StubDetic`` finds a ``SyntheticScene``'s objects by their color (object ``k`` is ``STUB_LABELS[k]``),
+   or, without colors, returns ``n_objects`` moving masks whatever the image (to measure the pipeline at a given object count).
+ - ``StubXMem`` matches detections to tracks by mask IoU and carries each track's last mask forward
+   unchanged until the next detection, so the accuracy drops as detections get further apart.
+ - ``StubEgoHos`` returns one left hand in the bottom corner.
+ - ``StubClip`` embeds a crop by the mean color of its center. ``stub_state_db`` builds a lancedb
+   state index for it where object ``k`` is in state ``object_state(k)``.
+
+The models only need to be stubbed while Perception is being constructed.
+'''
+import sys
+import contextlib
+from types import SimpleNamespace
+from unittest import mock
+import cv2
+import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
+from detectron2.structures import Boxes, Instances
+from torchvision.ops import masks_to_boxes
+
+from ..util.nms import mask_iou
+from ..util.synthetic import SyntheticScene
+
+STUB_LABELS = ['bowl', 'plate', 'tortilla', 'mug', 'knife']
+STUB_STATES = ['empty', 'full']
+EGOHOS_CLASSES = np.array(['', 'hand(left)', 'hand(right)', 'obj1(left)', 'obj1(right)', 'obj1(both)', 'obj2(left)', 'obj2(right)', 'obj2(both)', 'cb'])
+
+
+def object_label(k, labels=STUB_LABELS):
+    return labels[k % len(labels)]
+
+
+def object_state(k):
+    return STUB_STATES[k % len(STUB_STATES)]
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Models                                    #
+# ---------------------------------------------------------------------------- #
+
+
+class StubDetic(torch.nn.Module):
+    '''Detect objects of known colors, or (``colors=None``) make up ``n_objects`` moving objects in any image.
+
+    Arguments:
+        colors (np.ndarray): (n, 3) BGR object colors (``SyntheticScene.colors``).
+        labels (list): Object ``k``'s label is ``labels[k % len(labels)]``.
+        n_objects (int): Without colors, the number of objects (their masks follow a ``SyntheticScene``
+            at the image's size, one step per call).
+        tolerance (int): How far (per channel) a pixel can be from the color.
+        min_area (int): Drop smaller masks.
+    '''
+    def __init__(self, colors=None, labels=STUB_LABELS, n_objects=5, seed=0, tolerance=10, min_area=16, score=0.9, **kw):
+        super().__init__()
+        self.colors = None if colors is None else np.asarray(colors, dtype=int).reshape(-1, 3)
+        self.labels = list(labels)
+        self.n_objects = n_objects
+        self.seed = seed
+        self.tolerance = tolerance
+        self.min_area = min_area
+        self.score = score
+        self.scene = None
+        self.i = 0
+
+    def build_query(self, image):
+        return StubDeticQuery(self, image)
+
+    def color_masks(self, image):
+        masks, ks = [], []
+        for k, c in enumerate(self.colors):
+            m = cv2.inRange(image, np.clip(c - self.tolerance, 0, 255), np.clip(c + self.tolerance, 0, 255)) > 0
+            if m.sum() >= self.min_area:
+                masks.append(m)
+                ks.append(k)
+        return masks, ks
+
+    def random_masks(self, image):
+        H, W = image.shape[:2]
+        if self.scene is None or self.scene.size != (W, H):
+            self.scene = SyntheticScene((W, H), self.n_objects, self.seed)
+        _, masks, _ = self.scene.objects(self.i)
+        self.i += 1
+        return masks, list(range(len(masks)))
+
+    def detect(self, image):
+        H, W = image.shape[:2]
+        masks, ks = self.color_masks(image) if self.colors is not None else self.random_masks(image)
+        masks = torch.as_tensor(np.array(masks, dtype=bool).reshape(-1, H, W))
+        scores = torch.full((len(ks),), float(self.score))
+        return Instances(
+            (H, W),
+            pred_boxes=Boxes(masks_to_boxes(masks) if len(masks) else torch.zeros((0, 4))),
+            pred_masks=masks,
+            scores=scores,
+            pred_scores=scores.clone(),
+            pred_classes=torch.as_tensor(ks, dtype=torch.long),
+            pred_labels=np.array([object_label(k, self.labels) for k in ks], dtype=object),
+        )
+
+
+class StubDeticQuery:
+    def __init__(self, model, image):
+        self.model = model
+        self.image = image
+
+    def detect(self, classifier=None, conf_threshold=None, labels=None, roi_heads=None, **kw):
+        return {'instances': self.model.detect(self.image)}
+
+
+class StubEgoHos(torch.nn.Module):
+    '''One left hand, in the bottom left corner.'''
+    CLASSES = EGOHOS_CLASSES
+
+    def __init__(self, mode='obj1', device=None, **kw):
+        super().__init__()
+
+    def forward(self, image):
+        H, W = image.shape[:2]
+        mask = np.zeros((H, W), np.uint8)
+        cv2.ellipse(mask, (W // 8, H), (W // 12, H // 8), 0, 0, 360, 1, -1)
+        return torch.as_tensor(mask.astype(bool))[None], np.array([1])
+
+
+class StubXMem(torch.nn.Module):
+    '''Keep each track's last detected mask. Detections are matched to the tracks by mask IoU.
+
+    Arguments:
+        config (dict): XMem's config. ``min_iou`` and ``max_age`` (frames without a match) are used.
+        Track (type): The track class (``core.CustomTrack``).
+    '''
+    def __init__(self, config=None, Track=None, **kw):
+        super().__init__()
+        config = dict(config or {})
+        self.min_iou = config.get('min_iou') or 0.3
+        self.max_age = config.get('max_age') or 60
+        self.Track = Track
+        self.tracks = {}
+        self.masks = {}
+        self.last_seen = {}
+        self.next_id = 1
+        self.t = 0
+
+    def clear_memory(self, reset_index=False):
+        self.tracks.clear()
+        self.masks.clear()
+        self.last_seen.clear()
+        if reset_index:
+            self.next_id = 1
+
+    def _new_track(self, tid):
+        return self.Track(tid, self.t) if self.Track is not None else SimpleNamespace(track_id=tid)
+
+    def forward(self, image, mask=None, negative_mask=None, mask_scores=None, tracked_labels=None, only_confirmed=False, **kw):
+        H, W = image.shape[:2]
+        self.t += 1
+        if any(m.shape != (H, W) for m in self.masks.values()):  # the frame size changed
+            self.clear_memory()
+
+        input_track_ids = None
+        if mask is not None:
+            mask = mask.bool().cpu()
+            ids = list(self.masks)
+            input_track_ids = [-1] * len(mask)
+            if ids and len(mask):
+                iou = mask_iou(mask, torch.stack([self.masks[i] for i in ids])).numpy()
+                for r, c in zip(*linear_sum_assignment(-iou)):
+                    if iou[r, c] >= self.min_iou:
+                        input_track_ids[r] = ids[c]
+            for r, tid in enumerate(input_track_ids):
+                if tid < 0:
+                    tid = input_track_ids[r] = self.next_id
+                    self.next_id += 1
+                    self.tracks[tid] = self._new_track(tid)
+                self.masks[tid] = mask[r]
+                self.last_seen[tid] = self.t
+
+        for tid in [i for i, t in self.last_seen.items() if self.t - t > self.max_age]:
+            del self.tracks[tid], self.masks[tid], self.last_seen[tid]
+
+        track_ids = list(self.masks)
+        pred_mask = torch.stack([self.masks[i] for i in track_ids]) if track_ids else torch.zeros((0, H, W), dtype=torch.bool)
+        return pred_mask, track_ids, input_track_ids
+
+
+class StubClip(torch.nn.Module):
+    '''Embed a crop (from ``stub_clip_preprocess``) with a fixed linear projection of its color.'''
+    def __init__(self, dim=512, seed=0):
+        super().__init__()
+        g = torch.Generator().manual_seed(seed)
+        self.register_buffer('proj', torch.randn(3, dim, generator=g))
+        self.visual = torch.nn.Identity()
+
+    def encode_image(self, x):
+        return x.float().reshape(len(x), 3) @ self.proj
+
+
+def stub_clip_preprocess(image):
+    '''A PIL crop -> the mean RGB color (in [0, 1]) of its center half.'''
+    x = np.asarray(image, dtype=np.float32)
+    h, w = x.shape[:2]
+    x = x[h // 4:max(3 * h // 4, h // 4 + 1), w // 4:max(3 * w // 4, w // 4 + 1)]
+    return torch.as_tensor(x.reshape(-1, 3).mean(0) / 255)
+
+
+def stub_clip_load(name=None, device='cpu', **kw):
+    return StubClip().to(device), stub_clip_preprocess
+
+
+def stub_load_classifier(*a, **kw):
+    return None, SimpleNamespace(thing_classes=[]), None
+
+
+# ---------------------------------------------------------------------------- #
+#                                     Setup                                    #
+# ---------------------------------------------------------------------------- #
+
+
+@contextlib.contextmanager
+def stub_models(colors=None, labels=STUB_LABELS, **detic_kw):
+    '''Construct Perception / ObjectDetector with stub models inside this context.
+
+    Arguments:
+        colors (np.ndarray): The scene's object colors. None to detect ``n_objects`` made up objects instead.
+        **detic_kw: Passed to ``StubDetic`` (e.g. ``n_objects``, ``tolerance``).
+    '''
+    from ..inference import core
+    with mock.patch.object(core, 'Detic', lambda *a, **kw: StubDetic(colors, labels, **detic_kw)), \
+         mock.patch.object(core, 'XMem', StubXMem), \
+         mock.patch.object(core, 'load_classifier', stub_load_classifier), \
+         mock.patch.object(core, 'clip', SimpleNamespace(load=stub_clip_load)), \
+         mock.patch.dict(sys.modules, {'egohos': SimpleNamespace(EgoHos=StubEgoHos)}):
+        yield
+
+
+def stub_state_db(path, colors, labels=STUB_LABELS, n=11, noise=0.02, seed=0):
+    '''Create a lancedb state index for ``StubClip``: each object's label table has ``n`` noisy embeddings of its color.'''
+    import lancedb
+    import pandas as pd
+    clip = StubClip()
+    rng = np.random.default_rng(seed)
+    rows = {}
+    for k, c in enumerate(np.asarray(colors).reshape(-1, 3)):
+        rgb = c[::-1] / 255 + rng.normal(0, noise, (n, 3))
+        z = clip.encode_image(torch.as_tensor(rgb, dtype=torch.float32)).numpy()
+        rows.setdefault(object_label(k, labels), []).extend({'vector': v, 'state': object_state(k)} for v in z)
+    db = lancedb.connect(path)
+    for label, r in rows.items():
+        db.create_table(label, data=pd.DataFrame(r), mode='overwrite')
+    return path
@@ -22,6 +22,7 @@ from IPython import embed
 
 import torch
 import clip
+from .util.precision import load_clip, encode_image
 
 from PIL import Image
 
@@ -31,7 +32,7 @@ device = "cuda"
 import ipdb
 @ipdb.iex
 @torch.no_grad()
-def main(config_fname, fields=['ground_truth_tracker', 'detections_tracker'], file_path=None):
+def main(config_fname, fields=['ground_truth_tracker', 'detections_tracker'], file_path=None, precision='fp32', device=device):
     cfg = get_cfg(config_fname)
 
     dataset_dir = cfg.DATASET.ROOT
@@ -41,7 +42,7 @@ def main(config_fname, fields=['ground_truth_tracker', 'detections_tracker'], fi
     # -------------------------------- Load models ------------------------------- #
 
     # detic = Detic(['cat'])
-    model, preprocess = clip.load("ViT-B/32", device=device)
+    model, preprocess = load_clip("ViT-B/32", device=device, precision=precision)
     
     # ------------------------------- Load dataset ------------------------------- #
 
@@ -130,7 +131,7 @@ def main(config_fname, fields=['ground_truth_tracker', 'detections_tracker'], fi
                 ims = [crop] + aug_crops
                 
                 x = torch.stack([preprocess(im) for im in ims]).to(device)
-                z = model.encode_image(x).cpu().numpy()
+                z = encode_image(model, x, precision).cpu().numpy()
 
                 embeddings[track_id]['clip']['z'].extend(z)
                 embeddings[track_id]['clip']['frame_index'].extend([i]*len(z))
@@ -19,6 +19,8 @@ from IPython import embed
 
 import torch
 import clip
+from .util.precision import load_clip, encode_image
+from .util.detic_features import detic_stage_features, select_stage_features, is_detic_type
 
 from PIL import Image
 
@@ -28,7 +30,7 @@ device = "cuda"
 import ipdb
 @ipdb.iex
 @torch.no_grad()
-def main(config_fname, match=None, embeddings_dir='embeddings', debug=False):
+def main(config_fname, match=None, embeddings_dir='embeddings', debug=False, precision='fp32', device=device, emb_types=('clip',), detic_config_key=None):
     cfg = get_cfg(config_fname)
 
     dataset_dir = cfg.DATASET.ROOT
@@ -37,7 +39,15 @@ def main(config_fname, match=None, embeddings_dir='embeddings', debug=False):
 
     # -------------------------------- Load models ------------------------------- #
     
-    model, preprocess = clip.load("ViT-B/32", device=device)
+    emb_types = [emb_types] if isinstance(emb_types, str) else list(emb_types)
+    detic_types = [t for t in emb_types if is_detic_type(t)]
+    if 'clip' in emb_types:
+        model, preprocess = load_clip("ViT-B/32", device=device, precision=precision)
+    if detic_types:
+        from detic import Detic
+        from detic.inference import load_classifier
+        detic = Detic([], config=detic_config_key, masks=True, device=device).eval().to(device)
+        detic_clsf, _, _ = load_classifier(['object'], metadata_name='lvis+', device=device)
     
     # ------------------------------- Load dataset ------------------------------- #
 
@@ -115,32 +125,51 @@ def main(config_fname, match=None, embeddings_dir='embeddings', debug=False):
 
             pbar.set_description(f'{len(detections)} {labels}')
 
+            # the same objects for every embedding type, so they can be compared (eval.compare_embedding_types)
+            rgb = frame[:,:,::-1]
+            keep = np.array([
+                'microwave' not in label and crop_box(rgb, xyxy).size > 0
+                for xyxy, label in zip(detections.xyxy, labels)], dtype=bool)
+            if not keep.any():
+                continue
+            detections, labels = detections[keep], np.asarray(labels)[keep]
+
             # ---------------------------- Get clip embeddings --------------------------- #
 
-            for (xyxy, _, conf, _, track_id), label in zip(detections, labels):
-                if 'microwave' in label: continue
-                rgb = frame[:,:,::-1]
-                crop: np.ndarray = crop_box(rgb, xyxy)
-                if debug:
-                    Image.fromarray(crop).save('debug.png')
-                    input()
-                    continue
-                if not crop.size:
-                    continue
-                crop = Image.fromarray(crop)
-                aug_crop = Image.fromarray(crop_box(rgb, xyxy, padding=30))
-                aug_crops = [aug_crop] + [
-                    image_augmentation(aug_crop)
-                    for i in range(n_augs)
-                ]
-                ims = [crop] + aug_crops
-                
-                x = torch.stack([preprocess(im) for im in ims]).to(device)
-                z = model.encode_image(x).cpu().numpy()
-
-                embeddings[track_id]['clip']['z'].extend(z)
-                embeddings[track_id]['clip']['frame_index'].extend([i]*len(z))
-                embeddings[track_id]['clip']['augmented'].extend([False] + [True]*len(aug_crops))
+            if 'clip' in emb_types:
+                for (xyxy, _, conf, _, track_id), label in zip(detections, labels):
+                    crop: np.ndarray = crop_box(rgb, xyxy)
+                    if debug:
+                        Image.fromarray(crop).save('debug.png')
+                        input()
+                        continue
+                    crop = Image.fromarray(crop)
+                    aug_crop = Image.fromarray(crop_box(rgb, xyxy, padding=30))
+                    aug_crops = [aug_crop] + [
+                        image_augmentation(aug_crop)
+                        for i in range(n_augs)
+                    ]
+                    ims = [crop] + aug_crops
+                    
+                    x = torch.stack([preprocess(im) for im in ims]).to(device)
+                    z = encode_image(model, x, precision).cpu().numpy()
+
+                    embeddings[track_id]['clip']['z'].extend(z)
+                    embeddings[track_id]['clip']['frame_index'].extend([i]*len(z))
+                    embeddings[track_id]['clip']['augmented'].extend([False] + [True]*len(aug_crops))
+
+            # --------------------------- Get Detic embeddings --------------------------- #
+            # the same roi features that ObjectDetector(state_features='detic') uses at inference
+
+            if detic_types:
+                query = detic.build_query(frame)
+                z_detic = detic_stage_features(
+                    query, torch.as_tensor(detections.xyxy, device=device), detic_clsf).cpu().numpy()  # n, 3, 512
+                for kind in detic_types:
+                    for track_id, z in zip(detections.tracker_id, select_stage_features(z_detic, kind)):
+                        embeddings[track_id][kind]['z'].append(z)
+                        embeddings[track_id][kind]['frame_index'].append(i)
+                        embeddings[track_id][kind]['augmented'].append(False)
 
         # ------------------------- Write embeddings to file ------------------------- #
 
@@ -23,6 +23,7 @@ from sklearn.manifold import TSNE, Isomap
 
 from .config import get_cfg
 from .util.step_annotations import load_object_annotations, get_obj_anns
+from .util.state_clsf import export_bundle
 
 from IPython import embed
 
@@ -162,6 +163,8 @@ def load_data_from_db(cfg, state_col, emb_type='clip'):
     import lancedb
     dfs = []
     fs = cfg.EVAL.EMBEDDING_DBS
+    # either {emb_type: [dbs]} or a list of clip dbs
+    fs = fs.get(emb_type) if isinstance(fs, dict) else fs if emb_type == 'clip' else None
     f = os.path.join(cfg.DATASET.ROOT, f'{emb_type}.lancedb')
     if not fs and os.path.isfile(f):
         fs = [f]
@@ -240,6 +243,11 @@ def train_eval(run_name, model, X, y, i_train, i_test, video_ids, plot_dir='plot
     # Save the entire pipeline
     with open(os.path.join(plot_dir, f'{run_name}_pipeline.pkl'), 'wb') as f:
         joblib.dump(pipeline, f)
+    # and as a numpy bundle for inference (if it's a model type we can export)
+    try:
+        export_bundle(pipeline, os.path.join(plot_dir, f'{run_name}_bundle'))
+    except TypeError as e:
+        tqdm.tqdm.write(f'Not exporting bundle for {run_name}: {e}')
 
     # ------------------------------- Visualization ------------------------------ #
 
@@ -488,7 +496,7 @@ def exponentially_decaying_average(a, decay_rate):
 
 def get_data(cfg, STATE, full_split, emb_type='clip'):
     emb_dirs = cfg.EVAL.EMBEDDING_DIRS or [os.path.join(cfg.DATASET.ROOT, 'embeddings-all', cfg.EVAL.DETECTION_NAME)]
-    ydf = load_data_from_db(cfg, state_col='mod_state')
+    ydf = load_data_from_db(cfg, state_col='mod_state', emb_type=emb_type)
     db_train_split = ydf.video_id.unique().tolist()
     ydf = pd.concat([
         *[
@@ -619,9 +627,9 @@ def run(config_name):
 
     models = get_models(cfg)
 
-    cfg.EVAL.EMBEDDING_TYPES=['clip']
-    for emb_type in tqdm.tqdm(cfg.EVAL.EMBEDDING_TYPES, desc='embedding type'):
-        ydf, db_train_split = get_data(cfg, STATE, full_split)
+    emb_types = cfg.EVAL.EMBEDDING_TYPES or ['clip']
+    for emb_type in tqdm.tqdm(emb_types, desc='embedding type'):
+        ydf, db_train_split = get_data(cfg, STATE, full_split, emb_type)
         emb_plot(f'{root_plot_dir}/{emb_type}', np.array(list(ydf['vector'].values)), ydf['object'].values, 'object')
         # emb_plot(f'{root_plot_dir}/{emb_type}', np.array(list(ydf['vector'].values)), ydf[STATE].values, 'states')
 
@@ -675,6 +683,35 @@ def run(config_name):
                     cross_model_metrics(plot_dir, all_metrics_df, f'{emb_type}_')
                     # n_videos_class_metrics(plot_dir, all_per_class_metrics_df, f'{emb_type}_')
 
+    if len(emb_types) > 1:
+        compare_embedding_types(root_plot_dir)
+
+
+def compare_embedding_types(root_plot_dir):
+    '''Compare state accuracy between embedding types (e.g. clip crops vs detic roi features).
+
+    Writes ``{root_plot_dir}/embedding_types.csv`` with the best unsmoothed model
+    for each validation split, object, and embedding type.
+    '''
+    dfs = []
+    for f in glob.glob(f'{root_plot_dir}/*/*/*/metrics.csv'):
+        val_split_name, emb_type, object_name = f.split(os.sep)[-4:-1]
+        df = pd.read_csv(f, index_col=0)
+        if 'smoothing' in df.columns:
+            df = df[pd.isna(df.smoothing)]
+        df['val_split'] = val_split_name
+        df['emb_type'] = emb_type
+        df['object'] = object_name
+        dfs.append(df)
+    if not dfs:
+        return
+    df = pd.concat(dfs)
+    df = df.sort_values('f1', ascending=False).groupby(['val_split', 'object', 'emb_type']).head(1)
+    df = df[['val_split', 'object', 'emb_type', 'model_name', 'accuracy', 'f1']].sort_values(['val_split', 'object', 'emb_type'])
+    print(df.to_string())
+    df.to_csv(f'{root_plot_dir}/embedding_types.csv', index=False)
+    return df
+
 
 def show_counts(y):
     yu, counts = np.unique(y, return_counts=True)
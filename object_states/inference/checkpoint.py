@@ -0,0 +1,141 @@
+'''Checkpoints for resuming ``run_one`` on long videos.
+
+A checkpoint records the last frame processed, how much of each output was on disk
+at that point, and the track table (last box, label counts, and state of each track).
+
+XMem's memory isn't saved. Instead, we restart tracking from the next frame (which is
+a detection frame after ``clear_memory``) and ``TrackRemapper`` matches the new tracks
+to the checkpoint's tracks by box IoU so the track IDs carry on where they left off.
+``Perception`` does the same when the governor changes the tracking width mid-video.
+'''
+import os
+import logging
+import orjson
+import numpy as np
+import pandas as pd
+import torch
+
+from ..util.boxes import box_iou
+
+log = logging.getLogger(__name__)
+
+
+class Checkpoint:
+    def __init__(self, fname):
+        self.fname = fname
+
+    def load(self):
+        if not os.path.isfile(self.fname):
+            return None
+        with open(self.fname, 'rb') as f:
+            return orjson.loads(f.read())
+
+    def save(self, **state):
+        os.makedirs(os.path.dirname(self.fname) or '.', exist_ok=True)
+        # write-then-rename so a checkpoint is never half written
+        with open(f'{self.fname}.tmp', 'wb') as f:
+            f.write(orjson.dumps(state, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS))
+        os.replace(f'{self.fname}.tmp', self.fname)
+        log.info('saved checkpoint at frame %s: %s', state.get('frame_index'), self.fname)
+
+    def remove(self):
+        if os.path.isfile(self.fname):
+            os.remove(self.fname)
+
+
+class TrackRemapper:
+    '''Map XMem's track IDs to the track IDs we write out.
+
+    Without a checkpoint this is the identity. After resuming, XMem's IDs start over, so
+    each new track is matched (greedily, by box IoU) to an unclaimed track from the
+    checkpoint and takes its ID, label counts, and state. Anything unmatched gets a new ID.
+    Checkpoint tracks can only be matched for ``max_age`` seconds after the first frame (so a
+    track that never comes back can't hand its ID to some new object later on).
+
+    Arguments:
+        tracks (dict): The checkpoint's track table ``{track_id: {xyxy, label, label_count, state}}``.
+        next_id (int): The next unused track ID.
+        min_iou (float): The minimum box IoU to match a new track to a checkpoint track.
+        max_age (float): How long (seconds) after the first frame checkpoint tracks can be matched.
+            None to only match on the first frame (or without timestamps).
+    '''
+    def __init__(self, tracks=None, next_id=None, min_iou=0.3, max_age=None):
+        self.identity = not tracks and next_id is None
+        self.prev = {int(k): v for k, v in (tracks or {}).items()}
+        self.next_id = next_id if next_id is not None else max(self.prev, default=-1) + 1
+        self.min_iou = min_iou
+        self.max_age = max_age
+        self.start = None
+        self.ids = {}
+        self.tracks = {}
+
+    def __call__(self, detections, xmem_tracks=None, timestamp=None):
+        '''Rewrite ``detections.track_ids`` in place and update the track table.'''
+        if not detections.has('track_ids'):
+            return detections
+        track_ids = detections.track_ids.cpu().numpy()
+        boxes = detections.pred_boxes.tensor.cpu().numpy()
+        if not self.identity:
+            self._match(track_ids, boxes, xmem_tracks)
+            self._expire(timestamp)
+            detections.track_ids = torch.as_tensor([self.ids[t] for t in track_ids], dtype=torch.long)
+
+        # the track table for the next checkpoint
+        labels = detections.pred_labels
+        self.tracks = {}
+        for t, out_id, xyxy, label in zip(track_ids, detections.track_ids.tolist(), boxes, labels):
+            track = (xmem_tracks or {}).get(t)
+            self.tracks[out_id] = {
+                'xyxy': xyxy.tolist(),
+                'label': label,
+                'label_count': dict(track.label_count) if track is not None else {},
+                'state': getattr(track, 'last_state', None) or {},
+            }
+            self.next_id = max(self.next_id, out_id + 1)
+        return detections
+
+    def _match(self, track_ids, boxes, xmem_tracks=None):
+        new = [i for i, t in enumerate(track_ids) if t not in self.ids]
+        if not new:
+            return
+        prev_ids = list(self.prev)
+        if prev_ids:
+            iou = box_iou(boxes[new], [self.prev[k]['xyxy'] for k in prev_ids])
+            for flat in np.argsort(-iou, axis=None):
+                i, j = np.unravel_index(flat, iou.shape)
+                if iou[i, j] < self.min_iou:
+                    break
+                t = track_ids[new[i]]
+                if t in self.ids or prev_ids[j] not in self.prev:
+                    continue
+                self.ids[t] = prev_ids[j]
+                self._restore(xmem_tracks, t, self.prev.pop(prev_ids[j]))
+                log.info('resumed track %s as %s (iou=%.2f)', t, prev_ids[j], iou[i, j])
+        for i in new:
+            t = track_ids[i]
+            if t not in self.ids:
+                self.ids[t] = self.next_id
+                self.next_id += 1
+
+    def _expire(self, timestamp):
+        '''Forget the unmatched checkpoint tracks once ``max_age`` has passed.'''
+        if not self.prev:
+            return
+        if self.start is None:
+            self.start = timestamp
+        if timestamp is None or self.start is None or timestamp - self.start >= (self.max_age or 0):
+            log.info('dropping %d unmatched tracks: %s', len(self.prev), list(self.prev))
+            self.prev.clear()
+
+    def _restore(self, xmem_tracks, t, prev):
+        track = (xmem_tracks or {}).get(t)
+        if track is None:
+            return
+        track.label_count.update(prev.get('label_count') or {})
+        if prev.get('state'):
+            track.last_state = prev['state']
+            track.obj_state_dist = pd.Series(prev['state'], dtype=float)
+            track.obj_state_dist_label = prev.get('label')
+
+    def state(self):
+        return {'tracks': self.tracks, 'next_track_id': self.next_id}
@@ -4,6 +4,8 @@
 import logging
 from collections import Counter, defaultdict, deque
 import pickle
+import time
+import contextlib
 
 import os
 import glob
@@ -25,7 +27,17 @@ from torchvision import transforms
 
 from ..util.nms import asymmetric_nms, mask_iou
 from ..util.vocab import prepare_vocab
+from ..util.precision import set_precision, encode_image
+from ..util.state_clsf import compile_state_classifier, load_bundle, BUNDLE_META
+from ..util.detic_features import detic_box_features, is_detic_type
+from ..util import trace
+from ..util.stage_cache import StageCache, config_hash, get_instances, put_instances
+from ..util.serialize import serialize_instances
+from .governor import Governor
+from .metrics import Metrics, NoMetrics
 from .download import ensure_db
+from .cpu import CpuProfile
+from .checkpoint import TrackRemapper
 
 from IPython import embed
 
@@ -35,6 +47,8 @@ log = logging.getLogger(__name__)
 
 IMAGENET_DEFAULT_MEAN = (0.485, 0.456, 0.406)
 IMAGENET_DEFAULT_STD = (0.229, 0.224, 0.225)
+# Perception's default detic_feature_max_age, in detection intervals
+DETIC_FEATURE_MAX_AGE = 2
 
 
 class CustomTrack(XMem.Track):
@@ -49,6 +63,8 @@ class CustomTrack(XMem.Track):
         self.obj_state_dist = pd.Series(dtype=float)
         self.obj_state_dist_label = None
         self.z_clips = {}
+        self.last_state = None
+        self.state_timestamp = -1e30
 
     @property
     def pred_label(self):
@@ -109,6 +125,7 @@ class ObjectDetector:
         vocabulary, 
         state_db_fname=None, 
         custom_state_clsf_fname=None,
+        compile_state_clsfs=False,
         xmem_config={}, 
         conf_threshold=0.3, 
         detect_hoi=None,
@@ -116,15 +133,23 @@ class ObjectDetector:
         detic_config_key=None,
         additional_roi_heads=None,
         filter_tracked_detections_from_frame=True,
-        device='cuda', detic_device=None, egohos_device=None, xmem_device=None, clip_device=None
+        device=None, detic_device=None, egohos_device=None, xmem_device=None, clip_device=None,
+        cpu_profile=None, clip_precision='fp32',
+        state_features='clip', detic_feature_max_age=None, state_budget=None, stage_cache=None,
     ):
+        # thread/layout/compilation settings for running on CPU
+        self.cpu_profile = CpuProfile.from_config(cpu_profile).apply()
+        # set by Perception (for the state index query latency)
+        self.metrics = NoMetrics()
+
         # initialize models
-        self.device = device
+        self.device = device = device or ('cpu' if self.cpu_profile.enabled else 'cuda')
         self.detic_device = detic_device or device
         self.egohos_device = egohos_device or device
         self.xmem_device = xmem_device or device
         self.clip_device = clip_device or device
         self.detic = Detic([], config=detic_config_key, masks=True, one_class_per_proposal=3, conf_threshold=conf_threshold, device=self.detic_device).eval().to(self.detic_device)
+        self.detic = self.cpu_profile.prepare('detic', self.detic)
 
         self.conf_threshold = conf_threshold
         self.filter_tracked_detections_from_frame = filter_tracked_detections_from_frame
@@ -136,6 +161,7 @@ class ObjectDetector:
             try:
                 from egohos import EgoHos
                 self.egohos = EgoHos('obj1', device=self.egohos_device).eval()
+                self.egohos = self.cpu_profile.prepare('egohos', self.egohos)
             except ImportError as e:
                 print('Could not import EgoHOS:', e)
                 if detect_hoi is True:
@@ -203,18 +229,42 @@ class ObjectDetector:
         self.skill_clsf, _, _ = load_classifier(full_prompts, metadata_name='lvis+', device=self.detic_device)
         self.skill_labels = np.asarray(full_vocab)
         self.skill_labels_is_tracked = np.isin(self.skill_labels, self.tracked_vocabulary)
+
+        # reuse detic/egohos outputs from earlier runs on the same video (e.g. tracking sweeps)
+        self.stage_cache = StageCache.from_config(stage_cache)
+        self.cache_identity = {
+            'detic': {
+                'model': 'detic', 'config': detic_config_key, 'conf_threshold': conf_threshold,
+                'roi_heads': [h if isinstance(h, str) else type(h).__name__ for h in additional_roi_heads or []],
+                'vocab': config_hash(full_prompts, full_vocab, self.tracked_vocabulary.tolist()),
+            },
+            'egohos': {'model': 'egohos', 'mode': 'obj1'},
+        }
         self.state_ema = 0.25
 
 
         self.state_clsf_type = None
+        self.clip_precision = clip_precision or 'fp32'
+        # which box embedding the state classifiers expect: clip crops or detic roi features
+        self.state_features = state_features or 'clip'
+        assert self.state_features == 'clip' or is_detic_type(self.state_features), f"Unknown state features: {state_features}"
+        self.detic_feature_max_age = detic_feature_max_age
+        self.detic_feature_query = None
+        # the tracks xmem returned last frame (only_confirmed=True), the rest are tentative
+        self.confirmed_track_ids = []
+        # the max number of boxes to classify per frame (the rest keep their last state)
+        self.state_budget = state_budget
         self.state_db_key = state_key
         self.obj_label_names = []
         self.sklearn_state_clsfs = {}
         if state_db_fname:
             if state_db_fname.endswith(".lancedb"):
                 self.state_clsf_type = 'lancedb'
-                # image encoder
-                self.clip, self.clip_pre = clip.load("ViT-B/32", device=self.clip_device)
+                # image encoder (not needed if we're using detic's features)
+                if self.state_features == 'clip':
+                    self.clip, self.clip_pre = clip.load("ViT-B/32", device=self.clip_device)
+                    self.clip = set_precision(self.clip, clip_precision, self.clip_device)
+                    self.clip = self.cpu_profile.prepare_clip(self.clip)
 
                 state_db_fname = ensure_db(state_db_fname)
                 print("Using state db:", state_db_fname)
@@ -230,11 +280,22 @@ class ObjectDetector:
                 #     tbl.create_index(num_partitions=256, num_sub_vectors=96)
 
         if custom_state_clsf_fname:
-            import joblib
+            # numpy bundles (see util/state_clsf.py) - memory-mapped, no pickle/sklearn needed
+            for f in sorted(glob.glob(os.path.join(custom_state_clsf_fname, '*', BUNDLE_META))):
+                cname = os.path.basename(os.path.dirname(f))
+                c = load_bundle(os.path.dirname(f))
+                print('using state bundle:', cname, os.path.dirname(f), c)
+                self.sklearn_state_clsfs[cname] = c
+
             for f in glob.glob(os.path.join(custom_state_clsf_fname, '*.joblib')):
                 cname = os.path.splitext(os.path.basename(f))[0]
+                if cname in self.sklearn_state_clsfs:
+                    continue  # prefer the bundle
+                import joblib
                 print('using sklearn model:', cname, f)
                 c = joblib.load(f)
+                if compile_state_clsfs:
+                    c = compile_state_classifier(c)
                 c.labels = np.array([l.strip() for l in open(os.path.join(custom_state_clsf_fname, f'{cname}.txt')).readlines() if l.strip()])
                 self.sklearn_state_clsfs[cname] = c
                 print(c)
@@ -263,26 +324,38 @@ class ObjectDetector:
 
     def clear_memory(self):
         self.xmem.clear_memory()
+        self.detic_feature_query = None
+        self.confirmed_track_ids = []
 
-    def predict_objects(self, image):
+    def predict_objects(self, image, frame_index=None):
         # ----------------------------- Object Detection ----------------------------- #
 
+        # the cache doesn't have detic's features, so it can't be used if the states need them
+        use_cache = frame_index is not None and not is_detic_type(self.state_features)
+        identity = {**self.cache_identity['detic'], 'shape': image.shape}
+        instances = get_instances(self.stage_cache, 'detic', identity, frame_index if use_cache else None, self.detic_device)
+        if instances is not None:
+            return instances, None
+
         # predict objects
-        detic_query = self.detic.build_query(image)
-        outputs = detic_query.detect(self.skill_clsf, conf_threshold=0.3, labels=self.skill_labels)
-        instances = outputs['instances']
-        if self.additional_roi_heads:
-            instances = instances[np.isin(instances.pred_labels, self.base_labels)]
+        with self.cpu_profile.component('detic'):
+            detic_query = self.detic.build_query(image)
+            outputs = detic_query.detect(self.skill_clsf, conf_threshold=0.3, labels=self.skill_labels)
+            instances = outputs['instances']
             instances_list = [
                 detic_query.detect(self.skill_clsf, roi_heads=h, labels=self.skill_labels)['instances']
                 for h in self.additional_roi_heads
             ]
+        if self.additional_roi_heads:
+            instances = instances[np.isin(instances.pred_labels, self.base_labels)]
             instances_list = [
                 h[np.isin(h.pred_labels, ls)]
                 for h, ls in zip(instances_list, self.additional_roi_heads_labels)
             ]
             instances = self._cat_instances(instances, instances_list)
         instances = self._filter_detections(instances)
+        if use_cache:
+            put_instances(self.stage_cache, 'detic', identity, frame_index, instances)
         return instances, detic_query
     
     def _cat_instances(self, instances, instances_list):
@@ -337,24 +410,29 @@ class ObjectDetector:
         # log.info("filtered detections %s", len(filtered_instances))
         return filtered_instances
 
-    def predict_hoi(self, image):
+    def predict_hoi(self, image, frame_index=None):
         if self.egohos is None:
             return None, None
         # -------------------------- Hand-Object Interaction ------------------------- #
 
-        # predict HOI
-        hoi_masks, hoi_class_ids = self.egohos(image)
-        keep = hoi_masks.sum(1).sum(1) > 4
-        hoi_masks = hoi_masks[keep]
-        hoi_class_ids = hoi_class_ids[keep.cpu().numpy()]
-        # create detectron2 instances
-        instances = Instances(
-            image.shape,
-            pred_masks=hoi_masks,
-            pred_boxes=Boxes(masks_to_boxes(hoi_masks)),
-            pred_hoi_classes=hoi_class_ids)
+        identity = {**self.cache_identity['egohos'], 'shape': image.shape}
+        instances = get_instances(self.stage_cache, 'egohos', identity, frame_index, self.egohos_device)
+        if instances is None:
+            # predict HOI
+            with self.cpu_profile.component('egohos'):
+                hoi_masks, hoi_class_ids = self.egohos(image)
+            keep = hoi_masks.sum(1).sum(1) > 4
+            hoi_masks = hoi_masks[keep]
+            hoi_class_ids = hoi_class_ids[keep.cpu().numpy()]
+            # create detectron2 instances
+            instances = Instances(
+                image.shape,
+                pred_masks=hoi_masks,
+                pred_boxes=Boxes(masks_to_boxes(hoi_masks)),
+                pred_hoi_classes=hoi_class_ids)
+            put_instances(self.stage_cache, 'egohos', identity, frame_index, instances)
         # get a mask of the hands
-        hand_mask = hoi_masks[self.egohos_type[hoi_class_ids] == 'hand'].sum(0)
+        hand_mask = instances.pred_masks[self.egohos_type[instances.pred_hoi_classes] == 'hand'].sum(0)
         return instances, hand_mask
 
     def merge_hoi(self, other_detections, hoi_detections, detic_query):
@@ -440,13 +518,15 @@ class ObjectDetector:
             negative_mask = negative_mask.to(self.xmem_device)
 
         # run xmem
-        pred_mask, track_ids, input_track_ids = self.xmem(
-            image, det_mask, 
-            negative_mask=negative_mask, 
-            mask_scores=det_scores,
-            tracked_labels=self.skill_labels_is_tracked,
-            only_confirmed=True
-        )
+        with self.cpu_profile.component('xmem'):
+            pred_mask, track_ids, input_track_ids = self.xmem(
+                image, det_mask, 
+                negative_mask=negative_mask, 
+                mask_scores=det_scores,
+                tracked_labels=self.skill_labels_is_tracked,
+                only_confirmed=True
+            )
+        self.confirmed_track_ids = track_ids
         # update label counts
         tracks = self.xmem.tracks
         if input_track_ids is not None and detections is not None:
@@ -471,55 +551,87 @@ class ObjectDetector:
             frame_detections = detections[~np.isin(detections.pred_labels, self.tracked_vocabulary)]
         return instances, frame_detections
 
-    def predict_state(self, image, detections, det_shape=None):
-        states = []
+    def predict_state(self, image, detections, det_shape=None, detic_query=None, timestamp=None):
+        states = [{} for _ in range(len(detections))]
+        if detic_query is not None:
+            # keep the detection frame's backbone features around for the tracking frames
+            self.detic_feature_query = (detic_query, timestamp)
 
         labels = detections.pred_labels
         has_state = np.isin(labels, self.obj_label_names)
         track_ids = detections.track_ids.cpu().numpy() if detections.has('track_ids') else None
         dets = detections[has_state]
-        i_z = {k: i for i, k in enumerate(np.where(has_state)[0])}
-        Z_imgs = self._encode_boxes(image, dets.pred_boxes.tensor, det_shape=det_shape) if len(dets) else None
-        for i in range(len(detections)):
-            pred_label = labels[i]
-            state = {}
+        i_z = np.where(has_state)[0]
+        if self.state_budget is not None and len(i_z) > self.state_budget:
+            # classify the tracks that have gone the longest without a state update
+            last = np.array([
+                self.xmem.tracks[track_ids[i]].state_timestamp if track_ids is not None and track_ids[i] in self.xmem.tracks else -np.inf
+                for i in i_z])
+            keep = np.sort(np.argsort(last, kind='stable')[:self.state_budget])
+            for i in np.delete(i_z, keep):
+                if track_ids is not None and track_ids[i] in self.xmem.tracks:
+                    states[i] = self.xmem.tracks[track_ids[i]].last_state or {}
+            i_z = i_z[keep]
+            dets = detections[i_z]
+        Z_imgs = None
+        if len(dets):
+            with trace.span('encode', n=len(dets)):
+                Z_imgs = self._encode_boxes(image, dets.pred_boxes.tensor, det_shape=det_shape, timestamp=timestamp)
+        if Z_imgs is None:
+            # no features this frame (e.g. the detic features are too old) - keep the last state of each track
+            for i in i_z:
+                if track_ids is not None and track_ids[i] in self.xmem.tracks:
+                    states[i] = self.xmem.tracks[track_ids[i]].last_state or {}
+            detections.pred_states = np.array(states)
+            return detections
+        Z_imgs = Z_imgs.cpu().numpy()
+
+        # classify all of the detections with the same label at once
+        with trace.span('state_lookup', n=len(i_z)):
+            for pred_label in np.unique(labels[i_z]):
+                same = labels[i_z] == pred_label
+                idxs, Z = i_z[same], Z_imgs[same]
 
-            if has_state[i]:
                 if pred_label in self.sklearn_state_clsfs:
-                    z = Z_imgs[i_z[i]].cpu().numpy()
                     c = self.sklearn_state_clsfs[pred_label]
-                    y = c.predict_proba(z[None])[0]
-                    state = {
-                        c: x for c, x in zip(c.labels.tolist(), y.tolist())
-                    }
-                    # print(pred_label)
-                    # print(sorted(state.items(), key=lambda x: x[1])[-3:])
-                    # input()
+                    Y = c.predict_proba(Z)
+                    for i, y in zip(idxs, Y.tolist()):
+                        states[i] = dict(zip(c.labels.tolist(), y))
 
                 elif self.state_clsf_type == 'lancedb':
-                    z = Z_imgs[i_z[i]].cpu().numpy()
-                    df = self.obj_state_tables[pred_label].search(z).limit(11).to_df()
-                    state = df[self.state_db_key].value_counts()
-                    state = state / state.sum()
-                    if track_ids is not None and track_ids[i] in self.xmem.tracks:
-                        state = self.xmem.tracks[track_ids[i]].update_state(state, pred_label, self.state_ema)
-                    state = state.to_dict()
-                # elif self.state_clsf_type == 'dino':
-                #     y = Z_imgs[i_z[i]]#.cpu().numpy()
-                #     assert y.shape[-1] == self.dino_state_classes.shape[0]
-                #     label_mask = self.dino_label_mask[pred_label]
-                #     state = dict(zip(
-                #         self.dino_state_classes[label_mask].tolist(),
-                #         y[label_mask].tolist()
-                #     ))
-                #     # print(state)
-
-            states.append(state)
+                    for i, z in zip(idxs, Z):
+                        t0 = time.perf_counter()
+                        df = self.obj_state_tables[pred_label].search(z).limit(11).to_df()
+                        self.metrics.observe('state_query', time.perf_counter() - t0)
+                        state = df[self.state_db_key].value_counts()
+                        state = state / state.sum()
+                        if track_ids is not None and track_ids[i] in self.xmem.tracks:
+                            state = self.xmem.tracks[track_ids[i]].update_state(state, pred_label, self.state_ema)
+                        states[i] = state.to_dict()
+                    # elif self.state_clsf_type == 'dino':
+                    #     y = Z_imgs[i_z[i]]#.cpu().numpy()
+                    #     assert y.shape[-1] == self.dino_state_classes.shape[0]
+                    #     label_mask = self.dino_label_mask[pred_label]
+                    #     state = dict(zip(
+                    #         self.dino_state_classes[label_mask].tolist(),
+                    #         y[label_mask].tolist()
+                    #     ))
+                    #     # print(state)
+
+        if track_ids is not None:
+            for i in i_z:
+                if track_ids[i] in self.xmem.tracks:
+                    self.xmem.tracks[track_ids[i]].last_state = states[i]
+                    self.xmem.tracks[track_ids[i]].state_timestamp = timestamp if timestamp is not None else 0
+
         # detections.__dict__['pred_states'] = states
         detections.pred_states = np.array(states)
         return detections
 
-    def _encode_boxes(self, img, boxes, det_shape=None):
+    def _encode_boxes(self, img, boxes, det_shape=None, timestamp=None):
+        if is_detic_type(self.state_features):
+            return self._detic_box_features(boxes, timestamp)
+
         # BGR
         # encode each bounding box crop with clip
         # print(f"Clip encoding: {img.shape} {boxes.shape}")
@@ -547,12 +659,27 @@ class ObjectDetector:
         #     input()
 
         if self.state_clsf_type == 'lancedb':
-            Z = self.clip.encode_image(torch.stack([self.clip_pre(x) for x in crops]).to(self.clip_device))
+            with self.cpu_profile.component('clip'):
+                Z = encode_image(self.clip, torch.stack([self.clip_pre(x) for x in crops]).to(self.clip_device), self.clip_precision)
             # Z /= Z.norm(dim=1, keepdim=True)
         # elif self.state_clsf_type == 'dino':
         #     Z = self.dinov2(torch.stack([self.dino_pre(x) for x in crops]).to(self.clip_device))
         #     Z = self.dino_head.predict_proba(np.ascontiguousarray(Z.cpu().numpy()))
         return Z
+
+    def _detic_box_features(self, boxes, timestamp=None):
+        # pool the boxes from the last detection frame's backbone features (no second backbone pass).
+        # boxes are in the detection image's coordinates.
+        if self.detic_feature_query is None:
+            return None
+        detic_query, t = self.detic_feature_query
+        if self.detic_feature_max_age is not None and timestamp is not None and t is not None:
+            if abs(timestamp - t) > self.detic_feature_max_age:
+                return None
+        with self.cpu_profile.component('detic'):
+            return detic_box_features(
+                detic_query, boxes.to(self.detic_device), self.state_features,
+                self.skill_clsf, labels=self.skill_labels)
     
     def classify(self, Z, labels):
         outputs = []
@@ -576,18 +703,60 @@ class ObjectDetector:
 
 
 class Perception:
-    def __init__(self, *a, detect_every_n_seconds=0.5, max_width=480, **kw):
+    def __init__(self, *a, detect_every_n_seconds=0.5, max_width=480, track_width=None, governor=None, metrics=None, **kw):
         self.detector = ObjectDetector(*a, **kw)
         self.detect_every_n_seconds = 0 if detect_every_n_seconds is True else detect_every_n_seconds
         self.detection_timestamp = -1e30
         self.max_width = max_width
-
-    def clear_memory(self):
+        # downscale frames wider than this before detection/tracking (outputs are scaled back)
+        self.track_width = track_width
+        self._track_width = track_width
+        # tunes detect_every_n_seconds, track_width and state_budget to hit a target fps
+        self.governor = Governor.from_config(governor)
+        # live fps / stage latency / track counts over http or a file
+        self.metrics = self.detector.metrics = Metrics.from_config(metrics).start()
+        # detic state features: by default only pool from the last couple of detection frames
+        # (follows detect_every_n_seconds as the governor changes it). Pass float('inf') for no limit.
+        self.auto_feature_max_age = self.detector.detic_feature_max_age is None
+        # keeps the output track IDs stable when XMem's memory is reset mid-video
+        self.track_remapper = TrackRemapper()
+
+    def clear_memory(self, tracks=None, next_track_id=None):
+        '''Start over (e.g. for a new video).
+
+        Arguments:
+            tracks (dict): A track table to carry on from (see ``TrackRemapper``), e.g. from a checkpoint.
+            next_track_id (int): The next unused track ID.
+        '''
         self.detector.clear_memory()
         self.detection_timestamp = -1e30
+        self.track_remapper = TrackRemapper(tracks, next_track_id, max_age=self.detect_every_n_seconds)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        '''Time a stage for the governor and the metrics.'''
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            dt = time.perf_counter() - t0
+            self.governor.observe(name, dt)
+            self.metrics.observe(name, dt)
+
+    def set_video(self, video):
+        '''Set the video that the stage cache looks frames up for (see ``predict(frame_index=)``).'''
+        self.detector.stage_cache.set_video(video)
 
     @torch.no_grad()
-    def predict(self, image, timestamp):
+    def predict(self, image, timestamp, frame_index=None):
+        '''
+        Arguments:
+            frame_index (int): The frame's index in the video (from ``set_video``). Needed to use the stage cache.
+        '''
+        with self.detector.cpu_profile.inference():
+            return self._predict(image, timestamp, frame_index)
+
+    def _predict(self, image, timestamp, frame_index=None):
         # # Get a small version of the image
         # h, w = image.shape[:2]
         full_image = image
@@ -595,25 +764,44 @@ class Perception:
         # H = int((h * W / w)//16)*16
         # # W = int((w * H / h)//16)*16
         # image = cv2.resize(image, (W, H))
+        t0 = time.perf_counter()
+        self.governor.start()
+        is_detection_frame = abs(timestamp - self.detection_timestamp) >= self.detect_every_n_seconds
+
+        # XMem's memory is tied to the frame size, so only change it when we're about to re-detect.
+        # The new tracks are matched to the last frame's tracks by box IoU so they keep their IDs.
+        if self.track_width != self._track_width and is_detection_frame:
+            log.info("Tracking width: %s -> %s", self._track_width, self.track_width)
+            self._track_width = self.track_width
+            self.detector.clear_memory()
+            self.track_remapper = TrackRemapper(
+                self.track_remapper.tracks, self.track_remapper.next_id, max_age=self.detect_every_n_seconds)
+        h, w = image.shape[:2]
+        if self._track_width and w > self._track_width:
+            image = cv2.resize(image, (self._track_width, int(h * self._track_width / w)))
 
         # ---------------------------------------------------------------------------- #
         #                           Detection: every N frames                          #
         # ---------------------------------------------------------------------------- #
 
         detections = detic_query = hoi_detections = hand_mask = None
-        is_detection_frame = abs(timestamp - self.detection_timestamp) >= self.detect_every_n_seconds
         if is_detection_frame:
             self.detection_timestamp = timestamp
 
-            # -------------------------- First we detect objects ------------------------- #
-            # Detic: 
+            with self.stage('detect'):
+                # -------------------------- First we detect objects ------------------------- #
+                # Detic: 
 
-            detections, detic_query = self.detector.predict_objects(image)
+                with trace.span('detect'):
+                    detections, detic_query = self.detector.predict_objects(image, frame_index)
+                    trace.annotate(n=len(detections))
 
-            # ------------------ Then we detect hand object interactions ----------------- #
-            # EgoHOS:
+                # ------------------ Then we detect hand object interactions ----------------- #
+                # EgoHOS:
 
-            hoi_detections, hand_mask = self.detector.predict_hoi(image)
+                with trace.span('hoi'):
+                    hoi_detections, hand_mask = self.detector.predict_hoi(image, frame_index)
+                    trace.annotate(n=len(hoi_detections) if hoi_detections is not None else 0)
 
         # ---------------------------------------------------------------------------- #
         #                             Tracking: Every frame                            #
@@ -622,7 +810,9 @@ class Perception:
         # ------------------------- Then we track the objects ------------------------ #
         # XMem:
 
-        track_detections, frame_detections = self.detector.track_objects(image, detections, negative_mask=hand_mask)
+        with self.stage('track'), trace.span('track'):
+            track_detections, frame_detections = self.detector.track_objects(image, detections, negative_mask=hand_mask)
+            trace.annotate(n=len(track_detections), n_tracks=len(self.detector.xmem.tracks))
 
         # ---------------------------------------------------------------------------- #
         #                            Predicting Object State                           #
@@ -632,7 +822,11 @@ class Perception:
         # LanceDB:
 
         # predict state for tracked objects
-        track_detections = self.detector.predict_state(full_image, track_detections, image.shape)
+        if self.auto_feature_max_age:
+            self.detector.detic_feature_max_age = DETIC_FEATURE_MAX_AGE * self.detect_every_n_seconds
+        with self.stage('state'):
+            track_detections = self.detector.predict_state(
+                full_image, track_detections, image.shape, detic_query=detic_query, timestamp=timestamp)
         # predict state for untracked objects
         # if frame_detections is not None:
         #     frame_detections = self.detector.predict_state(image, frame_detections)
@@ -643,83 +837,45 @@ class Perception:
 
         if hoi_detections is not None:
             # Merging HOI into track_detections, frame_detections, hoi_detections
-            hoi_detections = self.detector.merge_hoi(
-                [track_detections, frame_detections],
-                hoi_detections,
-                detic_query)
+            with self.stage('merge'), trace.span('merge_hoi'):
+                hoi_detections = self.detector.merge_hoi(
+                    [track_detections, frame_detections],
+                    hoi_detections,
+                    detic_query)
+
+        if image is not full_image:
+            track_detections, frame_detections, hoi_detections = (
+                rescale_instances(x, full_image.shape) if x is not None else None
+                for x in (track_detections, frame_detections, hoi_detections))
+        track_detections = self.track_remapper(track_detections, self.detector.xmem.tracks, timestamp)
 
         self.timestamp = timestamp
+        self.governor.finish(self, w)
+        self.metrics.frame(self, time.perf_counter() - t0)
         return track_detections, frame_detections, hoi_detections
 
 
-    def serialize_detections(self, detections, frame_shape, include_mask=False):
-        if detections is None:
-            return None
-        bboxes = detections.pred_boxes.tensor.cpu().numpy()
-        bboxes[:, 0] /= frame_shape[1]
-        bboxes[:, 1] /= frame_shape[0]
-        bboxes[:, 2] /= frame_shape[1]
-        bboxes[:, 3] /= frame_shape[0]
-        labels = detections.pred_labels
-        track_ids = detections.track_ids.cpu().numpy() if detections.has('track_ids') else None
-
-        scores = detections.scores.cpu().numpy() if detections.has('scores') else None
-
-        hand_object = { k: f'{k}_hand_interaction' for k in ['left', 'right', 'both'] }
-        hand_object = {
-            k: detections.get(kk).cpu().numpy()
-            for k, kk in hand_object.items() 
-            if detections.has(kk)}
-
-        possible_labels = None
-        if detections.has('topk_scores'):
-            possible_labels = [
-                {k: v for k, v in zip(ls.tolist(), ss.tolist()) if v > 0}
-                for ls, ss in zip(detections.topk_labels, detections.topk_scores.cpu().numpy())
-            ]
-
-        segments = None
-        if include_mask and detections.has('pred_masks'):
-            segments = [
-                norm_contours(cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[0], frame_shape)
-                for mask in detections.pred_masks.cpu().numpy().astype(np.uint8)
-            ]
-
-        states = detections.pred_states if detections.has('pred_states') else None
-
-        output = []
-        for i in range(len(detections)):
-            data = {
-                'xyxyn': bboxes[i].tolist(),
-                'label': labels[i],
-            }
-
-            if scores is not None:
-                data['confidence'] = scores[i]
-
-            if hand_object:
-                data['hand_object'] = ho = {k: x[i] for k, x in hand_object.items()}
-                data['hand_object_interaction'] = max(ho.values(), default=0)
-
-            if possible_labels:
-                data['possible_labels'] = possible_labels[i]
-
-            if segments:
-                data['segment'] = segments[i]
-
-            if states is not None:
-                data['state'] = states[i]
+    def serialize_detections(self, detections, frame_shape, include_mask=False, **kw):
+        '''Convert detections to a list of dicts.
 
-            if track_ids is not None:
-                data['segment_track_id'] = track_ids[i]
+        See ``util.serialize.serialize_columns`` for the mask and coordinate options
+        (``epsilon``, ``decimals``, ``pixels``).
+        '''
+        return serialize_instances(detections, frame_shape, include_mask=include_mask, **kw)
 
-            output.append(data)
-        return output
 
+def rescale_instances(instances, shape):
+    '''Scale boxes and masks to a new image shape.'''
+    H, W = shape[:2]
+    h, w = instances.image_size
+    out = Instances((H, W))
+    for k, v in instances.get_fields().items():
+        if k == 'pred_boxes':
+            v = Boxes(v.tensor * v.tensor.new_tensor([W / w, H / h, W / w, H / h]))
+        elif k == 'pred_masks' and len(v):
+            v = torch.nn.functional.interpolate(v[:, None].float(), size=(H, W), mode='nearest')[:, 0] > 0.5
+        elif k == 'pred_masks':
+            v = v.new_zeros((0, H, W))
+        out.set(k, v)
+    return out
 
-def norm_contours(contours, shape):
-    contours = list(contours)
-    WH = np.array(shape[:2][::-1])
-    for i in range(len(contours)):
-        contours[i] = np.asarray(contours[i]) / WH
-    return contours
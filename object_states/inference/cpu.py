@@ -0,0 +1,202 @@
+'''CPU tuning for running Perception on CPU-only nodes.
+
+Usage:
+
+    model = Perception(vocabulary=VOCAB, cpu_profile={
+        'threads': 8,
+        'component_threads': {'xmem': 4, 'clip': 2},
+        'compile': ['clip'],
+        'workers': 4,
+    })
+
+'''
+import os
+import logging
+import contextlib
+import torch
+
+log = logging.getLogger(__name__)
+
+COMPONENTS = ('detic', 'egohos', 'xmem', 'clip')
+# channels_last only helps the conv nets. CLIP ViT is a transformer so we leave it alone.
+CHANNELS_LAST_COMPONENTS = ('detic', 'egohos')
+COMPILE_COMPONENTS = ('clip', 'egohos')
+
+
+def available_cpus():
+    '''The number of cores this process is allowed to run on.'''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def workers_per_node():
+    '''Guess how many workers share this node from the launcher environment.'''
+    for k in ['PERCEPTION_WORKERS', 'LOCAL_WORLD_SIZE', 'SLURM_NTASKS_PER_NODE']:
+        v = os.getenv(k)
+        if v and v.split('(')[0].isdigit():
+            return int(v.split('(')[0])
+    return 1
+
+
+def local_worker_index():
+    '''This worker's index on the node from the launcher environment (None if it isn't set).'''
+    for k in ['PERCEPTION_WORKER_INDEX', 'LOCAL_RANK', 'SLURM_LOCALID']:
+        v = os.getenv(k)
+        if v and v.isdigit():
+            return int(v)
+    return None
+
+
+class CpuProfile:
+    '''Thread, layout and compilation settings for CPU inference.
+
+    Arguments:
+        threads (int): Default intra-op thread count. By default, this is the
+            number of cores available to this worker.
+        interop_threads (int): Inter-op thread count. Can only be set once per process.
+        component_threads (dict): Intra-op thread count per component,
+            e.g. ``{'detic': 8, 'xmem': 4}``. Components: ``detic, egohos, xmem, clip``.
+        inference_mode (bool): Run predictions under ``torch.inference_mode``.
+        channels_last (bool): Convert the conv models (Detic, EgoHOS) to channels_last.
+        compile (list): Components to ``torch.compile``. Options: ``clip, egohos``.
+        workers (int): The number of Perception workers sharing this node. Thread
+            counts are capped so that ``workers * threads <= cores``. By default
+            this is read from ``PERCEPTION_WORKERS``, ``LOCAL_WORLD_SIZE`` or ``SLURM_NTASKS_PER_NODE``.
+        worker_index (int): This worker's index on the node, used to pin it to its own slice
+            of cores so workers don't compete. By default this is read from
+            ``PERCEPTION_WORKER_INDEX``, ``LOCAL_RANK`` or ``SLURM_LOCALID``.
+    '''
+    enabled = True
+
+    def __init__(self, threads=None, interop_threads=1, component_threads=None, inference_mode=True,
+                 channels_last=True, compile=(), workers=None, worker_index=None):
+        self.workers = max(int(workers or workers_per_node()), 1)
+        self.worker_index = worker_index if worker_index is not None else local_worker_index()
+        self.cpus = available_cpus()
+        # oversubscription protection: each worker gets its own share of the cores
+        self.max_threads = max(self.cpus // self.workers, 1)
+        self.threads = self._cap(threads or self.max_threads)
+        self.interop_threads = self._cap(interop_threads) if interop_threads else None
+        self.component_threads = {
+            k: self._cap(n) for k, n in (component_threads or {}).items() if n}
+        unknown = set(self.component_threads) - set(COMPONENTS)
+        assert not unknown, f"Unknown components {unknown}. Expected {COMPONENTS}"
+        self.inference_mode = inference_mode
+        self.channels_last = channels_last
+        self.compile = [compile] if isinstance(compile, str) else list(compile or ())
+        unknown = set(self.compile) - set(COMPILE_COMPONENTS)
+        assert not unknown, f"Can't compile {unknown}. Expected {COMPILE_COMPONENTS}"
+
+    def __repr__(self):
+        return (
+            f'CpuProfile(threads={self.threads}, interop_threads={self.interop_threads}, '
+            f'component_threads={self.component_threads}, inference_mode={self.inference_mode}, '
+            f'channels_last={self.channels_last}, compile={self.compile}, '
+            f'workers={self.workers}, worker_index={self.worker_index}, cpus={self.cpus})')
+
+    @classmethod
+    def from_config(cls, cfg=None):
+        '''Create a profile from ``None``, ``True``, a dict, or an existing profile.'''
+        if isinstance(cfg, (cls, NoCpuProfile)):
+            return cfg
+        if cfg is None or cfg is False:
+            return NoCpuProfile()
+        if cfg is True:
+            return cls()
+        return cls(**cfg)
+
+    def _cap(self, n):
+        n = int(n)
+        if n > self.max_threads:
+            log.warning(
+                "Capping %d threads to %d (%d cpus / %d workers) to avoid oversubscription.",
+                n, self.max_threads, self.cpus, self.workers)
+        return max(min(n, self.max_threads), 1)
+
+    # ------------------------------- Process setup ------------------------------ #
+
+    def apply(self):
+        '''Apply the process-wide settings. Call this before loading the models.'''
+        # make sure any libraries that read these at init don't spawn a thread per core
+        for k in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+            os.environ.setdefault(k, str(self.threads))
+
+        # pin workers to disjoint cores
+        if self.worker_index is not None and self.workers > 1 and hasattr(os, 'sched_setaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+            start = (self.worker_index % self.workers) * self.max_threads
+            os.sched_setaffinity(0, cpus[start:start + self.max_threads])
+
+        torch.set_num_threads(self.threads)
+        if self.interop_threads:
+            try:
+                torch.set_num_interop_threads(self.interop_threads)
+            except RuntimeError as e:  # can only be set once, before any parallel work
+                log.warning("Could not set interop threads: %s", e)
+        log.info("Using %s", self)
+        return self
+
+    # ------------------------------ Model setup ------------------------------ #
+
+    def prepare(self, name, module):
+        '''Apply layout and compilation settings to a component model.'''
+        if module is None:
+            return module
+        if self.channels_last and name in CHANNELS_LAST_COMPONENTS:
+            module = module.to(memory_format=torch.channels_last)
+        if name in self.compile:
+            log.info("Compiling %s", name)
+            module = torch.compile(module)
+        return module
+
+    def prepare_clip(self, model):
+        '''Compile only the CLIP visual encoder (that's all we use at inference).'''
+        if model is not None and 'clip' in self.compile:
+            log.info("Compiling clip visual encoder")
+            model.visual = torch.compile(model.visual)
+        return model
+
+    # -------------------------------- Runtime -------------------------------- #
+
+    def inference(self):
+        '''Context for running predictions.'''
+        return torch.inference_mode() if self.inference_mode else contextlib.nullcontext()
+
+    @contextlib.contextmanager
+    def component(self, name):
+        '''Run a component with its own intra-op thread count.'''
+        n = self.component_threads.get(name)
+        if not n or n == self.threads:
+            yield
+            return
+        torch.set_num_threads(n)
+        try:
+            yield
+        finally:
+            torch.set_num_threads(self.threads)
+
+
+class NoCpuProfile:
+    '''The default: don't touch anything.'''
+    enabled = False
+    threads = None
+
+    def __repr__(self):
+        return 'NoCpuProfile()'
+
+    def apply(self):
+        return self
+
+    def prepare(self, name, module):
+        return module
+
+    def prepare_clip(self, model):
+        return model
+
+    def inference(self):
+        return contextlib.nullcontext()
+
+    def component(self, name):
+        return contextlib.nullcontext()
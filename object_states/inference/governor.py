@@ -0,0 +1,206 @@
+'''Keep Perception at a target frame rate by tuning its knobs at runtime.
+
+Usage:
+
+    model = Perception(vocabulary=VOCAB, governor={
+        'target_fps': 10,
+        'detect_every': [0.25, 2],     # detection interval bounds (seconds)
+        'track_width': [320, 853],     # tracking resolution bounds (pixels)
+        'state_budget': [2, 16],       # max boxes to state-classify per frame
+    })
+
+The governor times each stage of ``Perception.predict`` (``detect``, ``track``, ``state``, ``merge``).
+Every ``window`` frames it compares the achieved fps to the target:
+
+ - too slow (below ``target * (1 - tolerance)``): degrade the knob whose stage costs the most
+   (longer detection interval, lower tracking resolution, smaller state budget).
+ - fast enough: restore the degraded knob that is cheapest to restore, but only if the fps
+   predicted after restoring it is still above ``target * (1 + tolerance)``. This is what
+   keeps it from flip-flopping between two settings.
+
+Knobs without bounds are left alone. Every change is logged and kept in ``governor.history``.
+'''
+import time
+import logging
+import contextlib
+from collections import defaultdict, deque
+
+log = logging.getLogger(__name__)
+
+# knob -> the stage it makes cheaper
+KNOBS = {'detect_every': 'detect', 'track_width': 'track', 'state_budget': 'state'}
+STAGES = ('detect', 'track', 'state', 'merge')
+
+
+class Governor:
+    '''Tune the detection interval, tracking resolution and state budget to hit a target fps.
+
+    Arguments:
+        target_fps (float): The fps to aim for (inference only, excluding decoding/writing).
+        detect_every (tuple): (min, max) detection interval in seconds.
+        track_width (tuple): (min, max) tracking width in pixels. Changes apply on the next detection frame
+            (XMem starts over, and the new tracks take over the old track IDs by box IoU).
+        state_budget (tuple): (min, max) boxes to state-classify per frame.
+        window (int): How many frames to measure before deciding.
+        tolerance (float): The relative dead band around the target.
+        detect_step (float): How much to multiply the detection interval by per change.
+        width_step (float): How much to multiply the tracking width by per change.
+        budget_step (float): How much to multiply the state budget by per change.
+    '''
+    enabled = True
+
+    def __init__(self, target_fps, detect_every=None, track_width=None, state_budget=None, window=30, tolerance=0.1,
+                 detect_step=1.25, width_step=0.85, budget_step=0.75):
+        self.target_fps = target_fps
+        self.bounds = {
+            k: tuple(v) for k, v in
+            {'detect_every': detect_every, 'track_width': track_width, 'state_budget': state_budget}.items()
+            if v is not None}
+        for k, (lo, hi) in self.bounds.items():
+            assert lo <= hi, f"{k}: min {lo} > max {hi}"
+        self.window = window
+        self.tolerance = tolerance
+        self.steps = {'detect_every': detect_step, 'track_width': width_step, 'state_budget': budget_step}
+        self.frames = deque(maxlen=window)
+        self.history = []
+        self._stages = defaultdict(float)
+        self._t0 = None
+
+    def __repr__(self):
+        return f'Governor(target_fps={self.target_fps}, bounds={self.bounds})'
+
+    @classmethod
+    def from_config(cls, cfg=None):
+        '''Create a governor from ``None``, a target fps, a dict, or an existing governor.'''
+        if isinstance(cfg, (cls, NoGovernor)):
+            return cfg
+        if not cfg:
+            return NoGovernor()
+        if isinstance(cfg, (int, float)):
+            return cls(cfg)
+        return cls(**cfg)
+
+    # -------------------------------- Measuring ------------------------------- #
+
+    def start(self):
+        self._stages.clear()
+        self._t0 = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0)
+
+    def observe(self, name, seconds):
+        self._stages[name] += seconds
+
+    def finish(self, model, width=None):
+        '''Record the frame and adjust the model's knobs if needed.'''
+        if self._t0 is None:
+            return
+        self.frames.append((time.perf_counter() - self._t0, dict(self._stages)))
+        self._t0 = None
+        if len(self.frames) < self.window:
+            return
+        self.adjust(model, width)
+
+    def stats(self):
+        '''The fps and the average time per frame spent in each stage.'''
+        n = len(self.frames)
+        total = sum(t for t, _ in self.frames)
+        costs = {s: sum(st.get(s, 0) for _, st in self.frames) / n for s in STAGES}
+        return (n / total if total else float('inf')), total / n, costs
+
+    # -------------------------------- Adjusting ------------------------------- #
+
+    def values(self, model, width=None):
+        return {
+            'detect_every': model.detect_every_n_seconds,
+            'track_width': model.track_width or width,
+            'state_budget': model.detector.state_budget,
+        }
+
+    def adjust(self, model, width=None):
+        fps, frame_time, costs = self.stats()
+        values = self.values(model, width)
+        if fps < self.target_fps * (1 - self.tolerance):
+            # degrade whatever is costing us the most
+            options = [k for k in self.bounds if self._step(k, values[k], degrade=True) is not None]
+            if not options:
+                return
+            knob = max(options, key=lambda k: costs[KNOBS[k]])
+            self._set(model, knob, values[knob], self._step(knob, values[knob], degrade=True), fps)
+        elif fps > self.target_fps * (1 + self.tolerance):
+            # restore the cheapest knob that we can afford
+            best = None
+            for k in self.bounds:
+                new = self._step(k, values[k], degrade=False)
+                if new is None:
+                    continue
+                # predicted frame time if the stage's cost grows with the knob
+                extra = costs[KNOBS[k]] * (self._cost_ratio(k, values[k], new) - 1)
+                predicted = 1 / (frame_time + extra) if frame_time + extra > 0 else float('inf')
+                if predicted >= self.target_fps * (1 + self.tolerance) and (best is None or extra < best[0]):
+                    best = extra, k, new
+            if best is not None:
+                _, knob, new = best
+                self._set(model, knob, values[knob], new, fps)
+
+    def _cost_ratio(self, knob, old, new):
+        if knob == 'detect_every':
+            return old / new  # detections per second
+        if knob == 'track_width':
+            return (new / old) ** 2  # pixels
+        return new / old  # boxes
+
+    def _step(self, knob, value, degrade):
+        '''The next value for a knob, or None if it's at its bound.'''
+        lo, hi = self.bounds[knob]
+        step = self.steps[knob]
+        if knob == 'detect_every':
+            new = round(value * step if degrade else value / step, 3)
+        elif knob == 'track_width':
+            if value is None:
+                return None
+            new = int(round(value * step / 16) * 16 if degrade else round(value / step / 16) * 16)
+        else:
+            value = hi if value is None else value
+            new = int(value * step) if degrade else max(int(round(value / step)), value + 1)
+        new = min(max(new, lo), hi)
+        return None if new == value else new
+
+    def _set(self, model, knob, old, new, fps):
+        if knob == 'detect_every':
+            model.detect_every_n_seconds = new
+        elif knob == 'track_width':
+            model.track_width = new
+        else:
+            model.detector.state_budget = new
+        log.info("Governor: %.1f fps (target %.1f): %s %s -> %s", fps, self.target_fps, knob, old, new)
+        self.history.append({'fps': fps, 'knob': knob, 'old': old, 'new': new})
+        # measure the new setting from scratch
+        self.frames.clear()
+
+
+class NoGovernor:
+    '''The default: don't measure or change anything.'''
+    enabled = False
+    history = ()
+
+    def __repr__(self):
+        return 'NoGovernor()'
+
+    def start(self):
+        pass
+
+    def stage(self, name):
+        return contextlib.nullcontext()
+
+    def observe(self, name, seconds):
+        pass
+
+    def finish(self, model, width=None):
+        pass
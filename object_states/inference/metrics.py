@@ -0,0 +1,329 @@
+'''Live metrics for long-running Perception workers, in Prometheus text format.
+
+Usage:
+
+    model = Perception(vocabulary=VOCAB, metrics={'port': 9108})      # GET http://localhost:9108/metrics
+    model = Perception(vocabulary=VOCAB, metrics={'file': 'metrics.prom', 'interval': 5})
+    model.metrics.watch_queue('writer', writer)                     # anything with qsize() or __len__
+    model.metrics.register('dropped_frames_total', lambda: replay.n_dropped, 'counter')
+
+The inference loop never takes a lock: each value has a single writer (the inference
+thread) and is a plain attribute, a fixed-size ring buffer, or a running total, which the
+exporter thread reads as-is. A read can be one observation behind, which doesn't matter
+for a scrape. Values that already live elsewhere (queue depths, dropped frames) are
+pulled by the exporter when it renders, so they cost the loop nothing.
+
+Exposed (prefix ``object_states_``):
+
+ - ``fps``: rolling fps over the last ``window`` frames
+ - ``frames_total``
+ - ``stage_seconds{stage, quantile}`` (+ ``_sum``, ``_count``): ``frame``, ``detect``, ``track``, ``state``, ``merge``, ``state_query``
+ - ``tracks{status="live"|"tentative"}``: tracks XMem returned (confirmed) and the rest of its tracks
+ - ``xmem_memory_elements{memory="working"|"long_term"}``
+ - ``queue_depth{queue}``, ``dropped_frames_total`` and anything else that's registered
+'''
+import os
+import time
+import logging
+import threading
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+PREFIX = 'object_states_'
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Ring:
+    '''A fixed-size buffer of the last ``n`` observations, plus a running count and sum. Single writer.'''
+    __slots__ = ('values', 'count', 'sum')
+
+    def __init__(self, n):
+        self.values = np.zeros(n)
+        self.count = 0
+        self.sum = 0.
+
+    def add(self, x):
+        self.values[self.count % len(self.values)] = x
+        self.sum += x
+        self.count += 1  # last, so a reader never sees a slot that isn't written yet
+
+    def last(self):
+        return self.values[:min(self.count, len(self.values))].copy()
+
+
+class Metrics:
+    '''Collect per-frame metrics and export them over HTTP or to a file.
+
+    Arguments:
+        port (int): Serve ``/metrics`` on this port.
+        host (str): The address to serve on. Defaults to localhost only.
+        file (str): Rewrite this file every ``interval`` seconds (atomically, for e.g. node_exporter's textfile collector).
+        interval (float): How often to rewrite the file.
+        window (int): How many frames the fps and quantiles are computed over.
+        track_every (int): Count tracks and XMem memory every N frames.
+    '''
+    enabled = True
+
+    def __init__(self, port=None, host='127.0.0.1', file=None, interval=5, window=256, track_every=1):
+        assert port is not None or file, "Metrics needs a port or a file to export to"
+        self.port = port
+        self.host = host
+        self.file = file
+        self.interval = interval
+        self.window = window
+        self.track_every = max(int(track_every), 1)
+
+        self.frames = 0
+        self.frame_ends = Ring(window)
+        self.stages = {}
+        self.gauges = {}
+        self.collectors = {}
+        self._server = self._thread = None
+        self._stop = threading.Event()
+        self._memory_path = None
+
+    def __repr__(self):
+        return f'Metrics(port={self.port}, file={self.file})'
+
+    @classmethod
+    def from_config(cls, cfg=None):
+        '''Create metrics from ``None``, a port, a file name, a dict, or an existing ``Metrics``.'''
+        if isinstance(cfg, (cls, NoMetrics)):
+            return cfg
+        if not cfg:
+            return NoMetrics()
+        if isinstance(cfg, int):
+            return cls(port=cfg)
+        if isinstance(cfg, str):
+            return cls(file=cfg)
+        return cls(**cfg)
+
+    # ------------------------------- Hot loop ------------------------------- #
+
+    def observe(self, name, seconds):
+        ring = self.stages.get(name)
+        if ring is None:
+            ring = self.stages[name] = Ring(self.window)
+        ring.add(seconds)
+
+    def frame(self, model, seconds):
+        '''Record a finished frame (called at the end of ``Perception.predict``).'''
+        self.observe('frame', seconds)
+        self.frame_ends.add(time.perf_counter())
+        self.frames += 1
+        if self.frames % self.track_every == 0:
+            xmem = model.detector.xmem
+            live = len(model.detector.confirmed_track_ids)
+            self.gauges['tracks'] = {'live': live, 'tentative': max(len(xmem.tracks) - live, 0)}
+            self.gauges['xmem_memory_elements'] = self.xmem_memory_size(xmem)
+
+    def xmem_memory_size(self, xmem):
+        '''XMem's memory sizes ({} if they can't be read - logged once).'''
+        if self._memory_path is None:
+            try:
+                path = find_memory_manager(xmem)
+            except ImportError:
+                path = None
+            if path is None:
+                log.warning("Can't find XMem's MemoryManager in %s - not reporting its memory size", type(xmem).__name__)
+            self._memory_path = path if path is not None else False
+        if self._memory_path is False:
+            return {}
+        memory = xmem
+        for k in self._memory_path:
+            memory = getattr(memory, k)
+        try:
+            return memory_size(memory)
+        except AttributeError as e:
+            log.warning("Can't read XMem's memory size (%s) - not reporting it", e)
+            self._memory_path = False
+            return {}
+
+    # -------------------------------- Pulled -------------------------------- #
+
+    def register(self, name, fn, kind='gauge', **labels):
+        '''Add a value that's read when the metrics are rendered. Registering the same name and labels again replaces it.'''
+        self.collectors[(name, tuple(sorted(labels.items())))] = (kind, fn)
+
+    def watch_queue(self, name, q):
+        '''Export a queue's depth (anything with ``qsize()`` or ``__len__``).'''
+        fn = q.qsize if hasattr(q, 'qsize') else lambda: len(q)
+        self.register('queue_depth', fn, queue=name)
+
+    # -------------------------------- Export -------------------------------- #
+
+    def fps(self):
+        ends = np.sort(self.frame_ends.last())
+        return (len(ends) - 1) / (ends[-1] - ends[0]) if len(ends) > 1 and ends[-1] > ends[0] else 0.
+
+    def render(self):
+        '''The metrics in Prometheus text format.'''
+        lines = []
+        def add(name, kind, samples, help=None):
+            name = PREFIX + name
+            if help:
+                lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, labels, value in samples:
+                lines.append(f'{name}{suffix}{_labels(labels)} {_value(value)}')
+
+        add('frames_total', 'counter', [('', {}, self.frames)], 'Frames processed.')
+        add('fps', 'gauge', [('', {}, self.fps())], f'Frames per second over the last {self.window} frames.')
+        samples = []
+        for stage, ring in list(self.stages.items()):
+            x = ring.last()
+            count, total = ring.count, ring.sum
+            if len(x):
+                samples += [('', {'stage': stage, 'quantile': q}, v) for q, v in zip(QUANTILES, np.quantile(x, QUANTILES))]
+            samples += [('_sum', {'stage': stage}, total), ('_count', {'stage': stage}, count)]
+        add('stage_seconds', 'summary', samples, 'Time spent in each stage.')
+
+        gauges = dict(self.gauges)
+        if 'tracks' in gauges:
+            add('tracks', 'gauge', [('', {'status': k}, v) for k, v in gauges['tracks'].items()], 'XMem tracks.')
+        if gauges.get('xmem_memory_elements'):
+            add('xmem_memory_elements', 'gauge', [('', {'memory': k}, v) for k, v in gauges['xmem_memory_elements'].items()], 'XMem memory size.')
+
+        by_name = {}
+        for (name, labels), (kind, fn) in list(self.collectors.items()):
+            try:
+                value = fn()
+            except Exception as e:
+                log.debug("metrics: %s failed: %s", name, e)
+                continue
+            by_name.setdefault((name, kind), []).append(('', dict(labels), value))
+        for (name, kind), samples in by_name.items():
+            add(name, kind, samples)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, fname=None):
+        '''Write the metrics to a file (atomically).'''
+        fname = fname or self.file
+        os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+        tmp = f'{fname}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, fname)
+
+    def start(self):
+        '''Start serving / writing in the background.'''
+        if self.port is not None and self._server is None:
+            self._server = _serve(self, self.host, self.port)
+            log.info("Serving metrics on http://%s:%s/metrics", self.host, self._server.server_address[1])
+        if self.file and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._write_loop, daemon=True)
+            self._thread.start()
+        return self
+
+    def _write_loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except Exception:
+                log.exception("Could not write metrics to %s", self.file)
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self.write()
+
+
+class NoMetrics:
+    '''The default: don't collect anything.'''
+    enabled = False
+
+    def __repr__(self):
+        return 'NoMetrics()'
+
+    def observe(self, name, seconds):
+        pass
+
+    def frame(self, model, seconds):
+        pass
+
+    def register(self, *a, **kw):
+        pass
+
+    def watch_queue(self, name, q):
+        pass
+
+    def start(self):
+        return self
+
+    def close(self):
+        pass
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Helpers                                   #
+# ---------------------------------------------------------------------------- #
+
+
+def find_memory_manager(xmem, depth=3):
+    '''The attribute path (e.g. ``['processor', 'memory']``) to XMem's ``MemoryManager``, or None.'''
+    from xmem.inference.memory_manager import MemoryManager
+    level = [([], xmem)]
+    for _ in range(depth + 1):
+        for path, obj in level:
+            if isinstance(obj, MemoryManager):
+                return path
+        level = [
+            (path + [k], v) for path, obj in level
+            for k, v in {**getattr(obj, '_modules', {}), **getattr(obj, '__dict__', {})}.items()
+            if not k.startswith('__') and hasattr(v, '__dict__')]
+    return None
+
+
+def memory_size(memory):
+    '''The number of elements in a ``MemoryManager``'s working and long-term memory.'''
+    out = {'working': int(memory.work_mem.size)}
+    if getattr(memory, 'enable_long_term', False):
+        out['long_term'] = int(memory.long_mem.size)
+    return out
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + '}'
+
+
+def _escape(v):
+    return str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _value(v):
+    v = float(v)
+    return 'NaN' if v != v else repr(int(v)) if v.is_integer() and abs(v) < 2**53 else repr(v)
+
+
+def _serve(metrics, host, port):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *a):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
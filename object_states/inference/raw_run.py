@@ -1,37 +1,72 @@
 import os
+import logging
 import cv2
 import orjson
+import tqdm
+import numpy as np
 import torch
 from ptgctl.holoframe import load as holoframe_load
 from ptgctl.util import parse_epoch_time, format_epoch_time
 from redis_record.storage_formats import get_player, get_recorder
 from object_states.inference import Perception
+from ..util import wire
+from ..util.timeseries import StreamAligner, DepthLifter
+from ..util.data_output import json_dump
+from .realtime import RealtimeReplay
 from .vocab import VOCAB
 
+log = logging.getLogger(__name__)
+
 
 @torch.no_grad()
-def run_one(name, recording_dir, json_recording_dir, tracked_vocab=None, state_db=None, vocab=VOCAB, detect_every=0.5, suffix=':v3'):
+def run_one(name, recording_dir, json_recording_dir, tracked_vocab=None, state_db=None, vocab=VOCAB, detect_every=0.5, suffix=':v3', cpu_profile=None, segment_epsilon=1, segment_decimals=4, wire_format='json', depth_tolerance=300, max_depth_dist=None, realtime=False, speed=1, slo=0.5, drop_policy='oldest', keep_every=2, governor=None, metrics=None):
+    '''
+    Arguments:
+        wire_format (str): ``json`` or ``wire``. ``wire`` sends ``detic:image`` as binary
+            (``util.wire.encode_detections``) and writes ``{sid}.osw`` files instead of ``{sid}.json``.
+            Convert them with ``python -m object_states.util.wire to_json``.
+        depth_tolerance (int): The max time (ms) between a main frame and the depth frame used for ``detic:world``.
+        max_depth_dist (float): Drop 3D objects whose depth point is further than this (pixels) from their box center.
+        realtime (bool): Replay at recorded ``speed`` and drop main frames that fall behind (see ``realtime.RealtimeReplay``).
+            Writes the fps, drop rate and latency percentiles to ``{name}/realtime.json``.
+        slo (float): The latency SLO (seconds) for realtime mode.
+        drop_policy (str): ``oldest``, ``detect`` (never drop detection frames) or ``nth`` (never drop every ``keep_every``-th frame).
+        metrics (int, str, dict): Export live metrics on a port, to a file, or ``{port, file, interval}`` (see ``metrics.Metrics``).
+    '''
     if tracked_vocab is not None:
         vocab['tracked'] = tracked_vocab
     model = Perception(
         vocabulary=vocab,
         state_db_fname=state_db,
-        detect_every_n_seconds=detect_every)
+        detect_every_n_seconds=detect_every,
+        cpu_profile=cpu_profile,
+        governor=governor,
+        metrics=metrics)
 
     skipped_3d_labels = {'person'}
 
     with get_player(name, recording_dir, subset=['main', 'depthlt', 'depthltCal']) as player, \
          get_recorder(recording_dir) as recorder, \
-         JsonWriter(name, recording_dir) as json_recorder:
+         wire.StreamWriter(os.path.join(recording_dir, name), format=wire_format) as json_recorder:
         recorder.ensure_writer(name)
-        depthltCal = None
-        depthltHist = dicque(maxlen=16)
+        # depth frames are matched to the closest main frame, the calibration is whatever we saw last
+        streams = StreamAligner({'depthlt': depth_tolerance}, maxlen={'depthlt': 16, 'depthltCal': 1})
+        lifter = DepthLifter(max_dist=max_depth_dist)
+        model.metrics.watch_queue('writer', json_recorder)
+        replay = None
+        if realtime:
+            player = replay = RealtimeReplay(
+                player, get_time=lambda ts: int(ts.split('-')[0]) / 1000, speed=speed, slo=slo,
+                policy=drop_policy, every=keep_every,
+                # the governor can change the detection interval, so follow the model's
+                detect_every=lambda: model.detect_every_n_seconds,
+                last_detection=lambda: model.detection_timestamp)
+            model.metrics.register('queue_depth', replay.pending, queue='replay')
+            model.metrics.register('dropped_frames_total', lambda: replay.n_dropped, 'counter')
         for stream_id, ts, message in player:
             tms = int(ts.split('-')[0])
-            if stream_id == 'depthltCal':
-                depthltCal = holoframe_load(message['d'])
-            elif stream_id == 'depthlt':
-                depthltHist[tms] = holoframe_load(message['d'])
+            if stream_id in ('depthlt', 'depthltCal'):
+                streams.add(stream_id, tms, holoframe_load(message['d']))
             elif stream_id == 'main':
                 d = holoframe_load(message['d'])
                 frame = d['image'][:,:,::-1]
@@ -40,9 +75,11 @@ def run_one(name, recording_dir, json_recording_dir, tracked_vocab=None, state_d
                 small_frame = cv2.resize(frame, (int(w*H/h), H))
                 # ts = parse_epoch_time(timestamp)
                 timestamp = format_epoch_time(ts)
-                track_detections, frame_detections, hoi_detections = model.predict(small_frame, ts)
+                track_detections, frame_detections, hoi_detections = model.predict(small_frame, tms / 1000)
                 outputs = {
-                    "detic:image": model.serialize_detections(track_detections, frame.shape, include_mask=True),
+                    "detic:image": model.serialize_detections(
+                        track_detections, small_frame.shape, include_mask=True,
+                        epsilon=segment_epsilon, decimals=segment_decimals),
                     # "detic:image": self.perception.serialize_detections(track_detections, frame.shape),
                 }
 
@@ -59,138 +96,46 @@ def run_one(name, recording_dir, json_recording_dir, tracked_vocab=None, state_d
                     'timestamp': timestamp,
                 }
 
-                if len(depthltHist) and depthltCal is not None:
-                    k = depthltHist.closest(tms)
-                    if k is None or abs(k-tms) > 300:
-                        tqdm.tqdm.write(f"Skipping 3d as depth was too far away: {k or 0:.0f} - {tms:.0f}: {(k or 0)-tms:.2f}>300")
-                    else:
-                        objects = get_3d_objects(objects, image_params, depthltHist[k], depthltCal)
-                        objects = [d for d in objects if d['label'] not in skipped_3d_labels]
-                        outputs['detic:world'] = objects
-                else:
+                depthlt, depthltCal = streams.align(tms, ['depthlt', 'depthltCal'])
+                if depthlt is not None and depthltCal is not None:
+                    objects = [d for d in outputs['detic:image'] if d['label'] not in skipped_3d_labels]
+                    outputs['detic:world'] = get_3d_objects(objects, image_params, depthlt, depthltCal, lifter)
+                elif depthltCal is None or not len(streams.buffer('depthlt')):
                     tqdm.tqdm.write("Skipping 3d as we have no depth data")
+                else:
+                    tqdm.tqdm.write(f"Skipping 3d as depth was more than {depth_tolerance}ms away")
 
                 for sid, d in outputs.items():
+                    d = (
+                        wire.encode_detections(d) if wire_format == 'wire' and sid == 'detic:image' else
+                        orjson.dumps(d, option=orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY))
                     sid = f'{sid}{suffix}'
-                    d = orjson.dumps(d, option=orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY)
-                    json_recorder.write(sid, timestamp, d)
+                    json_recorder.write_message(sid, timestamp, d)
                     recorder.write(sid, ts, {b'd': d})
+                if replay is not None:
+                    replay.done()
+
+        if replay is not None:
+            report = replay.report()
+            log.info("realtime: %s", report)
+            json_dump(os.path.join(recording_dir, name, 'realtime.json'), report)
+    model.metrics.close()
 
 
             
 
 
-def get_3d_objects(objects, image_params, depthlt, depthltCal):
-    pts = pt3d.Points3D(
-        image_params['shape'][:2], 
-        depthlt['image'], 
-        depthltCal['lut'],
-        depthlt['rig2world'], 
-        depthltCal['rig2cam'], 
-        image_params['cam2world'],
-        image_params['focal'], 
-        image_params['principal'],
-        generate_point_cloud=False)
-    h, w = pt3d.im_shape
-
-    # convert to 3d
-    d = outputs['detic:image:for3d']
-    xyxy = np.array([o['xyxyn'] for o in objects]).reshape(-1, 4)
-    xyxy[:, 0] *= w 
-    xyxy[:, 1] *= h 
-    xyxy[:, 2] *= w 
-    xyxy[:, 3] *= h 
-    xyz_center, dist = pt3d.transform_center_withinbbox(xyxy)
-    valid = dist < self.max_depth_dist  # make sure the points aren't too far
+def get_3d_objects(objects, image_params, depthlt, depthltCal, lifter=None):
+    '''Add ``xyz_center`` and ``depth_map_dist`` to each object. Objects without a (close enough) depth point are dropped.'''
+    lifter = lifter or DepthLifter()
+    h, w = image_params['shape'][:2]
+    xyxy = np.array([o['xyxyn'] for o in objects], dtype=np.float32).reshape(-1, 4) * [w, h, w, h]
+    xyz_center, dist, valid = lifter.lift(xyxy, image_params, depthlt, depthltCal)
     log.debug('%d/%d boxes valid. dist in [%f,%f]', valid.sum(), len(valid), dist.min(initial=np.inf), dist.max(initial=0))
-
-    for obj, xyz_center, valid, dist in zip(objects, xyz_center, valid, dist):
-        obj['xyz_center'] = xyz_center
-        obj['depth_map_dist'] = dist
-    return objects
-
-
-
-class dicque(OrderedDict):
-    def __init__(self, *a, maxlen=0, **kw):
-        self._max = maxlen
-        super().__init__(*a, **kw)
-
-    def __setitem__(self, k, v):
-        super().__setitem__(k, v)
-        if self._max > 0 and len(self) > self._max:
-            self.popitem(False)
-
-    def closest(self, tms):
-        k = min(self, key=lambda t: abs(tms-t), default=None)
-        return k
-
-
-class JsonWriter:
-    out_dir = ''
-    def __init__(self, name, recording_dir=''):
-        self.recording_dir = recording_dir
-        self.writers = {}
-        if name is not None:
-            self.ensure_writer(name)
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, *a):
-        self.close()
-
-    def ensure_writer(self, name):
-        self.close()
-        self.out_dir = os.path.join(self.recording_dir, name)
-        os.makedirs(self.out_dir, exist_ok=True)
-
-    def ensure_channel(self, sid):
-        if sid not in self.writers:
-            self.writers[sid] = open(os.path.join(self.out_dir, f'{sid}.json'), 'wb')
-            self.writers[sid].write(b'[\n')
-            self.writers[sid].i_line = 0
-        return self.writers[sid]
-
-    def close(self):
-        for w in self.writers.values():
-            w.write(b'\n]\n')
-            w.close()
-        self.writers.clear()
-
-    def write(self, sid, t, data):
-        w = self.ensure_channel(sid)
-        data = self._add_timestamp_to_json(data, t)
-        data = self._serialize(data)
-        if w.i_line:
-            w.write(b',\n')
-        w.write(data)
-        w.i_line += 1
-
-    def _add_timestamp_to_json(self, d, ts):
-        if ts is not None:
-            try:
-                if isinstance(d, bytes):
-                    d = orjson.loads(d)
-                if not isinstance(d, dict):
-                    d = {'data': d}
-                if 'timestamp' not in d:
-                    d['timestamp'] = ts
-            except Exception:
-                print("error reading data")
-                print(d)
-                raise
-        return d
-
-    def _serialize(self, d):
-        try:
-            if not isinstance(d, bytes):
-                d = orjson.dumps(d, option=orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY)
-        except Exception:
-            print("error writing data")
-            print(d)
-            raise
-        return d
+    return [
+        {**obj, 'xyz_center': xyz.tolist(), 'depth_map_dist': float(di)}
+        for obj, xyz, di, v in zip(objects, xyz_center, dist, valid) if v
+    ]
 
 
 # import ipdb
@@ -0,0 +1,181 @@
+'''Replay a recording in real time, dropping frames when inference can't keep up.
+
+Messages are released at their recorded time (``speed`` x) by a background thread, like they
+would arrive from a live device. When the loop asks for the next message, main frames that
+have been superseded by a newer frame, or that are older than the latency SLO, are dropped -
+unless the drop policy protects them:
+
+ - ``oldest``: nothing is protected, always process the freshest frame.
+ - ``detect``: protect the frames that will be detection frames (every ``detect_every`` seconds).
+ - ``nth``: protect every ``every``-th frame.
+
+Other streams (depth, calibration) are never dropped.
+
+.. code-block:: python
+
+    replay = RealtimeReplay(player, get_time=lambda ts: int(ts.split('-')[0]) / 1000, slo=0.3)
+    for sid, ts, msg in replay:
+        ...
+        replay.done()
+    print(replay.report())
+'''
+import time
+import logging
+import threading
+from collections import deque
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+POLICIES = ['oldest', 'detect', 'nth']
+
+
+class RealtimeReplay:
+    '''Replay (stream_id, ts, message) at recorded speed with a latency SLO and a drop policy.
+
+    Arguments:
+        messages (iterable): The (stream_id, ts, message) to replay, in time order.
+        stream (str): The stream that can be dropped (the one inference runs on).
+        get_time (callable): Get the time (seconds) from a message's ts. Defaults to ts itself.
+        speed (float): The replay speed. 2 replays twice as fast as it was recorded.
+        slo (float): The latency SLO (seconds). Unprotected frames older than this are dropped. None to only drop superseded frames.
+        policy (str): Which frames can't be dropped. See ``POLICIES``.
+        every (int): For ``nth``, protect every Nth frame.
+        detect_every (float, callable): For ``detect``, the detection interval (seconds), or a function
+            returning the current one (e.g. ``lambda: model.detect_every_n_seconds``, which the governor changes).
+        last_detection (callable): For ``detect``, a function returning the time of the last detection frame
+            (e.g. ``lambda: model.detection_timestamp``). By default, the last protected frame.
+        max_pending (int): How many messages the reader can get ahead before it waits.
+    '''
+    def __init__(self, messages, stream='main', get_time=None, speed=1, slo=0.5, policy='oldest', every=2, detect_every=0.5, last_detection=None, max_pending=1024):
+        assert policy in POLICIES, f"Unknown drop policy {policy}. Use one of {POLICIES}"
+        self.messages = messages
+        self.stream = stream
+        self.get_time = get_time or (lambda ts: ts)
+        self.speed = speed
+        self.slo = slo
+        self.policy = policy
+        self.every = max(int(every), 1)
+        self.detect_every = detect_every if callable(detect_every) else (lambda: detect_every)
+        self.last_detection = last_detection or (lambda: self._last_detect)
+        self.max_pending = max_pending
+
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._finished = False
+        self._error = None
+        self._thread = None
+        self._current = None
+        self._last_detect = -1e30
+
+        self.n_frames = 0
+        self.n_dropped = 0
+        self.latencies = []
+        self.started = self.stopped = None
+
+    # --------------------------------- Producer --------------------------------- #
+
+    def _run(self):
+        t0 = None
+        try:
+            for sid, ts, msg in self.messages:
+                t = self.get_time(ts)
+                if t0 is None:
+                    t0 = t
+                # wait until the message would have arrived
+                delay = self.started + (t - t0) / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                with self._cond:
+                    while len(self._pending) >= self.max_pending:
+                        self._cond.wait()
+                    self._pending.append((sid, ts, msg, t, time.perf_counter()))
+                    self._cond.notify_all()
+        except BaseException as e:
+            self._error = e
+        finally:
+            with self._cond:
+                self._finished = True
+                self._cond.notify_all()
+
+    # --------------------------------- Consumer --------------------------------- #
+
+    def __iter__(self):
+        self.started = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                with self._cond:
+                    self.done()
+                    item = None
+                    while item is None:
+                        while not self._pending and not self._finished:
+                            self._cond.wait()
+                        if not self._pending:
+                            break
+                        item = self._next()
+                    self._cond.notify_all()
+                if item is None:
+                    break
+                yield item
+            if self._error is not None:
+                raise self._error
+        finally:
+            self.done()
+            self.stopped = time.perf_counter()
+
+    def _protected(self, t):
+        if self.policy == 'detect':
+            return t - self.last_detection() >= self.detect_every()
+        if self.policy == 'nth':
+            return self.n_frames % self.every == 0
+        return False
+
+    def _next(self):
+        sid, ts, msg, t, arrived = self._pending.popleft()
+        if sid != self.stream:
+            return sid, ts, msg
+        protected = self._protected(t)
+        self.n_frames += 1
+        superseded = any(x[0] == self.stream for x in self._pending)
+        late = self.slo is not None and time.perf_counter() - arrived > self.slo
+        if not protected and (superseded or late):
+            self.n_dropped += 1
+            return None
+        if self.policy == 'detect' and protected:
+            self._last_detect = t
+        self._current = arrived
+        return sid, ts, msg
+
+    def pending(self):
+        '''How many messages have arrived but haven't been read yet.'''
+        return len(self._pending)
+
+    def done(self):
+        '''Mark the current frame as finished (otherwise it's finished when the next message is requested).'''
+        if self._current is not None:
+            self.latencies.append(time.perf_counter() - self._current)
+            self._current = None
+
+    # ---------------------------------- Report ---------------------------------- #
+
+    def report(self):
+        '''The achieved fps, drop rate and latency percentiles (ms).'''
+        elapsed = (self.stopped or time.perf_counter()) - (self.started or time.perf_counter())
+        lat = np.array(self.latencies) * 1000
+        pct = lambda q: float(np.percentile(lat, q)) if len(lat) else None
+        return {
+            'policy': self.policy,
+            'frames': self.n_frames,
+            'processed': len(lat),
+            'dropped': self.n_dropped,
+            'drop_rate': self.n_dropped / max(self.n_frames, 1),
+            'input_fps': self.n_frames / elapsed if elapsed else 0,
+            'fps': len(lat) / elapsed if elapsed else 0,
+            'latency_p50_ms': pct(50),
+            'latency_p90_ms': pct(90),
+            'latency_p99_ms': pct(99),
+            'slo_ms': self.slo * 1000 if self.slo is not None else None,
+            'slo_violations': float((lat > self.slo * 1000).mean()) if self.slo is not None and len(lat) else None,
+        }
@@ -0,0 +1,114 @@
+'''Draw run_one's debug videos in a background thread.
+
+The inference loop only converts its outputs to (cpu) ``sv.Detections`` and puts them
+on a bounded queue with the frame. The renderer draws the four panels
+(tracks, detections, states, HOI) into one preallocated canvas and encodes the
+grid video and the per-track videos.
+'''
+import numpy as np
+import supervision as sv
+
+from ..util.data_output import BackgroundWriter
+from ..util import trace
+from ..util.video import FastDetectionAnnotator, XMemSink
+
+
+class Renderer(BackgroundWriter):
+    '''Render the tracks/detections/states/HOI grid video in a background thread.
+
+    Arguments:
+        out_dir (str): The output directory for the ``XMemSink``.
+        video_info (sv.VideoInfo): The output video info (for the 2x2 grid).
+        WH (tuple): The size of each panel.
+        every (int): Render every N frames that are passed to ``render``. 0 disables rendering.
+        maxsize (int): How many frames can be waiting to be rendered before ``render`` blocks.
+    '''
+    def __init__(self, out_dir, video_info, WH, every=1, maxsize=16, **kw):
+        super().__init__(maxsize=maxsize, **kw)
+        self.out_dir = out_dir
+        self.video_info = video_info
+        self.WH = WH
+        self.every = every or 0
+        self.count = 0
+        self.sink = None
+
+    def start(self):
+        if not self.every:
+            return self
+        return super().start()
+
+    def render(self, i, frame, track_detections, frame_detections=None, hoi_detections=None):
+        '''Queue a frame to render. This converts the detections to cpu numpy arrays first.'''
+        if not self.every:
+            return
+        self.count += 1
+        if (self.count - 1) % self.every:
+            return
+        with trace.span('draw'):
+            self.write((
+                i, frame,
+                (*detectron_to_sv(track_detections, frame.shape[:2]), track_detections.pred_states if track_detections.has('pred_states') else None),
+                detectron_to_sv(frame_detections, frame.shape[:2]) if frame_detections is not None else None,
+                detectron_to_sv(hoi_detections, frame.shape[:2]) if hoi_detections is not None else None,
+            ))
+
+    def _open(self):
+        self.ann = FastDetectionAnnotator()
+        W, H = self.WH
+        self.canvas = np.zeros((2 * H, 2 * W, 3), dtype=np.uint8)
+        self.track_frame = self.canvas[:H, :W]
+        self.det_frame = self.canvas[:H, W:]
+        self.state_frame = self.canvas[H:, :W]
+        self.hoi_frame = self.canvas[H:, W:]
+        self.sink = XMemSink(self.out_dir, self.video_info)
+        self.sink.__enter__()
+
+    def _draw(self, panel, frame, detections, labels, **kw):
+        self.ann.annotate(frame, detections, labels, out=panel, **kw)
+
+    def _write(self, item):
+        with trace.span('render', frame=item[0], n=len(item[2][0])):
+            self._render(*item)
+
+    def _render(self, i, frame, track, det, hoi):
+        detections, labels, states = track
+
+        # the detection panels keep the last detection frame
+        if det is not None:
+            self._draw(self.det_frame, frame, *det)
+        if hoi is not None:
+            self._draw(self.hoi_frame, frame, *hoi)
+
+        # Draw track detections
+        self._draw(self.track_frame, frame, detections, labels, by_track=True)
+        state_labels = [
+            max(s, key=s.get) if s else ""
+            for s in (states if states is not None else [{}] * len(detections))
+        ]
+        self._draw(self.state_frame, frame, detections, state_labels, by_track=True)
+
+        # -------------------------------- Write frames ------------------------------ #
+
+        self.sink.tracks.write_frame(self.track_frame, detections, labels, i)
+        self.sink.write_frame(self.canvas)
+
+    def _close(self):
+        if self.sink is not None:
+            self.sink.__exit__(None, None, None)
+            self.sink = None
+
+
+def detectron_to_sv(outputs, classes=None):
+    outputs = outputs.to('cpu')
+    detections = sv.Detections(
+        xyxy=outputs.pred_boxes.tensor.numpy(),
+        mask=outputs.pred_masks.numpy() if outputs.has('pred_masks') else None,
+        class_id=outputs.pred_classes.int().numpy() if outputs.has('pred_classes') else np.zeros(len(outputs), dtype=int),
+        tracker_id=outputs.track_ids.int().numpy() if outputs.has('track_ids') else None,
+        confidence=outputs.scores.numpy() if outputs.has('scores') else None,
+    )
+    labels = (
+        outputs.pred_labels if outputs.has('pred_labels') else
+        np.asarray(classes)[detections.class_id] if detections.class_id is not None else
+        None)
+    return detections, labels
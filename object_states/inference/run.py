@@ -10,17 +10,20 @@ import torch
 import supervision as sv
 from object_states.inference import Perception, util
 from object_states.inference import util
-from object_states.util.video import DetectionAnnotator, XMemSink, get_video_info
+from object_states.util.video import get_video_info
 # from object_states.util.format_convert import detectron_to_sv
-from object_states.util.data_output import json_dump
+from object_states.util.data_output import JsonlWriter
 from object_states.util import eta_format as eta
 from .vocab import VOCAB
+from .checkpoint import Checkpoint
+from .render import Renderer, detectron_to_sv
 from ..util.color import green, red, blue, yellow
+from ..util import trace as tracing
 from IPython import embed
 
 
 @torch.no_grad()
-def run_one(model, src, size=480, dataset_dir=None, overwrite=False, **kw):
+def run_one(model, src, size=480, dataset_dir=None, overwrite=False, segment_size=300, checkpoint_every=900, resume=True, render=True, render_every=1, trace=False, skip_every=10, first_frame=600, **kw):
     # out_path = out_path or f'{out_dir}/{os.path.splitext(os.path.basename(src))[0]}'
     # out_path = backup_path(out_path)
     # print(out_path)
@@ -31,11 +34,24 @@ def run_one(model, src, size=480, dataset_dir=None, overwrite=False, **kw):
         'labels2': {'{name}.json': 'labels2'},
         'output_json': {'{name}_{stream_name}.json': 'output_json'},
         'track_render': {'{name}': 'tracks'},
+        'checkpoints': {'{name}.json': 'checkpoint'},
         # 'manifest.json': 'manifest',
     }, data={'name': name})
+
+    # --------------------------- Resume from checkpoint ------------------------- #
+
+    checkpoint = Checkpoint(treeA.checkpoint.format())
+    ckpt = checkpoint.load() if resume and not overwrite else None
+    if ckpt:
+        print(yellow("Resuming from frame"), ckpt['frame_index'], checkpoint.fname)
+    ckpt = ckpt or {}
+    start = ckpt.get('frame_index', -1) + 1
+    offsets = ckpt.get('outputs') or {}
+
+    # streamed to disk as we go (jsonl / eta segments), then converted to the usual files at the end
     output_json_files = {
-        'track': (treeA.output_json.format(stream_name='detic-image'), []),
-        'frame': (treeA.output_json.format(stream_name='detic-image-misc'), []),
+        'track': JsonlWriter(treeA.output_json.format(stream_name='detic-image'), append=bool(ckpt), truncate=offsets.get('track')),
+        'frame': JsonlWriter(treeA.output_json.format(stream_name='detic-image-misc'), append=bool(ckpt), truncate=offsets.get('frame')),
     }
     # embed()
 
@@ -45,28 +61,51 @@ def run_one(model, src, size=480, dataset_dir=None, overwrite=False, **kw):
             return 
     print(blue("Doing"), treeA.labels)
 
-    eta_data = eta.eta_base()
-
-    model.detector.xmem.clear_memory()
-
+    eta_data = eta.SegmentWriter(treeA.labels2.format(), segment_size=segment_size, append=bool(ckpt), after=start - 1)
+    for w in [eta_data, *output_json_files.values()]:
+        w.start()
+    model.metrics.watch_queue('eta', eta_data)
+    for k, w in output_json_files.items():
+        model.metrics.watch_queue(k, w)
+
+    # also resets the detection timer so we start (or resume) on a detection frame,
+    # and carries the checkpoint's track IDs over to the new tracks
+    model.clear_memory(ckpt.get('tracks'), ckpt.get('next_track_id'))
+    model.set_video(src)
+
+    def save_checkpoint(i):
+        for w in [eta_data, *output_json_files.values()]:
+            w.sync()
+        checkpoint.save(
+            frame_index=i,
+            outputs={k: w.tell() for k, w in output_json_files.items()},
+            **model.track_remapper.state())
+
+    # per-stage spans + memory samples (trace=True or a dict of Tracer options)
+    tracer = tracing.enable(**(trace if isinstance(trace, dict) else {})) if trace else None
+
+    completed = False
+    last_checkpoint = start
     try:
-        ann = DetectionAnnotator()
         video_info, WH, WH2 = get_video_info(src, size, ncols=2, nrows=2)
-        det_frame = hoi_frame = np.zeros((WH[1], WH[0], 3), dtype=np.uint8)
 
-        with XMemSink(str(treeA.tracks), video_info) as s:
-            pbar = tqdm.tqdm(sv.get_video_frames_generator(src), total=video_info.total_frames)
-            for i, frame in enumerate(pbar):
-                if i % 10: continue
-                if i < 600: continue
+        # draws the debug videos in the background (render=False for headless runs)
+        with Renderer(str(treeA.tracks), video_info, WH, every=render_every if render else 0) as renderer:
+            model.metrics.watch_queue('render', renderer)
+            pbar = tqdm.tqdm(sv.get_video_frames_generator(src, start=start), total=video_info.total_frames, initial=start)
+            for i, frame in enumerate(pbar, start):
+                if i % skip_every: continue
+                if i < first_frame: continue
                 frame = cv2.resize(frame, WH)
                 timestamp = i / video_info.fps
+                tracing.set_frame(i)
 
                 # ---------------------------------- Predict --------------------------------- #
 
-                track_detections, frame_detections, hoi_detections = model.predict(frame, timestamp)
+                track_detections, frame_detections, hoi_detections = model.predict(frame, timestamp, frame_index=i)
 
-                eta.add_frame(eta_data, i, eta.detectron2_objects(track_detections, frame.shape))
+                with tracing.span('write', n=len(track_detections)):
+                    eta_data.add_frame(i, eta.detectron2_objects(track_detections, frame.shape))
                 pbar.set_description(
                     f'{len(track_detections)} '
                     f'{len(frame_detections) if frame_detections is not None else None} '
@@ -74,82 +113,55 @@ def run_one(model, src, size=480, dataset_dir=None, overwrite=False, **kw):
 
                 # -------------------------------- Draw frames ------------------------------- #
 
-                # Draw frame detections
-                if frame_detections is not None:
-                    detections, labels = detectron_to_sv(frame_detections, frame.shape[:2])
-                    det_frame = ann.annotate(frame.copy(), detections, labels)
-
-                # Draw HOI Detections
-                if hoi_detections is not None:
-                    detections, labels = detectron_to_sv(hoi_detections, frame.shape[:2])
-                    hoi_frame = ann.annotate(frame.copy(), detections, labels)
-
-                # Draw track detections
-                detections, labels = detectron_to_sv(track_detections, frame.shape[:2])
-                track_frame = ann.annotate(frame.copy(), detections, labels, by_track=True)
-                # print(track_detections.pred_states)
-                # if hasattr(track_detections, 'pred_states'):
-                state_labels = pd.Series([
-                    row.idxmax() if len(row.dropna()) else ""
-                    for i, row in pd.DataFrame(list(track_detections.pred_states)).iterrows()
-                ])
-                # print(labels)
-                keep = ~pd.isna(state_labels)
-                state_detections = detections[keep]
-                state_labels = state_labels[keep].tolist()
-                state_frame = ann.annotate(frame.copy(), state_detections, state_labels, by_track=True)
-                # else:
-                #     state_frame = frame.copy()
-
-                # -------------------------------- Write frames ------------------------------ #
-
-                s.tracks.write_frame(track_frame, detections, labels, i)
-                s.write_frame(np.vstack([
-                    np.hstack([track_frame, det_frame]),
-                    np.hstack([state_frame, hoi_frame])
-                ]))
+                renderer.render(i, frame, track_detections, frame_detections, hoi_detections)
 
                 # ----------------------------- Serialize outputs ---------------------------- #
 
                 meta = { 'timestamp': timestamp, 'image_shape': list(frame.shape) }
 
                 # write out track predictions
-                track_data = model.serialize_detections(track_detections, frame.shape)
-                output_json_files['track'][1].append({ **meta, 'objects': track_data })
+                with tracing.span('serialize', n=len(track_detections)):
+                    track_data = model.serialize_detections(track_detections, frame.shape)
+                with tracing.span('write'):
+                    output_json_files['track'].write({ **meta, 'objects': track_data })
                 
                 # write out frame predictions
                 frame_data = []
-                if frame_detections is not None:
-                    frame_data += track_data
-                    frame_data += model.serialize_detections(frame_detections, frame.shape)
-                if hoi_detections is not None:
-                    frame_data += model.serialize_detections(hoi_detections, frame.shape)
+                with tracing.span('serialize'):
+                    if frame_detections is not None:
+                        frame_data += track_data
+                        frame_data += model.serialize_detections(frame_detections, frame.shape)
+                    if hoi_detections is not None:
+                        frame_data += model.serialize_detections(hoi_detections, frame.shape)
+                    tracing.annotate(n=len(frame_data))
                 if frame_data:
-                    output_json_files['frame'][1].append({ **meta, 'objects': frame_data })
+                    with tracing.span('write'):
+                        output_json_files['frame'].write({ **meta, 'objects': frame_data })
+
+                # ------------------------------ Checkpoint ---------------------------- #
+
+                if checkpoint_every and i - last_checkpoint >= checkpoint_every:
+                    save_checkpoint(i)
+                    last_checkpoint = i
+        completed = True
     finally:
         # -------------------------- Write out final outputs ------------------------- #
 
-        eta.save(eta_data, treeA.labels2.format())
-        for fname, data in output_json_files.values():
-            print(yellow('Writing'), fname)
-            json_dump(fname, data)
-
+        # if we crashed, leave the partial outputs + checkpoint so we can resume
+        eta_data.close(finalize=completed)
+        for w in output_json_files.values():
+            if completed:
+                print(yellow('Writing'), w.fname)
+            w.close(finalize=completed)
+        if completed:
+            checkpoint.remove()
+        if model.detector.stage_cache.enabled:
+            print(model.detector.stage_cache)
+        if tracer is not None:
+            tracing.disable()
+            tracer.report(dataset_dir or f'output/{name}', f'{name}_trace')
 
 
-def detectron_to_sv(outputs, classes=None):
-    outputs = outputs.to('cpu')
-    detections = sv.Detections(
-        xyxy=outputs.pred_boxes.tensor.numpy(),
-        mask=outputs.pred_masks.numpy() if outputs.has('pred_masks') else None,
-        class_id=outputs.pred_classes.int().numpy() if outputs.has('pred_classes') else np.zeros(len(outputs), dtype=int),
-        tracker_id=outputs.track_ids.int().numpy() if outputs.has('track_ids') else None,
-        confidence=outputs.scores.numpy() if outputs.has('scores') else None,
-    )
-    labels = (
-        outputs.pred_labels if outputs.has('pred_labels') else 
-        np.asarray(classes)[detections.class_id] if detections.class_id is not None else 
-        None)
-    return detections, labels
 
 
 
@@ -158,7 +170,8 @@ import ipdb
 @ipdb.iex
 def run(*srcs, 
         tracked_vocab=None, state_db=None, vocab=VOCAB, additional_roi_heads=None, detic_config_key=None, detect_every=0.5, conf_threshold=0.3, 
-        custom_state_clsf_fname=None,
+        custom_state_clsf_fname=None, compile_state_clsfs=False, cpu_profile=None, clip_precision='fp32',
+        state_features='clip', detic_feature_max_age=None, state_budget=None, track_width=None, governor=None, metrics=None, stage_cache=None,
         **kw):
     if tracked_vocab is not None:
         vocab['tracked'] = tracked_vocab
@@ -168,16 +181,30 @@ def run(*srcs,
         state_db_fname=state_db,
         state_key='mod_state',
         custom_state_clsf_fname=custom_state_clsf_fname,
+        compile_state_clsfs=compile_state_clsfs,
         additional_roi_heads=additional_roi_heads,
         detic_config_key=detic_config_key,
         detect_every_n_seconds=detect_every,
         conf_threshold=conf_threshold,
         filter_tracked_detections_from_frame=False,
+        cpu_profile=cpu_profile,
+        clip_precision=clip_precision,
+        state_features=state_features,
+        detic_feature_max_age=detic_feature_max_age,
+        state_budget=state_budget,
+        track_width=track_width,
+        governor=governor,
+        metrics=metrics,
+        stage_cache=stage_cache,
     )
-    for f in srcs:
-        f = glob.glob(os.path.join(f, '*')) if os.path.isdir(f) else [f]
-        for fi in f:
-            run_one(model, fi, **kw)
+    try:
+        for f in srcs:
+            f = glob.glob(os.path.join(f, '*')) if os.path.isdir(f) else [f]
+            for fi in f:
+                run_one(model, fi, **kw)
+    finally:
+        # final write of the metrics file
+        model.metrics.close()
 
 def main(*a, profile=False, **kw):
     import sys
@@ -16,6 +16,7 @@ from .config import get_cfg
 from .util.video import XMemSink, DetectionAnnotator, iter_video
 from .util.format_convert import *
 from .util.vocab import prepare_vocab
+from .util.stage_cache import StageCache, config_hash, get_instances, put_instances
 
 from xmem import XMem
 from detic import Detic
@@ -28,13 +29,18 @@ from IPython import embed
 log = logging.getLogger(__name__)
 
 device = 'cuda'
+# detic resizes its input so the longest side is at most this
+DETIC_MAX_SIZE = 500
 
 import ipdb
 @ipdb.iex
 @torch.no_grad()
-def main(config_fname, *files_to_predict, field=None, detect=None, stop_detect_after=None, skip_every=1, file_path=None):
+def main(config_fname, *files_to_predict, field=None, detect=None, stop_detect_after=None, skip_every=1, file_path=None, stage_cache=None):
     cfg = get_cfg(config_fname)
     print(cfg)
+
+    # detic/egohos outputs are shared between configs that only change tracking (see util/stage_cache.py)
+    cache = StageCache.from_config(stage_cache or cfg.DATASET.get('STAGE_CACHE'))
     
     root_dataset_dir = dataset_dir = cfg.DATASET.ROOT
     video_pattern = cfg.DATASET.VIDEO_PATTERN
@@ -98,33 +104,13 @@ def main(config_fname, *files_to_predict, field=None, detect=None, stop_detect_a
     detect_every_secs = cfg.DETIC.DETECT_EVERY_SECS
     hoi_detect_every = 3
 
-    if isinstance(cfg.DATA.UNTRACKED_VOCAB, str):
-        # PROMPTS = cfg.DATA.UNTRACKED_VOCAB
-        # VOCAB = None
-        tracked_prompts, TRACKED_VOCAB = prepare_vocab(cfg.DATA.VOCAB)
-        _, meta, _ = load_classifier(cfg.DATA.UNTRACKED_VOCAB)
-        PROMPTS = list(meta.thing_classes) + [p for p in tracked_prompts if p not in meta.thing_classes]
-        VOCAB = list(meta.thing_classes) + [TRACKED_VOCAB[i] for i, p in enumerate(tracked_prompts) if p not in meta.thing_classes]
-    else:
-        untracked_prompts, UNTRACKED_VOCAB = prepare_vocab(cfg.DATA.UNTRACKED_VOCAB)
-        tracked_prompts, TRACKED_VOCAB = prepare_vocab(cfg.DATA.VOCAB)
-        PROMPTS = list(untracked_prompts) + list(tracked_prompts)
-        VOCAB = list(UNTRACKED_VOCAB) + list(TRACKED_VOCAB)
-        print("Prompts:")
-        for p, v in zip(PROMPTS, VOCAB):
-            print(v, ':', p)
-        # input()
+    PROMPTS, VOCAB, TRACKED_VOCAB = get_vocab(cfg)
 
     # object detector
-    detic = Detic(PROMPTS, conf_threshold=CONFIDENCE, masks=True, max_size=500).cuda().eval()
-    if VOCAB is not None:
-        detic.labels = np.array(VOCAB)
-    print(detic.labels)
-    assert not (set(TRACKED_VOCAB) - set(detic.labels)), f"these tracked labels dont exist: {set(TRACKED_VOCAB) - set(detic.labels)}"
-
-    # hand-object interactions
-    egohos = EgoHos(mode='obj1', device=device).cuda().eval()
+    detic, egohos = load_detectors(cfg, PROMPTS, VOCAB, TRACKED_VOCAB)
     egohos_classes = np.array(list(egohos.CLASSES))
+    identities = stage_identities(cfg, PROMPTS, detic.labels)
+    detic_identity, egohos_identity = identities['detic'], identities['egohos']
 
     # ---------------------------- Load object tracker --------------------------- #
 
@@ -174,6 +160,7 @@ def main(config_fname, *files_to_predict, field=None, detect=None, stop_detect_a
                 xmem.clear_memory(reset_index=True)
                 xmem.track_detections.clear()
                 xmem.label_counts.clear()
+                cache.set_video(video_path)
 
                 # ----------------------------- Loop over frames ----------------------------- #
 
@@ -196,12 +183,12 @@ def main(config_fname, *files_to_predict, field=None, detect=None, stop_detect_a
                         dets = hoi_dets = None
                         if not stop_detect_after or i < stop_detect_after:
                             if detect and not i % detect_every:
-                                hoi_dets = do_egohos(egohos, frame)
+                                hoi_dets = do_egohos(egohos, frame, cache=cache, identity=egohos_identity, frame_index=i)
                                 finfo['hoi'] = hoi_dets
                                 detections, labels = fo_to_sv(hoi_dets, frame.shape[:2], classes=egohos.CLASSES)
                                 hoi_frame = ann.annotate(frame.copy(), detections, labels)
 
-                                dets = do_detect(detic, frame)
+                                dets = do_detect(detic, frame, cache=cache, identity=detic_identity, frame_index=i)
                                 finfo[field] = dets
                                 detections, labels = fo_to_sv(dets, frame.shape[:2], classes=detic.labels)
                                 det_frame = ann.annotate(frame.copy(), detections, labels)
@@ -240,6 +227,8 @@ def main(config_fname, *files_to_predict, field=None, detect=None, stop_detect_a
         except KeyboardInterrupt:
             pass
         finally:
+            if cache.enabled:
+                log.info("%s", cache)
             # ------------------------------ Export dataset ------------------------------ #
             print("aaaaaaaaa")
             view.export(
@@ -275,14 +264,82 @@ def main(config_fname, *files_to_predict, field=None, detect=None, stop_detect_a
         # embed()
 
 
+# ---------------------------------------------------------------------------- #
+#                                Loading Models                                #
+# ---------------------------------------------------------------------------- #
+
+
+def get_vocab(cfg):
+    '''Get the detic prompts, their labels, and the tracked labels from a config.'''
+    if isinstance(cfg.DATA.UNTRACKED_VOCAB, str):
+        # PROMPTS = cfg.DATA.UNTRACKED_VOCAB
+        # VOCAB = None
+        tracked_prompts, TRACKED_VOCAB = prepare_vocab(cfg.DATA.VOCAB)
+        _, meta, _ = load_classifier(cfg.DATA.UNTRACKED_VOCAB)
+        PROMPTS = list(meta.thing_classes) + [p for p in tracked_prompts if p not in meta.thing_classes]
+        VOCAB = list(meta.thing_classes) + [TRACKED_VOCAB[i] for i, p in enumerate(tracked_prompts) if p not in meta.thing_classes]
+    else:
+        untracked_prompts, UNTRACKED_VOCAB = prepare_vocab(cfg.DATA.UNTRACKED_VOCAB)
+        tracked_prompts, TRACKED_VOCAB = prepare_vocab(cfg.DATA.VOCAB)
+        PROMPTS = list(untracked_prompts) + list(tracked_prompts)
+        VOCAB = list(UNTRACKED_VOCAB) + list(TRACKED_VOCAB)
+        print("Prompts:")
+        for p, v in zip(PROMPTS, VOCAB):
+            print(v, ':', p)
+        # input()
+    return PROMPTS, VOCAB, TRACKED_VOCAB
+
+
+def load_detectors(cfg, PROMPTS, VOCAB, TRACKED_VOCAB):
+    # object detector
+    detic = Detic(PROMPTS, conf_threshold=cfg.DETIC.CONFIDENCE, masks=True, max_size=DETIC_MAX_SIZE).cuda().eval()
+    if VOCAB is not None:
+        detic.labels = np.array(VOCAB)
+    print(detic.labels)
+    assert not (set(TRACKED_VOCAB) - set(detic.labels)), f"these tracked labels dont exist: {set(TRACKED_VOCAB) - set(detic.labels)}"
+
+    # hand-object interactions
+    egohos = EgoHos(mode='obj1', device=device).cuda().eval()
+    return detic, egohos
+
+
+def stage_identities(cfg, PROMPTS, labels):
+    '''The stage cache identities of the detic/egohos outputs for a config (see util/stage_cache.py).'''
+    return {
+        'detic': {
+            'model': 'detic', 'source': 'predict', 'conf_threshold': cfg.DETIC.CONFIDENCE, 'max_size': DETIC_MAX_SIZE,
+            'vocab': config_hash(PROMPTS, list(labels)),
+        },
+        'egohos': {'model': 'egohos', 'mode': 'obj1'},
+    }
+
+
+def frame_identity(identity, shape, **kw):
+    return {**(identity or {}), 'shape': tuple(shape), **kw}
+
+
 # ---------------------------------------------------------------------------- #
 #                                Running Models                                #
 # ---------------------------------------------------------------------------- #
 
 
-def do_egohos(model, frame):
-    # get hoi detections
+def egohos_masks(model, frame, cache=None, identity=None, frame_index=None):
+    '''Get the egohos masks and class ids (from the stage cache if it has them).'''
+    identity = frame_identity(identity, frame.shape)
+    data = cache.get('egohos', identity, frame_index) if cache is not None and frame_index is not None else None
+    if data is not None:
+        return torch.as_tensor(data['masks'], device=device), data['class_ids']
     masks, class_ids = model(frame)
+    if cache is not None and frame_index is not None:
+        cache.put('egohos', identity, frame_index, {
+            'masks': masks.cpu().numpy(), 
+            'class_ids': class_ids.cpu().numpy() if torch.is_tensor(class_ids) else np.asarray(class_ids)})
+    return masks, class_ids
+
+
+def do_egohos(model, frame, cache=None, identity=None, frame_index=None):
+    # get hoi detections
+    masks, class_ids = egohos_masks(model, frame, cache, identity, frame_index)
     boxes = xyxy2xywhn(masks_to_boxes(masks), frame.shape).cpu().numpy().tolist()
     if len(class_ids):
         log.info(f"HOS: {model.CLASSES[class_ids]}")
@@ -296,8 +353,18 @@ def do_egohos(model, frame):
     ])
 
 
-def do_detect(model, frame, track_labels=None, iou_threshold=0.85):
+def do_detect(model, frame, track_labels=None, iou_threshold=0.85, cache=None, identity=None, frame_index=None):
+    instances = detect_instances(model, frame, track_labels, iou_threshold, cache, identity, frame_index)
+    return detectron_to_fo({'instances': instances}, model.labels, frame.shape)
+
+
+def detect_instances(model, frame, track_labels=None, iou_threshold=0.85, cache=None, identity=None, frame_index=None):
+    '''Get the (filtered) detic instances (from the stage cache if it has them).'''
     labels = model.labels
+    identity = frame_identity(identity, frame.shape, track_labels=track_labels, iou_threshold=iou_threshold)
+    instances = get_instances(cache, 'detic', identity, frame_index) if cache is not None else None
+    if instances is not None:
+        return instances
     outputs = model(frame)
     # selected_indices, _ = asymmetric_nms(outputs['instances'].pred_boxes.tensor, outputs['instances'].scores)
     # filtered = set(range(len(outputs['instances']))) - set(selected_indices.tolist())
@@ -342,46 +409,71 @@ def do_detect(model, frame, track_labels=None, iou_threshold=0.85):
             filtered_instances.pred_masks[i] |= torch.maximum(
                 filtered_instances.pred_masks[i], 
                 overlap_insts.pred_masks.max(0).values)
-    outputs['instances'] = filtered_instances
+    if cache is not None:
+        put_instances(cache, 'detic', identity, frame_index, filtered_instances)
+
+    log.debug(f"Detected: {labels[filtered_instances.pred_classes.int().cpu().numpy()]}")
+    return filtered_instances
+
 
-    log.debug(f"Detected: {labels[outputs['instances'].pred_classes.int().cpu().numpy()]}")
-    return detectron_to_fo(outputs, labels, frame.shape)
+HANDS = ['hand(left)', 'hand(right)']
+
+
+def xmem_frame(frame, width):
+    '''Resize a frame to the tracking width.'''
+    ho, wo = frame.shape[:2]
+    h, w = int(width / wo * ho), int(width)
+    return cv2.resize(frame, (w, h))
+
+
+def xmem_step(xmem, frame, gt_mask=None, gt_labels=None, neg_masks=()):
+    '''Track one (resized) frame and count the labels of the new detections (``xmem.label_counts``).
+
+    Arguments:
+        gt_mask (torch.Tensor): (n, h, w) masks of the detections to track, if it's a detection frame.
+        gt_labels (list): The detections' labels.
+        neg_masks (list): (n, h, w) masks (or None) that shouldn't be tracked (hands, untracked objects).
+
+    Returns:
+        pred_mask, track_ids, input_track_ids: see ``XMem.__call__``.
+    '''
+    neg_mask = None
+    for m in neg_masks:
+        if m is None:
+            continue
+        m = m.any(0)
+        if m.any():
+            neg_mask = m if neg_mask is None else neg_mask | m
+
+    pred_mask, track_ids, input_track_ids = xmem(frame, gt_mask, negative_mask=neg_mask, only_confirmed=True)
+    log.debug(f"Tracks: {track_ids} input tracks: {input_track_ids}")
+    if gt_mask is not None:
+        for tid, label in zip(input_track_ids, gt_labels):
+            xmem.label_counts[tid].update([label])
+    return pred_mask, track_ids, input_track_ids
 
 
 def do_xmem(xmem, frame, gt, gt_hoi, track_labels=None, width=280):
     # ------------------------------- Resize frame ------------------------------- #
 
     ho, wo = frame.shape[:2]
-    h, w = int(width / wo * ho), int(width)
-    frame = cv2.resize(frame, (w, h))
+    frame = xmem_frame(frame, width)
+    h, w = frame.shape[:2]
 
     # ----------------------- Load detections from FiftyOne ---------------------- #
 
     gt_mask, gt_labels, dets, neg_gt_mask = get_masks_and_labels(gt, (wo,ho), (w, h), track_labels, return_neg_mask=True)
-    hoi_mask, _, _ = get_masks_and_labels(gt_hoi, (wo,ho), (w, h), ['hand(left)', 'hand(right)'])
-    neg_mask = None
-    if hoi_mask is not None:
-        hoi_mask = hoi_mask.sum(0)
-        if hoi_mask.float().sum() > 0:
-            neg_mask = hoi_mask
-    if neg_gt_mask is not None:
-        neg_gt_mask = neg_gt_mask.sum(0)
-        if neg_gt_mask.float().sum() > 0:
-            neg_mask = neg_gt_mask if neg_mask is None else neg_gt_mask | neg_mask
-    
+    hoi_mask, _, _ = get_masks_and_labels(gt_hoi, (wo,ho), (w, h), HANDS)
 
     # ------------------------------- Track objects ------------------------------ #
 
-    pred_mask, track_ids, input_track_ids = xmem(frame, gt_mask, negative_mask=neg_mask, only_confirmed=True)
+    pred_mask, track_ids, input_track_ids = xmem_step(xmem, frame, gt_mask, gt_labels, [hoi_mask, neg_gt_mask])
     boxes = masks_to_boxes(pred_mask)
     boxes = xyxy2xywhn(boxes, frame.shape).tolist()
-    log.debug(f"Tracks: {track_ids} input tracks: {input_track_ids}")
 
     if gt_mask is not None:
         for tid, det in zip(input_track_ids, dets):
             xmem.track_detections[tid] = det
-        for tid, label in zip(input_track_ids, gt_labels):
-            xmem.label_counts[tid].update([label])
 
     # ------------------------- Convert back to FiftyOne ------------------------- #
     
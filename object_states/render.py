@@ -1,36 +1,139 @@
+'''Render review videos for a dataset from its ETA labels.
+
+This reads the manifest and ETA label JSON directly (no FiftyOne / Mongo). Each video
+is split into frame ranges that are rendered by a process pool and the encoded segments
+are concatenated at the end.
+
+usage: python -m object_states.render /datasets/annotation_final --stride 2 --size 360 --workers 8
+'''
 import os
+import shutil
+import bisect
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import cv2
 import tqdm
-import fiftyone as fo
 import supervision as sv
-from .util.video import XMemSink, iter_video
-from .util.format_convert import fo_to_sv
 
-import ipdb
-@ipdb.iex
-def main(dataset_dir, field='detections_tracker'):
-    
-    # ------------------------------- Load dataset ------------------------------- #
+from .util import eta_format as eta
+from .util.video import FastDetectionAnnotator, VideoSink, concat_videos
+from .util.color import green, blue
+
+
+def output_size(width, height, size=None):
+    # keep the aspect ratio, and make it even so the encoder is happy
+    if not size:
+        return width // 2 * 2, height // 2 * 2
+    return int(width * size / height) // 2 * 2, int(size) // 2 * 2
+
+
+def split_frames(labels, total_frames, chunk_size=1800, stride=1):
+    '''Split a video into frame ranges, with the label frames each range needs.'''
+    frames = labels.get('frames') or {}
+    keys = sorted(int(k) - 1 for k in frames)
+    chunks = []
+    for start in range(0, total_frames, chunk_size):
+        end = min(start + chunk_size, total_frames)
+        # include the last labeled frame before the chunk so we can hold it
+        i0 = max(bisect.bisect_right(keys, start) - 1, 0)
+        i1 = bisect.bisect_right(keys, end)
+        chunk_frames = {str(k + 1): frames[str(k + 1)] for k in keys[i0:i1]}
+        chunks.append((start, end, stride, {'frames': chunk_frames}))
+    return chunks
+
+
+def render_segment(video_path, out_path, start, end, stride, labels, size=None):
+    '''Render frames [start, end) of a video. Frames without labels show the last labeled frame.'''
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30
+    W, H = output_size(int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), size)
+    # keep the first frame of each segment on the stride grid so the segments line up
+    start = -(-start // stride) * stride
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+    keys = sorted(int(k) - 1 for k in labels['frames'])
+    ann = FastDetectionAnnotator()
+    info = sv.VideoInfo(width=W, height=H, fps=fps / stride)
+    n = 0
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    with VideoSink(out_path, info) as s:
+        for i in range(start, end):
+            if (i - start) % stride:
+                if not cap.grab():
+                    break
+                continue
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frame = cv2.resize(frame, (W, H))
+
+            j = bisect.bisect_right(keys, i) - 1
+            if j >= 0:
+                detections, labels_ = eta.get_sv_detections(labels, keys[j], frame.shape)
+                if len(detections):
+                    names = [f'{t} {l}' for t, l in zip(detections.tracker_id, labels_)]
+                    frame = ann.annotate(frame, detections, names, by_track=True)
+            s.write_frame(frame)
+            n += 1
+    cap.release()
+    return out_path, n
+
+
+def finish_video(out_path, parts_dir, futures):
+    fs = [f for f, n in (f.result() for f in futures) if n]
+    concat_videos(fs, out_path)
+    shutil.rmtree(parts_dir)
+    tqdm.tqdm.write(f"{green('Wrote')} {out_path}")
 
-    dataset = fo.Dataset.from_dir(
-        dataset_dir=dataset_dir,
-        dataset_type=fo.types.FiftyOneVideoLabelsDataset,
-    )
 
-    view = dataset.view()
-    view.compute_metadata(overwrite=True)
+def main(dataset_dir, out_dir=None, stride=1, size=None, workers=None, chunk_size=1800, match=None, overwrite=False, max_queued_videos=2):
+    '''Render a review video for every video in a dataset.
 
-    for sample in tqdm.tqdm(view):
+    Arguments:
+        dataset_dir (str): The dataset with ``manifest.json`` and ``labels/``.
+        out_dir (str): Where to write the videos. Defaults to ``{dataset_dir}/track_render``.
+        stride (int): Render every Nth frame.
+        size (int): The output height. Defaults to the video's size.
+        workers (int): The number of rendering processes.
+        chunk_size (int): The number of source frames per segment.
+        match (str): Only render videos with this in their path.
+        max_queued_videos (int): How many videos can be queued at once. This bounds the
+            memory used by the queued labels.
+    '''
+    out_dir = out_dir or f'{dataset_dir}/track_render'
+    manifest = eta.load(eta.manifest_fname(dataset_dir))
 
-        video_path = sample.filepath
-        video_info = sv.VideoInfo.from_video_path(video_path=video_path)
-        out_path = f'{dataset_dir}/track_render/{os.path.basename(video_path)}.mp4'
+    jobs = deque()
+    with ProcessPoolExecutor(workers) as pool:
+        # submit the segments of the next videos while the current one finishes so the pool stays busy
+        for sample in tqdm.tqdm(manifest['index'], desc='videos'):
+            video_path = sample['data']
+            if match and match not in video_path:
+                continue
+            out_path = f'{out_dir}/{os.path.basename(video_path)}'
+            if os.path.isfile(out_path) and not overwrite:
+                tqdm.tqdm.write(f"{green('Already exists!')} {out_path}")
+                continue
+            if not os.path.isfile(sample['labels']):
+                tqdm.tqdm.write(f"Missing labels: {sample['labels']}")
+                continue
+            labels = eta.load(sample['labels'])
+            total_frames = sv.VideoInfo.from_video_path(video_path).total_frames
+            parts_dir = f'{out_path}.parts'
+            futures = [
+                pool.submit(render_segment, video_path, f'{parts_dir}/{k:05d}.mp4', start, end, stride_, chunk, size)
+                for k, (start, end, stride_, chunk) in enumerate(split_frames(labels, total_frames, chunk_size, stride))
+            ]
+            del labels
+            jobs.append((out_path, parts_dir, futures))
+            tqdm.tqdm.write(f"{blue('Queued')} {out_path} {len(futures)} segments")
+            while len(jobs) > max_queued_videos:
+                finish_video(*jobs.popleft())
 
-        with XMemSink(out_path, video_info) as s:
-            for i, frame, finfo in iter_video(sample):
-                detections, labels = fo_to_sv(finfo[field])
-                s.write_frame(frame, detections, labels)
+        while jobs:
+            finish_video(*jobs.popleft())
 
 
 if __name__ == '__main__':
     import fire
-    fire.Fire(main)
\ No newline at end of file
+    fire.Fire(main)
@@ -0,0 +1,379 @@
+'''Run a grid of predict.py configs over the same videos, decoding and detecting each video once.
+
+usage:
+    python -m object_states.sweep config/xmem_eval/base.yaml \
+        --grid '{"XMEM.FRAME_SIZE": [140, 280, 420, 700], "XMEM.CONFIG.min_iou": [0.4, 0.7]}' --workers 4
+    python -m object_states.sweep config/detic_rate/base.yaml --grid '{"DETIC.DETECT_EVERY_SECS": [0.25, 0.5, 1, 2]}'
+    python -m object_states.sweep --configs 'config/xmem_eval/frame_size_*.yaml' --gt /datasets/xmem_eval_gt
+
+Each video is decoded once into shared memory. Detic and EgoHOS run once on every frame that any
+config detects on and are stored in the stage cache (see ``util/stage_cache.py``), so configs that
+only differ in tracking (or detection rate) share them. Then every config's tracker runs in its
+own process from the shared frames.
+
+Each config writes ``labels/{video}.json`` (ETA), ``manifest.json`` and ``config.yaml`` to
+``{out_dir}/{config name}`` (``DATASET.ROOT`` for ``--configs``), plus ``{out_dir}/sweep_timing.csv``.
+'''
+import os
+import glob
+import time
+import shutil
+import itertools
+import logging
+from collections import Counter, defaultdict
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import cv2
+import tqdm
+import numpy as np
+import pandas as pd
+import supervision as sv
+
+from .config import get_cfg
+from .util import eta_format as eta
+from .util.stage_cache import StageCache, config_hash
+
+log = logging.getLogger(__name__)
+
+# see predict.DETIC_MAX_SIZE (predict.py imports the models, so it's not imported here)
+DETIC_MAX_SIZE = 500
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Configs                                   #
+# ---------------------------------------------------------------------------- #
+
+
+def expand_grid(grid):
+    '''{key: [values]} -> [{key: value}] for every combination.'''
+    grid = {k: v if isinstance(v, (list, tuple)) else [v] for k, v in (grid or {}).items()}
+    return [dict(zip(grid, vs)) for vs in itertools.product(*grid.values())]
+
+
+def config_name(overrides):
+    return '_'.join(f'{k.split(".")[-1]}={v}' for k, v in overrides.items()) or 'base'
+
+
+def apply_overrides(cfg, overrides):
+    for key, value in overrides.items():
+        *parents, last = key.split('.')
+        node = cfg
+        for k in parents:
+            node = node[k]
+        node[last] = value
+    return cfg
+
+
+def detection_key(cfg):
+    '''Configs with the same key have the same detections (only the detection rate and tracking can differ).'''
+    detic = {k: v for k, v in cfg.DETIC.items() if k not in ('DETECT_EVERY_SECS', 'DETECT_EVERY')}
+    return config_hash(detic, cfg.DATA)
+
+
+def working_size(video_info, cfgs):
+    '''The frame height to decode at: big enough for Detic and every config's tracking width, but no bigger than the video.'''
+    H, W = video_info.height, video_info.width
+    scale = max(DETIC_MAX_SIZE / max(H, W), *(cfg.XMEM.FRAME_SIZE / W for cfg in cfgs))
+    return int(round(H * min(scale, 1)))
+
+
+def detect_frames(cfg, fps, n_frames):
+    '''The (1-based) frames that predict.py would detect on.'''
+    detect_every = max(int(cfg.DETIC.DETECT_EVERY_SECS * fps), 1)
+    return set(range(detect_every, n_frames + 1, detect_every))
+
+
+# ---------------------------------------------------------------------------- #
+#                                 Shared frames                                #
+# ---------------------------------------------------------------------------- #
+
+
+class SharedFrames:
+    '''A (n, H, W, 3) uint8 frame array in shared memory.
+
+    Arguments:
+        shape (tuple): The array shape.
+        name (str): Attach to an existing block (in a worker) instead of creating one.
+    '''
+    def __init__(self, shape, name=None):
+        self.shape = tuple(shape)
+        self.owner = name is None
+        if self.owner and os.path.isdir('/dev/shm'):
+            size, free = int(np.prod(self.shape)), shutil.disk_usage('/dev/shm').free
+            assert size < free, (
+                f"{self.shape} frames need {size / 2**30:.1f}GB of shared memory but only {free / 2**30:.1f}GB is free. "
+                "Use a smaller --size or --max_frames.")
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=int(np.prod(self.shape)))
+        self.array = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @classmethod
+    def from_video(cls, path, size=None, max_frames=None, cfgs=()):
+        '''Decode a video into shared memory, resized to ``size`` height (default: the ``working_size`` for ``cfgs``).'''
+        info = sv.VideoInfo.from_video_path(path)
+        n = min(info.total_frames, max_frames or info.total_frames)
+        H, W = info.height, info.width
+        size = size or working_size(info, cfgs)
+        if size != H:
+            H, W = int(size), int(round(info.width * size / info.height))
+        self = cls((n, H, W, 3))
+        i = 0
+        for frame in sv.get_video_frames_generator(path):
+            if i >= n:
+                break
+            self.array[i] = cv2.resize(frame, (W, H)) if frame.shape[:2] != (H, W) else frame
+            i += 1
+        if i < n:  # the header over-counted, the rest are left black
+            log.warning("%s: decoded %d/%d frames", path, i, n)
+        self.fps = info.fps
+        return self
+
+    def close(self):
+        del self.array
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        self.close()
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Detection                                  #
+# ---------------------------------------------------------------------------- #
+
+
+class Detectors:
+    '''The detic + egohos models for a group of configs that share detections.'''
+    def __init__(self, cfg):
+        from .predict import get_vocab, load_detectors, stage_identities
+        self.cfg = cfg
+        prompts, vocab, self.tracked_vocab = get_vocab(cfg)
+        self.detic, self.egohos = load_detectors(cfg, prompts, vocab, self.tracked_vocab)
+        self.identities = stage_identities(cfg, prompts, self.detic.labels)
+
+    def info(self):
+        '''What the trackers need to know about the detections (picklable).'''
+        return self.identities, list(self.detic.labels), list(self.tracked_vocab), list(self.egohos.CLASSES)
+
+    def __call__(self, frames, frame_ids, cache, desc=None):
+        '''Run detic + egohos on the frames (1-based) that aren't in the stage cache yet.'''
+        import torch
+        from .predict import detect_instances, egohos_masks
+        with torch.no_grad():
+            for i in tqdm.tqdm(sorted(frame_ids), desc=desc):
+                frame = frames[i - 1]
+                egohos_masks(self.egohos, frame, cache=cache, identity=self.identities['egohos'], frame_index=i)
+                detect_instances(self.detic, frame, cache=cache, identity=self.identities['detic'], frame_index=i)
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Tracking                                   #
+# ---------------------------------------------------------------------------- #
+
+
+def track_video(cfg_str, video_name, shm_name, shape, fps, video_id, cache_root, models, out_dir):
+    '''Track one video with one config (in a worker process). Returns the timing.'''
+    import torch
+    from xmem import XMem
+    from fvcore.common.config import CfgNode
+    from .predict import frame_identity
+    cfg = CfgNode.load_cfg(cfg_str)
+    identities, labels, tracked_vocab, egohos_classes = models
+    cache = StageCache(cache_root, readonly=True)
+    cache.set_video(video_id, content_hash=False)
+    t0 = time.perf_counter()
+    xmem = XMem(cfg.XMEM.CONFIG).cuda().eval()
+    xmem.label_counts = defaultdict(Counter)
+    t_load = time.perf_counter() - t0
+
+    frames = SharedFrames(shape, name=shm_name)
+    try:
+        n = len(frames.array)
+        detect = detect_frames(cfg, fps, n)
+        width = cfg.XMEM.FRAME_SIZE
+        eta_labels = eta.eta_base()
+        confidence = {}
+        t_track = t_io = 0
+        with torch.no_grad():
+            for i in range(1, n + 1):
+                frame = frames.array[i - 1]
+                dets = hoi = None
+                if i in detect:
+                    t = time.perf_counter()
+                    dets = cache.get('detic', frame_identity(identities['detic'], frame.shape, track_labels=None, iou_threshold=0.85), i)
+                    hoi = cache.get('egohos', frame_identity(identities['egohos'], frame.shape), i)
+                    t_io += time.perf_counter() - t
+                t = time.perf_counter()
+                objects = track_frame(xmem, frame, dets, hoi, labels, tracked_vocab, egohos_classes, width, confidence)
+                t_track += time.perf_counter() - t
+                eta.add_frame(eta_labels, i - 1, objects)
+    finally:
+        frames.close()
+
+    t = time.perf_counter()
+    eta.save(eta_labels, eta.label_fname(out_dir, video_name))
+    t_io += time.perf_counter() - t
+    return {
+        'video': video_name, 'frames': n,
+        'fps': n / t_track if t_track else None,
+        'load_s': t_load, 'track_s': t_track, 'io_s': t_io,
+    }
+
+
+def track_frame(xmem, frame, dets, hoi, labels, tracked_vocab, egohos_classes, width, confidence):
+    '''predict.do_xmem, from stage cache arrays instead of FiftyOne detections.'''
+    import torch
+    import torch.nn.functional as F
+    from torchvision.ops import masks_to_boxes
+    from .predict import xmem_frame, xmem_step, HANDS
+    small = xmem_frame(frame, width)
+    h, w = small.shape[:2]
+    resize = lambda m: F.interpolate(torch.as_tensor(m).cuda()[None].float(), (h, w), mode='nearest')[0].bool()
+
+    gt_mask = gt_labels = gt_scores = neg_mask = hand_mask = None
+    if dets is not None and len(dets['pred_masks']):
+        det_labels = np.asarray(labels)[dets['pred_classes'].astype(int)]
+        tracked = np.isin(det_labels, tracked_vocab)
+        if tracked.any():
+            gt_mask = resize(dets['pred_masks'][tracked])
+            gt_labels, gt_scores = det_labels[tracked], dets['scores'][tracked]
+        if (~tracked).any():
+            neg_mask = resize(dets['pred_masks'][~tracked])
+    if hoi is not None and len(hoi['masks']):
+        hands = np.isin(np.asarray(egohos_classes)[hoi['class_ids']], HANDS)
+        if hands.any():
+            hand_mask = resize(hoi['masks'][hands])
+
+    pred_mask, track_ids, input_track_ids = xmem_step(xmem, small, gt_mask, gt_labels, [hand_mask, neg_mask])
+    if gt_mask is not None:
+        for tid, score in zip(input_track_ids, gt_scores):
+            confidence[tid] = float(score)
+
+    label_counts = xmem.label_counts
+    boxes = masks_to_boxes(pred_mask).cpu().numpy()
+    masks = pred_mask.cpu().numpy()
+    return [
+        eta.object(int(tid), label_counts[tid].most_common(1)[0][0] if label_counts[tid] else None, box, mask, confidence.get(tid), shape=small.shape)
+        for tid, mask, box in zip(track_ids, masks, boxes)
+    ]
+
+
+# ---------------------------------------------------------------------------- #
+#                                     Main                                     #
+# ---------------------------------------------------------------------------- #
+
+
+def main(config_fname=None, *videos, grid=None, configs=None, out_dir=None, workers=2, size=None, max_frames=None, stage_cache=None, out_csv=None, gt=None, iou='mask'):
+    '''
+    Arguments:
+        config_fname (str): The base config.
+        *videos: The videos to run on. Defaults to the config's ``DATASET.VIDEO_PATTERN``.
+        grid (dict): {dotted config key: [values]}. Every combination is run.
+        configs (str, list): Config files (or a glob) to run instead of a grid. Each writes to its own ``DATASET.ROOT``.
+        out_dir (str): Where the grid configs write to. Defaults to ``{DATASET.ROOT}_sweep``.
+        workers (int): How many trackers to run at once.
+        size (int): Decode frames at this height. Defaults to the smallest size that Detic and every config's
+            ``XMEM.FRAME_SIZE`` need (see ``working_size``), since the frames are held in shared memory.
+        max_frames (int): Only use the first N frames of each video.
+        stage_cache (str): The stage cache directory. Defaults to ``DATASET.STAGE_CACHE`` or ``{out_dir}/stage_cache``.
+        gt (str): Ground truth ETA labels. If given, every config is scored with ``track_eval`` (``{out_dir}/sweep_scores.csv``).
+        iou (str): ``mask`` or ``box`` IoU for scoring.
+    '''
+    # ------------------------------- Configs -------------------------------- #
+
+    runs = []  # (name, cfg, out dir)
+    if configs:
+        fs = sorted(f for c in ([configs] if isinstance(configs, str) else configs) for f in glob.glob(c))
+        for f in fs:
+            cfg = get_cfg(f).clone()  # get_cfg merges into the shared defaults
+            runs.append((os.path.splitext(os.path.basename(f))[0], cfg, cfg.DATASET.ROOT))
+        base = runs[0][1]
+    else:
+        base = get_cfg(config_fname).clone()
+        out_dir = out_dir or f'{base.DATASET.ROOT.rstrip(os.sep)}_sweep'
+        for overrides in expand_grid(grid):
+            name = config_name(overrides)
+            runs.append((name, apply_overrides(base.clone(), overrides), os.path.join(out_dir, name)))
+    assert runs, "Nothing to run"
+    out_dir = out_dir or os.path.commonpath([d for _, _, d in runs])
+    cache = StageCache(stage_cache or base.DATASET.get('STAGE_CACHE') or os.path.join(out_dir, 'stage_cache'))
+    videos = videos or sorted(glob.glob(base.DATASET.VIDEO_PATTERN))
+    log.info("Running %d configs on %d videos with %d workers", len(runs), len(videos), workers)
+    for name, cfg, d in runs:
+        os.makedirs(d, exist_ok=True)
+        with open(os.path.join(d, 'config.yaml'), 'w') as f:
+            f.write(cfg.dump())
+
+    # ------------------------------- Videos --------------------------------- #
+
+    groups = defaultdict(list)
+    for run in runs:
+        groups[detection_key(run[1])].append(run)
+    detectors = {}
+
+    timing = []
+    ctx = mp.get_context('spawn')  # cuda in the workers
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        for video in videos:
+            video_name = os.path.splitext(os.path.basename(video))[0]
+            video_id = cache.set_video(video)
+            t0 = time.perf_counter()
+            with SharedFrames.from_video(video, size=size, max_frames=max_frames, cfgs=[cfg for _, cfg, _ in runs]) as frames:
+                decode_s = time.perf_counter() - t0
+
+                # detect once per detection config, on every frame any of its configs needs
+                futures = []
+                for key, group in groups.items():
+                    need = set().union(*(detect_frames(cfg, frames.fps, len(frames.array)) for _, cfg, _ in group))
+                    t0 = time.perf_counter()
+                    if key not in detectors:
+                        detectors[key] = Detectors(group[0][1])
+                    detectors[key](frames.array, need, cache, f'{video_name} detect')
+                    detect_s = time.perf_counter() - t0
+                    timing.append({'config': f'detect:{key}', 'video': video_name, 'frames': len(need), 'decode_s': decode_s, 'detect_s': detect_s})
+
+                    # track every config in its own process
+                    for name, cfg, d in group:
+                        futures.append((name, d, pool.submit(
+                            track_video, cfg.dump(), video_name, frames.name, frames.shape, frames.fps, video_id,
+                            cache.root, detectors[key].info(), d)))
+
+                # the shared memory has to stay around until the trackers are done with it
+                for name, d, fut in tqdm.tqdm(futures, desc=f'{video_name} track'):
+                    timing.append({'config': name, **fut.result()})
+
+    # ------------------------------- Outputs -------------------------------- #
+
+    for name, cfg, d in runs:
+        eta.save(eta.manifest([
+            {'data': v, 'labels': eta.label_fname(d, v)} for v in videos
+            if os.path.isfile(eta.label_fname(d, v))
+        ]), eta.manifest_fname(d))
+
+    df = pd.DataFrame(timing)
+    print(df.to_string())
+    print(df[df.track_s.notna()].groupby('config')[['frames', 'track_s']].sum().assign(fps=lambda d: d.frames / d.track_s).to_string())
+    out_csv = out_csv or os.path.join(out_dir, 'sweep_timing.csv')
+    df.to_csv(out_csv, index=False)
+    print('Wrote', out_csv)
+
+    if gt:
+        from . import track_eval
+        track_eval.main(gt, *[d for _, _, d in runs], iou=iou, out_csv=os.path.join(out_dir, 'sweep_scores.csv'), out_dir=os.path.join(out_dir, 'track_scores'))
+
+
+if __name__ == '__main__':
+    import sys
+    from tqdm.contrib.logging import logging_redirect_tqdm
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    with logging_redirect_tqdm():
+        import fire
+        fire.Fire(main)
@@ -0,0 +1,406 @@
+'''Score tracker outputs against ground truth tracks. Both are ETA label sets (e.g. predict.py / sweep.py outputs).
+
+usage:
+    python -m object_states.track_eval /datasets/xmem_eval_gt /datasets/xmem_eval_sweep/*/ --out_csv scores.csv
+    python -m object_states.track_eval gt/labels/video.json pred/labels/video.json --iou box
+
+Computes, per video and over all videos (from the summed counts):
+ - HOTA, DetA, AssA, LocA (averaged over IoU thresholds 0.05-0.95)
+ - MOTA, MOTP, ID switches, fragmentations, mostly tracked / partially tracked / mostly lost (CLEAR MOT)
+ - IDF1, IDP, IDR
+ - StateAcc: how many matched objects have the right ``state`` attribute (if the ground truth has them)
+and a per ground truth track breakdown (``--out_dir``).
+
+Only frames that are in the ground truth file are scored, so sparsely annotated ground truth works.
+Masks are compared at ``shape`` (the labels are normalized), so the IoU is independent of the video size.
+Each mask is only rasterized over its own box and compared where boxes overlap, so thousands of
+frames take seconds.
+'''
+import os
+import glob
+import logging
+from collections import Counter, namedtuple
+import cv2
+import numpy as np
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+
+from .util import eta_format as eta
+from .util.boxes import box_iou
+
+log = logging.getLogger(__name__)
+
+ALPHAS = np.arange(0.05, 0.99, 0.05)
+EPS = 1e-9
+
+# masks are cropped to their pixels' box (crops: x0, y0, x1, y1, exclusive), so nothing is frame sized
+FrameObjects = namedtuple('FrameObjects', ['ids', 'labels', 'boxes', 'masks', 'crops', 'areas', 'states'])
+
+
+# ---------------------------------------------------------------------------- #
+#                                      IoU                                     #
+# ---------------------------------------------------------------------------- #
+
+
+def mask_iou(a, b):
+    '''FrameObjects x FrameObjects -> (n, m) mask IoU.
+
+    Only pairs whose crops overlap are compared, and only inside the overlap, so a frame
+    with a handful of objects costs a few small ``&``s instead of full-frame arrays.
+    '''
+    lt = np.maximum(a.crops[:, None, :2], b.crops[None, :, :2])
+    rb = np.minimum(a.crops[:, None, 2:], b.crops[None, :, 2:])
+    inter = np.zeros((len(a.crops), len(b.crops)))
+    for i, j in zip(*np.nonzero((rb > lt).all(-1))):
+        (x0, y0), (x1, y1) = lt[i, j], rb[i, j]
+        ax, ay, bx, by = a.crops[i, 0], a.crops[i, 1], b.crops[j, 0], b.crops[j, 1]
+        inter[i, j] = np.count_nonzero(
+            a.masks[i][y0 - ay:y1 - ay, x0 - ax:x1 - ax] &
+            b.masks[j][y0 - by:y1 - by, x0 - bx:x1 - bx])
+    union = a.areas[:, None] + b.areas[None] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1), 0)
+
+
+def similarity(gt, pred, iou='mask', class_aware=False):
+    '''The IoU between the ground truth and predicted objects in a frame.'''
+    if not len(gt.ids) or not len(pred.ids):
+        return np.zeros((len(gt.ids), len(pred.ids)))
+    sim = mask_iou(gt, pred) if iou == 'mask' else box_iou(gt.boxes, pred.boxes)
+    if class_aware:
+        sim = sim * (gt.labels[:, None] == pred.labels[None])
+    return sim
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Loading                                   #
+# ---------------------------------------------------------------------------- #
+
+
+def object_mask(obj, shape):
+    '''An ETA object's mask, cropped to its pixels. Returns (mask, (x0, y0, x1, y1)).'''
+    H, W = shape[:2]
+    if obj.get('polylines'):
+        # same as eta.polygon_to_binary_mask, but only rasterizing the polygons' box
+        pts = [(np.asarray(p).reshape(-1, 2) * [W, H]).astype(np.int32) for p in obj['polylines']]
+        xy = np.concatenate(pts)
+        x0, y0 = np.clip(xy.min(0), 0, [W - 1, H - 1])
+        x1, y1 = np.clip(xy.max(0) + 1, 1, [W, H])
+        mask = np.zeros((max(y1 - y0, 1), max(x1 - x0, 1)), np.uint8)
+        cv2.fillPoly(mask, pts, color=1, offset=(-int(x0), -int(y0)))
+        return mask.view(bool), (x0, y0, x0 + mask.shape[1], y0 + mask.shape[0])
+    full = eta.parse_object_mask(obj, shape)
+    if full is None or not full.any():
+        return np.zeros((0, 0), bool), (0, 0, 0, 0)
+    ys, xs = np.flatnonzero(full.any(1)), np.flatnonzero(full.any(0))
+    return full[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1].astype(bool), (xs[0], ys[0], xs[-1] + 1, ys[-1] + 1)
+
+
+def object_attr(obj, name, default=None):
+    '''Get an ETA object attribute's value (e.g. its ``state``).'''
+    for a in (obj.get('attrs') or {}).get('attrs') or []:
+        if a.get('name') == name:
+            return a.get('value')
+    return default
+
+
+def load_labels(fname, shape=(270, 480), masks=True):
+    '''Load an ETA label file as {frame number: FrameObjects}. Objects without a track index get their own ID.'''
+    base = eta.load(fname) if isinstance(fname, str) else fname
+    frames = {}
+    n_missing = 0
+    for k in base.get('frames', {}):
+        objects = eta.get_objects(base, k)
+        ids = np.array([
+            f'?{k}.{j}' if o.get('index') is None else o['index']
+            for j, o in enumerate(objects)], dtype=object)
+        n_missing += sum(o.get('index') is None for o in objects)
+        labels = np.array([o.get('label') for o in objects])
+        boxes = np.array([eta.box_to_xyxy(o['bounding_box'], shape) for o in objects]).reshape(-1, 4)
+        ms, crops = [], np.zeros((len(objects), 4), dtype=int)
+        if masks:
+            for j, o in enumerate(objects):
+                m, crops[j] = object_mask(o, shape)
+                ms.append(m)
+        areas = np.array([np.count_nonzero(m) for m in ms], dtype=int)
+        states = np.array([object_attr(o, 'state') for o in objects], dtype=object)
+        frames[int(k)] = FrameObjects(ids, labels, boxes, ms, crops, areas, states)
+    if n_missing:
+        log.warning("%s: %d objects have no track index", fname if isinstance(fname, str) else 'labels', n_missing)
+    return frames
+
+
+def label_files(path):
+    '''{video name: label file} for an ETA file, a dataset directory (``labels/*.json``) or a directory of label files.'''
+    if os.path.isfile(path):
+        return {os.path.splitext(os.path.basename(path))[0]: path}
+    fs = glob.glob(eta.label_fname(path, '*')) or glob.glob(os.path.join(path, '*.json'))
+    return {
+        os.path.splitext(os.path.basename(f))[0]: f for f in sorted(fs)
+        if os.path.basename(f) != 'manifest.json'
+    }
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Metrics                                   #
+# ---------------------------------------------------------------------------- #
+
+
+def evaluate(gt, pred, iou='mask', threshold=0.5, class_aware=False):
+    '''Match the predicted tracks to the ground truth tracks.
+
+    Arguments:
+        gt (dict): {frame: FrameObjects} (see ``load_labels``).
+        pred (dict): {frame: FrameObjects}
+        iou (str): ``mask`` or ``box``.
+        threshold (float): The IoU needed for a match (CLEAR MOT and IDF1).
+        class_aware (bool): Only match objects with the same label.
+
+    Returns:
+        counts (dict): Summable counts. Pass them to ``metrics``.
+        tracks (pd.DataFrame): One row per ground truth track.
+    '''
+    empty = FrameObjects(np.zeros(0, dtype=object), np.zeros(0), np.zeros((0, 4)), [], np.zeros((0, 4), dtype=int), np.zeros(0), np.zeros(0, dtype=object))
+    frames = sorted(gt)
+
+    # contiguous ids, so everything can be indexed with arrays
+    gt_index, pred_index = {}, {}
+    seq, states = [], []
+    for f in frames:
+        g, p = gt[f], pred.get(f, empty)
+        gi = np.array([gt_index.setdefault(i, len(gt_index)) for i in g.ids.tolist()], dtype=int)
+        pi = np.array([pred_index.setdefault(i, len(pred_index)) for i in p.ids.tolist()], dtype=int)
+        seq.append((gi, pi, similarity(g, p, iou, class_aware)))
+        states.append(state_agreement(g, p))
+    n_gt, n_pred = len(gt_index), len(pred_index)
+    gt_count = np.zeros(n_gt)
+    pred_count = np.zeros(n_pred)
+    for gi, pi, _ in seq:
+        gt_count[gi] += 1
+        pred_count[pi] += 1
+
+    counts = {'frames': len(frames), 'gt_dets': gt_count.sum(), 'pred_dets': pred_count.sum(), 'gt_tracks': n_gt, 'pred_tracks': n_pred}
+    clear, per_track = clear_mot(seq, n_gt, n_pred, threshold, states)
+    counts.update(clear)
+    counts.update(identity(seq, n_gt, n_pred, threshold))
+    counts.update(hota(seq, gt_count, pred_count))
+
+    # per ground truth track
+    gt_ids = list(gt_index)
+    pred_ids = np.array(list(pred_index), dtype=object)
+    labels = {}
+    for f in frames:
+        for i, l in zip(gt[f].ids.tolist(), gt[f].labels.tolist()):
+            labels.setdefault(i, Counter()).update([l])
+    match_counts = per_track.pop('match_counts')
+    main = match_counts.argmax(1) if n_pred else np.zeros(n_gt, dtype=int)
+    matched = per_track['matched']
+    tracks = pd.DataFrame({
+        'track_id': gt_ids,
+        'label': [labels[i].most_common(1)[0][0] for i in gt_ids],
+        'frames': gt_count.astype(int),
+        **{k: v.astype(int) for k, v in per_track.items()},
+        'recall': matched / np.maximum(gt_count, 1),
+        'main_pred': pred_ids[main] if n_pred else None,
+        'purity': (match_counts[np.arange(n_gt), main] / np.maximum(matched, 1)) if n_pred else 0.,
+    })
+    tracks['status'] = np.where(tracks.recall > 0.8, 'MT', np.where(tracks.recall < 0.2, 'ML', 'PT'))
+    counts.update({k: int((tracks.status == k).sum()) for k in ('MT', 'PT', 'ML')})
+    return counts, tracks
+
+
+def state_agreement(gt, pred):
+    '''(n, m): 1 if the objects have the same state, 0 if not, NaN if the ground truth has no state.'''
+    has = np.array([s is not None for s in gt.states.tolist()], dtype=bool)
+    if not has.any():
+        return None
+    same = (gt.states[:, None] == pred.states[None]).astype(float)
+    same[~has] = np.nan
+    return same
+
+
+def clear_mot(seq, n_gt, n_pred, threshold=0.5, states=None):
+    '''CLEAR MOT matching: keep last frame's matches when they're still above the threshold, Hungarian for the rest.
+
+    With ``states`` (per frame ``state_agreement``), also counts how many matches have the right state.
+    '''
+    prev = np.full(n_gt, -1)        # the pred each gt was matched to on the previous frame
+    last = np.full(n_gt, -1)        # the pred each gt was last matched to
+    was_matched = np.zeros(n_gt, bool)  # matched on the last frame the gt was in
+    matched = np.zeros(n_gt)
+    switches = np.zeros(n_gt)
+    segments = np.zeros(n_gt)
+    match_counts = np.zeros((n_gt, n_pred))
+    tp = fp = fn = iou_sum = state_n = state_tp = 0
+    for k, (gi, pi, sim) in enumerate(seq):
+        mg = mp = np.zeros(0, dtype=int)
+        if len(gi) and len(pi):
+            score = sim + 1000 * (prev[gi][:, None] == pi[None])
+            score[sim < threshold - EPS] = 0
+            r, c = linear_sum_assignment(-score)
+            ok = score[r, c] > 0
+            r, c = r[ok], c[ok]
+            mg, mp = gi[r], pi[c]
+            iou_sum += sim[r, c].sum()
+            if states is not None and states[k] is not None:
+                same = states[k][r, c]
+                state_n += int((~np.isnan(same)).sum())
+                state_tp += int(np.nansum(same))
+        tp += len(mg)
+        fn += len(gi) - len(mg)
+        fp += len(pi) - len(mp)
+
+        sw = (last[mg] >= 0) & (last[mg] != mp)
+        switches[mg[sw]] += 1
+        now = np.zeros(n_gt, bool)
+        now[mg] = True
+        segments[gi[now[gi] & ~was_matched[gi]]] += 1
+        was_matched[gi] = now[gi]
+        matched[mg] += 1
+        match_counts[mg, mp] += 1
+        prev[:] = -1
+        prev[mg] = mp
+        last[mg] = mp
+
+    frags = np.maximum(segments - 1, 0)
+    counts = {
+        'tp': tp, 'fp': fp, 'fn': fn, 'idsw': int(switches.sum()), 'frag': int(frags.sum()), 'iou_sum': float(iou_sum),
+        'state_n': state_n, 'state_tp': state_tp}
+    return counts, {'matched': matched, 'id_switches': switches, 'fragments': frags, 'match_counts': match_counts}
+
+
+def identity(seq, n_gt, n_pred, threshold=0.5):
+    '''IDF1: the one-to-one track assignment that maximizes the number of frames the pairs overlap.'''
+    overlap = np.zeros((n_gt, n_pred))
+    for gi, pi, sim in seq:
+        r, c = np.nonzero(sim >= threshold - EPS)
+        np.add.at(overlap, (gi[r], pi[c]), 1)
+    r, c = linear_sum_assignment(overlap, maximize=True) if overlap.size else ([], [])
+    return {'idtp': float(overlap[r, c].sum())}
+
+
+def hota(seq, gt_count, pred_count):
+    '''HOTA's per-threshold counts (Luiten et al. 2020), following TrackEval.'''
+    n_gt, n_pred = len(gt_count), len(pred_count)
+    # how well each pair of tracks is aligned over the whole video
+    potential = np.zeros((n_gt, n_pred))
+    for gi, pi, sim in seq:
+        if sim.size:
+            sim_iou = sim / (sim.sum(0)[None] + sim.sum(1)[:, None] - sim + EPS)
+            np.add.at(potential, (gi[:, None], pi[None]), sim_iou)
+    align = potential / np.maximum(gt_count[:, None] + pred_count[None] - potential, EPS)
+
+    # match every frame, preferring well aligned pairs
+    G, P, S = [], [], []
+    for gi, pi, sim in seq:
+        if sim.size:
+            r, c = linear_sum_assignment(-(align[gi][:, pi] * sim))
+            G.append(gi[r]); P.append(pi[c]); S.append(sim[r, c])
+    G, P, S = (np.concatenate(x) if x else np.zeros(0) for x in (G, P, S))
+
+    tp, ass, loc = np.zeros(len(ALPHAS)), np.zeros(len(ALPHAS)), np.zeros(len(ALPHAS))
+    for a, alpha in enumerate(ALPHAS):
+        ok = S >= alpha - EPS
+        tp[a] = ok.sum()
+        loc[a] = S[ok].sum()
+        pairs, n = np.unique(G[ok].astype(int) * max(n_pred, 1) + P[ok].astype(int), return_counts=True)
+        g, p = pairs // max(n_pred, 1), pairs % max(n_pred, 1)
+        ass[a] = (n * n / (gt_count[g] + pred_count[p] - n)).sum()  # sum over TPs of their association IoU
+    return {'hota_tp': tp, 'hota_ass': ass, 'hota_loc': loc}
+
+
+def metrics(counts):
+    '''The metrics from (summed) counts.'''
+    c = counts
+    tp = c['hota_tp']
+    det_a = tp / np.maximum(c['gt_dets'] + c['pred_dets'] - tp, 1)
+    ass_a = c['hota_ass'] / np.maximum(tp, 1)
+    return {
+        'HOTA': np.sqrt(det_a * ass_a).mean(),
+        'DetA': det_a.mean(),
+        'AssA': ass_a.mean(),
+        'LocA': (c['hota_loc'] / np.maximum(tp, EPS)).mean(),
+        'MOTA': 1 - (c['fn'] + c['fp'] + c['idsw']) / max(c['gt_dets'], 1),
+        'MOTP': c['iou_sum'] / max(c['tp'], 1),
+        'IDF1': 2 * c['idtp'] / max(c['gt_dets'] + c['pred_dets'], 1),
+        'IDP': c['idtp'] / max(c['pred_dets'], 1),
+        'IDR': c['idtp'] / max(c['gt_dets'], 1),
+        'StateAcc': c['state_tp'] / c['state_n'] if c['state_n'] else np.nan,
+        'IDSW': c['idsw'],
+        'Frag': c['frag'],
+        'MT': c['MT'], 'PT': c['PT'], 'ML': c['ML'],
+        'TP': c['tp'], 'FP': c['fp'], 'FN': c['fn'],
+        'GT_dets': int(c['gt_dets']), 'Pred_dets': int(c['pred_dets']),
+        'GT_tracks': c['gt_tracks'], 'Pred_tracks': c['pred_tracks'], 'frames': c['frames'],
+    }
+
+
+def sum_counts(counts):
+    return {k: sum(c[k] for c in counts) for k in counts[0]}
+
+
+# ---------------------------------------------------------------------------- #
+#                                      CLI                                     #
+# ---------------------------------------------------------------------------- #
+
+
+def evaluate_dir(gt, pred, iou='mask', threshold=0.5, class_aware=False, shape=(270, 480), gt_cache=None):
+    '''Score every video in ``pred`` that has ground truth. Returns (per-video metrics, per-track breakdown).'''
+    gt_files, pred_files = label_files(gt), label_files(pred)
+    missing = set(gt_files) - set(pred_files)
+    if missing:
+        log.warning("%s is missing %d/%d videos: %s", pred, len(missing), len(gt_files), sorted(missing))
+    gt_cache = {} if gt_cache is None else gt_cache
+    rows, tracks, all_counts = [], [], []
+    for name in sorted(set(gt_files) & set(pred_files)):
+        if name not in gt_cache:
+            gt_cache[name] = load_labels(gt_files[name], shape, masks=iou == 'mask')
+        pred_labels = load_labels(pred_files[name], shape, masks=iou == 'mask')
+        counts, tdf = evaluate(gt_cache[name], pred_labels, iou=iou, threshold=threshold, class_aware=class_aware)
+        all_counts.append(counts)
+        rows.append({'video': name, **metrics(counts)})
+        tracks.append(tdf.assign(video=name))
+    if all_counts:
+        rows.append({'video': 'ALL', **metrics(sum_counts(all_counts))})
+    return pd.DataFrame(rows), (pd.concat(tracks, ignore_index=True) if tracks else pd.DataFrame())
+
+
+def main(gt, *preds, iou='mask', threshold=0.5, class_aware=False, shape=(270, 480), out_csv=None, out_dir=None):
+    '''
+    Arguments:
+        gt (str): The ground truth ETA file or dataset directory.
+        *preds (str): The predicted ETA files or dataset directories (e.g. one per sweep config).
+        iou (str): ``mask`` or ``box``.
+        threshold (float): The IoU needed for a match (MOTA, IDF1).
+        class_aware (bool): Only match objects with the same label.
+        shape (tuple): The (H, W) to compare masks at.
+        out_csv (str): Write the per-video / overall metrics here.
+        out_dir (str): Write each prediction's per-track breakdown to ``{out_dir}/{name}_tracks.csv``.
+    '''
+    assert iou in ('mask', 'box'), f"iou must be mask or box, not {iou}"
+    gt_cache = {}
+    dfs = []
+    for pred in preds:
+        name = os.path.basename(os.path.normpath(pred))
+        df, tracks = evaluate_dir(gt, pred, iou=iou, threshold=threshold, class_aware=class_aware, shape=tuple(shape), gt_cache=gt_cache)
+        dfs.append(df.assign(pred=name))
+        if out_dir and len(tracks):
+            os.makedirs(out_dir, exist_ok=True)
+            tracks.to_csv(os.path.join(out_dir, f'{name}_tracks.csv'), index=False)
+    df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+    if not len(df):
+        log.warning("Nothing to score")
+        return
+    df = df[['pred', 'video'] + [c for c in df.columns if c not in ('pred', 'video')]]
+    with pd.option_context('display.width', 200, 'display.max_columns', 30):
+        print(df[df.video == 'ALL'].set_index('pred').round(4).to_string())
+    if out_csv:
+        os.makedirs(os.path.dirname(out_csv) or '.', exist_ok=True)
+        df.to_csv(out_csv, index=False)
+        print('Wrote', out_csv)
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    import fire
+    fire.Fire(main)
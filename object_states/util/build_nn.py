@@ -266,16 +266,18 @@ def fix_vocab(sdf):
 
 import ipdb
 @ipdb.iex
-def build(config_name, embeddings_dir='embeddings', overwrite=False):
+def build(config_name, embeddings_dir='embeddings', overwrite=False, emb_types=None):
     cfg = get_cfg(config_name)
     tree = pt.tree(cfg.DATASET.ROOT, {
         '{embeddings_dir}/{field_name}/{video_id}/{emb_type}/{track_id}.npz': 'emb_file',
         '{emb_type}.lancedb': 'db_fname',
     }).specify(embeddings_dir=embeddings_dir)
     # emb_dir = os.path.join(cfg.DATASET.ROOT, 'embeddings1', cfg.EVAL.DETECTION_NAME)
-    # emb_types = cfg.EVAL.EMBEDDING_TYPES
+    # e.g. clip, detic, detic_s0 - use the same type as ObjectDetector(state_features=...)
+    emb_types = emb_types or ['clip']
+    emb_types = [emb_types] if isinstance(emb_types, str) else emb_types
 
-    for emb_type in ['clip']: #emb_types:
+    for emb_type in emb_types:
         # ---------------------- Load the embeddings and states ---------------------- #
 
         data_file_pattern = tree.emb_file.specify(emb_type=emb_type).glob_format() #f'{emb_dir}/*/{emb_type}/*.npz'
@@ -1,8 +1,231 @@
 import os
+import glob
+import queue
+import threading
 import orjson
 
+OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY
+
 
 def json_dump(fname, data):
     os.makedirs(os.path.dirname(fname), exist_ok=True)
     with open(fname, 'wb') as f:
-        f.write(orjson.dumps(data, option=orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY))
+        f.write(orjson.dumps(data, option=OPTIONS))
+
+
+# ---------------------------------------------------------------------------- #
+#                               Streaming writers                              #
+# ---------------------------------------------------------------------------- #
+
+
+class BackgroundWriter:
+    '''Write items from a background thread.
+
+    ``write`` puts the item on a bounded queue (so it blocks if the disk falls behind
+    instead of growing memory) and the thread hands them to ``_write``. ``_flush`` is
+    called every ``flush_every`` items and whenever the queue runs dry, so at most a
+    few items are lost if the process dies.
+
+    ``sync`` waits until everything written so far is on disk (e.g. before a checkpoint).
+
+    Subclasses implement ``_open``, ``_write``, ``_flush``, ``_sync``, ``_close`` and ``finalize``.
+    '''
+    def __init__(self, maxsize=256, flush_every=32):
+        self.maxsize = maxsize
+        self.flush_every = flush_every
+        self._queue = None
+        self._thread = None
+        self._error = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *a):
+        self.close()
+
+    def start(self):
+        if self._thread is None:
+            self._open()
+            self._queue = queue.Queue(maxsize=self.maxsize)
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def write(self, item):
+        if self._thread is None:
+            self.start()
+        self._raise()
+        self._queue.put(item)
+
+    def qsize(self):
+        '''How many items are waiting to be written.'''
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def sync(self):
+        '''Block until all items written so far have been written and flushed.'''
+        if self._thread is not None:
+            done = threading.Event()
+            self._queue.put(done)
+            while not done.wait(1):
+                if not self._thread.is_alive():
+                    break
+            self._raise()
+
+    def close(self, finalize=True):
+        '''Drain the queue, stop the thread, and (optionally) write the final output.'''
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._raise()
+        if finalize:
+            return self.finalize()
+
+    def _raise(self):
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise RuntimeError(f"{type(self).__name__} failed in the background") from e
+
+    def _run(self):
+        n = 0
+        try:
+            while True:
+                try:
+                    item = self._queue.get(timeout=1)
+                except queue.Empty:
+                    if n:
+                        self._flush()
+                        n = 0
+                    continue
+                if item is None:
+                    break
+                if isinstance(item, threading.Event):
+                    self._sync()
+                    self._flush()
+                    n = 0
+                    item.set()
+                    continue
+                self._write(item)
+                n += 1
+                if n >= self.flush_every or self._queue.empty():
+                    self._flush()
+                    n = 0
+        except BaseException as e:
+            self._error = e
+            # keep draining so write() doesn't block forever
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                if isinstance(item, threading.Event):
+                    item.set()
+        finally:
+            try:
+                self._close()
+            except BaseException as e:
+                self._error = self._error or e
+
+    def _open(self): pass
+    def _write(self, item): raise NotImplementedError
+    def _flush(self): pass
+    def _sync(self): pass
+    def _close(self): pass
+    def finalize(self): pass
+
+
+class JsonlWriter(BackgroundWriter):
+    '''Write a list of records as JSON Lines, then convert to a JSON list when finished.
+
+    The records are written to ``{fname}l`` (one record per line) as they come in.
+    ``finalize`` streams them into ``fname`` as a JSON list - the same file ``json_dump``
+    would write - without loading them all into memory.
+
+    Arguments:
+        fname (str): The final JSON file.
+        keep_jsonl (bool): Keep the JSON Lines file after finalizing.
+        append (bool): Append to an existing JSON Lines file (e.g. when resuming) instead of replacing it.
+        truncate (int): When appending, first cut the file back to this many bytes (see ``tell``).
+    '''
+    def __init__(self, fname, keep_jsonl=False, append=False, truncate=None, **kw):
+        super().__init__(**kw)
+        self.fname = fname
+        self.jsonl_fname = jsonl_fname(fname)
+        self.keep_jsonl = keep_jsonl
+        self.append = append
+        self.truncate = truncate
+        self.count = 0
+        self._f = None
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.fname) or '.', exist_ok=True)
+        self._f = open(self.jsonl_fname, 'ab' if self.append else 'wb')
+        if self.append and self.truncate is not None:
+            self._f.truncate(self.truncate)
+
+    def tell(self):
+        '''The size of the JSON Lines file. Call ``sync`` first to include everything written.'''
+        return os.path.getsize(self.jsonl_fname) if os.path.isfile(self.jsonl_fname) else 0
+
+    def _write(self, item):
+        if not isinstance(item, bytes):
+            item = orjson.dumps(item, option=OPTIONS)
+        self._f.write(item + b'\n')
+        self.count += 1
+
+    def _flush(self):
+        self._f.flush()
+
+    def _close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    def finalize(self):
+        return jsonl_to_json(self.jsonl_fname, self.fname, remove=not self.keep_jsonl)
+
+
+def jsonl_fname(fname):
+    return os.path.splitext(fname)[0] + '.jsonl'
+
+
+def iter_jsonl(fname):
+    '''Read records from a JSON Lines file. A truncated last line (from a crash) is skipped.'''
+    with open(fname, 'rb') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError:
+                if line.endswith(b'\n'):
+                    raise
+                return
+
+
+def jsonl_to_json(src, fname=None, remove=False):
+    '''Convert a JSON Lines file to a JSON list, one record at a time.'''
+    fname = fname or os.path.splitext(src)[0] + '.json'
+    tmp = f'{fname}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(b'[')
+        for i, d in enumerate(iter_jsonl(src) if os.path.isfile(src) else ()):
+            if i:
+                f.write(b',\n')
+            f.write(orjson.dumps(d, option=OPTIONS))
+        f.write(b']')
+    os.replace(tmp, fname)
+    if remove and os.path.isfile(src):
+        os.remove(src)
+    return fname
+
+
+def finalize_jsonl(*fnames):
+    '''Recover JSON outputs from the JSON Lines left behind by a run that crashed.'''
+    for f in fnames:
+        for fi in glob.glob(f) if '*' in f else [f]:
+            print(jsonl_to_json(fi, remove=True))
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire()
@@ -0,0 +1,44 @@
+'''Box embeddings from Detic's ROI head, reusing an already computed Detic query.
+
+This lets us classify object states from the features Detic computed for detection
+instead of cropping each box and running a second backbone (CLIP).
+
+Embedding types (matching the ``embeddings/{field}/{video}/{emb_type}`` dirs):
+ - ``detic``: the ROI features averaged over the cascade stages
+ - ``detic_s{i}``: the ROI features from cascade stage ``i``
+'''
+
+
+def is_detic_type(emb_type):
+    return emb_type == 'detic' or emb_type.startswith('detic_s')
+
+
+def detic_stage_features(detic_query, boxes, classifier=None, labels=None):
+    '''Get the (n, stages, d) ROI features for boxes from each cascade stage.'''
+    outputs = detic_query.predict(boxes, classifier, labels=labels)
+    return outputs['instances'].stage_features
+
+
+def select_stage_features(z, emb_type='detic'):
+    '''Get the embedding type from the (n, stages, d) stage features.'''
+    assert is_detic_type(emb_type), f"Not a detic embedding type: {emb_type}"
+    if emb_type == 'detic':
+        return z.mean(1)
+    return z[:, int(emb_type[len('detic_s'):])]
+
+
+def detic_box_features(detic_query, boxes, emb_type='detic', classifier=None, labels=None):
+    '''Get ROI features for boxes (in the query image's coordinates).
+
+    Arguments:
+        detic_query: The query returned by ``detic.build_query(image)``. Its backbone
+            features are pooled for each box so no extra backbone pass is needed.
+        boxes (torch.Tensor): The (n, 4) xyxy boxes.
+        emb_type (str): ``detic`` or ``detic_s{i}``.
+        classifier, labels: Passed to the ROI head. They don't change the features.
+
+    Returns:
+        z (torch.Tensor): The (n, d) box features.
+    '''
+    z = detic_stage_features(detic_query, boxes, classifier, labels)
+    return select_stage_features(z, emb_type)
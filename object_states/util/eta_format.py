@@ -7,6 +7,9 @@ import cv2
 
 import logging
 
+from .data_output import BackgroundWriter
+from .serialize import mask_contours, encode_contours
+
 log = logging.getLogger(__name__)
 
 
@@ -42,11 +45,11 @@ def frame(frame_number, objects, attrs=None):
         **_maybe_key("objects", objects),
     }
 
-def object(index, label, bbox, mask, confidence, shape=None, attrs=None, as_polylines=True):
+def object(index, label, bbox, mask, confidence, shape=None, attrs=None, as_polylines=True, **kw):
     return {
         "index": index,
         "label": label,
-        "polylines": binary_mask_to_polygon(mask) if as_polylines else binary_to_bounded_mask(mask, bbox),
+        "polylines": binary_mask_to_polygon(mask, bbox, **kw) if as_polylines else binary_to_bounded_mask(mask, bbox),
         "confidence": confidence,
         "bounding_box": xyxy_to_box(bbox, shape or mask.shape),
         **_maybe_key("attrs", attrs),
@@ -76,13 +79,11 @@ def nonone(d):
 
 # --------------------------------- Polyline --------------------------------- #
 
-def binary_mask_to_polygon(mask):
-    mask = mask.astype(np.uint8)
-    shape = np.array(mask.shape)[::-1]
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contours = [np.asarray(contour) / shape for contour in contours]
-    contours = [contour.flatten().tolist() for contour in contours]
-    return contours
+def binary_mask_to_polygon(mask, bbox=None, epsilon=0, decimals=None):
+    # bbox (xyxy pixels) limits the contour search to the box. See util.serialize for the options.
+    contours = mask_contours(mask, bbox, epsilon=epsilon)
+    contours = encode_contours(contours, mask.shape, decimals=decimals)
+    return [contour.flatten().tolist() for contour in contours]
 
 def polygon_to_binary_mask(polylines, shape):
     mask = np.zeros(shape[:2], np.uint8)
@@ -137,7 +138,7 @@ def xyxy_to_box(xyxy, shape):
 
 # --------------------------------- Detectron -------------------------------- #
 
-def detectron2_objects(instances, shape, classes=None):
+def detectron2_objects(instances, shape, classes=None, **kw):
     instances = instances.to('cpu')
     if classes is None:
         assert instances.has('pred_labels')
@@ -145,7 +146,7 @@ def detectron2_objects(instances, shape, classes=None):
     else:
         labels = np.asarray(classes)[instances.pred_classes.int().numpy()]
     return [
-        object(i, label, bbox, mask, confidence, shape=shape)
+        object(i, label, bbox, mask, confidence, shape=shape, **kw)
         for i, (label, bbox, mask, confidence) in enumerate(zip(
             labels,
             instances.pred_boxes.tensor.numpy(),
@@ -247,10 +248,116 @@ def save(ann, fname, overwrite=True):
 
 
 def load(fname):
-    with open(fname, 'rb') as f: 
+    with open(fname, 'rb') as f:
         return orjson.loads(f.read())
 
 
+# ---------------------------------------------------------------------------- #
+#                               Streaming writer                               #
+# ---------------------------------------------------------------------------- #
+
+
+class SegmentWriter(BackgroundWriter):
+    '''Write ETA labels in frame-chunked segments as the video is processed.
+
+    Every ``segment_size`` frames are written to ``{fname}.segments/{first frame}.json``
+    so only one segment is held in memory, and a crash loses at most one segment.
+    ``finalize`` merges the segments into a regular ETA file at ``fname``.
+    Pass ``append=True`` to keep the segments already on disk (e.g. when resuming), and
+    ``after`` to drop any segments that start after that frame.
+
+    .. code-block:: python
+
+        with eta.SegmentWriter(fname) as w:
+            for i, frame in ...:
+                w.add_frame(i, objects)
+    '''
+    def __init__(self, fname, segment_size=300, attrs=None, keep_segments=False, append=False, after=None, **kw):
+        super().__init__(**kw)
+        self.append = append
+        self.after = after
+        self.fname = fname
+        self.segment_dir = segment_dir(fname)
+        self.segment_size = segment_size
+        self.attrs = attrs
+        self.keep_segments = keep_segments
+        self._segment = None
+
+    def add_frame(self, frame_number, objects=None, attrs=None):
+        self.write((frame_number, objects, attrs))
+
+    def _open(self):
+        os.makedirs(self.segment_dir, exist_ok=True)
+        for f in glob.glob(os.path.join(self.segment_dir, '*.json')):
+            # clear out segments from a previous run (or the ones after a checkpoint)
+            start = int(os.path.splitext(os.path.basename(f))[0])
+            if not self.append or (self.after is not None and start > self.after):
+                os.remove(f)
+
+    def _write(self, item):
+        frame_number, objects, attrs = item
+        if self._segment is None:
+            self._segment = (frame_number, eta_base())
+        add_frame(self._segment[1], frame_number, objects, attrs)
+        if len(self._segment[1]['frames']) >= self.segment_size:
+            self._write_segment()
+
+    def _write_segment(self):
+        if self._segment is not None:
+            start, data = self._segment
+            fname = os.path.join(self.segment_dir, f'{start:08d}.json')
+            # write-then-rename so a segment is either complete or missing
+            with open(f'{fname}.tmp', 'wb') as f:
+                f.write(orjson.dumps(data, option=orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY))
+            os.replace(f'{fname}.tmp', fname)
+            self._segment = None
+
+    def _sync(self):
+        # end the segment early so everything so far is on disk
+        self._write_segment()
+
+    def _close(self):
+        self._write_segment()
+
+    def finalize(self):
+        return merge_segments(self.fname, attrs=self.attrs, remove=not self.keep_segments)
+
+
+def segment_dir(fname):
+    return f'{fname}.segments'
+
+
+def merge_segments(fname, attrs=None, remove=False):
+    '''Merge the segments written by ``SegmentWriter`` into a single ETA file.
+
+    The frames are streamed into the output one segment at a time. This can also be
+    used to recover the labels from a run that crashed.
+    '''
+    sdir = segment_dir(fname)
+    fs = sorted(glob.glob(os.path.join(sdir, '*.json')))
+    log.info('merging %d segments into %s', len(fs), fname)
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    opt = orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY
+    with open(f'{fname}.tmp', 'wb') as f:
+        f.write(b'{')
+        if attrs:
+            f.write(orjson.dumps("attrs") + b':' + orjson.dumps(_maybe_key("attrs", attrs)["attrs"], option=opt) + b',')
+        f.write(b'"frames":{')
+        i = 0
+        for fi in fs:
+            for k, frame in load(fi)['frames'].items():
+                f.write((b',' if i else b'') + orjson.dumps(k) + b':' + orjson.dumps(frame, option=opt))
+                i += 1
+        f.write(b'}}')
+    os.replace(f'{fname}.tmp', fname)
+    if remove:
+        for fi in fs:
+            os.remove(fi)
+        if not os.listdir(sdir):
+            os.rmdir(sdir)
+    return fname
+
+
 # --------------------------------- Filenames -------------------------------- #
 
 def data_fname(out_dir, f, ext='.mp4'):
@@ -16,12 +16,12 @@ from IPython import embed
 
 device = 'cuda'
 
-def load_clip():
-    import clip
-    model, preprocess = clip.load("ViT-B/32", device=device)
+def load_clip(precision='fp32', device=device):
+    from .precision import load_clip, encode_image
+    model, preprocess = load_clip("ViT-B/32", device=device, precision=precision)
     class CLIP(torch.nn.Module):
         def forward(self, x):
-            return model.encode_image(x)
+            return encode_image(model, x, precision)
     return CLIP(), preprocess
 
 def load_dino():
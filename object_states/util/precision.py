@@ -0,0 +1,52 @@
+'''Reduced precision for the CLIP state embedding.
+
+ - ``fp32``: the default. No change.
+ - ``bf16``: run the encoder under bf16 autocast.
+ - ``int8``: dynamically quantize the linear layers (CPU only).
+
+Embeddings are always returned as fp32 so downstream code (kNN, sklearn) doesn't change.
+'''
+import contextlib
+import logging
+import torch
+
+log = logging.getLogger(__name__)
+
+PRECISIONS = ('fp32', 'bf16', 'int8')
+
+
+def check_precision(precision, device='cpu'):
+    precision = precision or 'fp32'
+    assert precision in PRECISIONS, f"Unknown precision {precision}. Expected one of {PRECISIONS}"
+    if precision == 'int8':
+        assert torch.device(device).type == 'cpu', "int8 dynamic quantization only runs on CPU"
+    return precision
+
+
+def set_precision(model, precision='fp32', device='cpu'):
+    '''Prepare a CLIP model for a precision. This only touches the visual encoder.'''
+    precision = check_precision(precision, device)
+    if precision == 'int8':
+        log.info("Quantizing CLIP visual encoder linear layers to int8")
+        model.visual = torch.ao.quantization.quantize_dynamic(
+            model.visual, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def autocast(precision='fp32', device='cpu'):
+    if precision == 'bf16':
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def encode_image(model, x, precision='fp32'):
+    '''Encode an image batch with CLIP at the given precision. Returns fp32 embeddings.'''
+    with autocast(precision, x.device):
+        return model.encode_image(x).float()
+
+
+def load_clip(name="ViT-B/32", device='cpu', precision='fp32'):
+    import clip
+    precision = check_precision(precision, device)
+    model, preprocess = clip.load(name, device=device)
+    return set_precision(model, precision, device), preprocess
@@ -0,0 +1,176 @@
+'''Turn detections into JSON-able records.
+
+This is shared by ``Perception.serialize_detections`` (``detic:image`` messages / jsonl outputs)
+and the ETA labels (``eta_format.binary_mask_to_polygon``).
+
+Contours are found on the mask cropped to its (padded) bounding box instead of the full frame
+and can be simplified with ``cv2.approxPolyDP`` (``epsilon``, in pixels). Coordinates can be
+rounded (``decimals``) or written as integer pixels (``pixels``), which is most of the message size.
+'''
+import cv2
+import numpy as np
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Contours                                   #
+# ---------------------------------------------------------------------------- #
+
+def mask_contours(mask, box=None, epsilon=0, mode=cv2.RETR_EXTERNAL, pad=2):
+    '''Get the contours of a binary mask.
+
+    Arguments:
+        mask (np.ndarray): The (h, w) mask.
+        box (array): The mask's xyxy box in pixels. Only this region (plus ``pad``) is searched.
+        epsilon (float): The ``cv2.approxPolyDP`` tolerance in pixels. 0 to keep every point.
+        mode (int): The ``cv2.findContours`` retrieval mode.
+        pad (int): Extra pixels around the box, in case the mask spills over it.
+
+    Returns:
+        A list of (n, 2) int32 arrays of pixel coordinates.
+    '''
+    x1 = y1 = 0
+    if box is not None:
+        H, W = mask.shape[:2]
+        x1, y1, x2, y2 = np.asarray(box, dtype=float)
+        x1, y1 = max(int(x1) - pad, 0), max(int(y1) - pad, 0)
+        x2, y2 = min(int(np.ceil(x2)) + pad + 1, W), min(int(np.ceil(y2)) + pad + 1, H)
+        if x2 <= x1 or y2 <= y1:
+            return []
+        mask = mask[y1:y2, x1:x2]
+    mask = np.ascontiguousarray(mask, dtype=np.uint8)
+    contours = cv2.findContours(mask, mode, cv2.CHAIN_APPROX_SIMPLE, offset=(x1, y1))[0]
+    if epsilon:
+        contours = [cv2.approxPolyDP(c, epsilon, True) for c in contours]
+    return [c.reshape(-1, 2) for c in contours]
+
+
+def encode_contours(contours, shape, decimals=None, pixels=False):
+    '''Normalize contours by the frame size.
+
+    Arguments:
+        contours (list): (n, 2) pixel coordinate arrays.
+        shape (tuple): The frame shape (h, w, ...).
+        decimals (int): Round the normalized coordinates. None for full precision.
+        pixels (bool): Keep integer pixel coordinates instead of normalizing.
+
+    Returns:
+        A list of (n, 2) arrays.
+    '''
+    if pixels or not len(contours):
+        return list(contours)
+    # normalize every contour at once
+    points = np.concatenate(contours) / np.array(shape[:2][::-1], dtype=float)
+    if decimals is not None:
+        points = points.round(decimals)
+    return np.split(points, np.cumsum([len(c) for c in contours])[:-1])
+
+
+def mask_polygons(masks, boxes, shape, epsilon=0, decimals=None, pixels=False, mode=cv2.RETR_EXTERNAL):
+    '''Get the encoded contours for each mask. See ``mask_contours`` and ``encode_contours``.'''
+    if boxes is None:
+        boxes = [None] * len(masks)
+    return [
+        encode_contours(mask_contours(m, b, epsilon=epsilon, mode=mode), shape, decimals=decimals, pixels=pixels)
+        for m, b in zip(masks, boxes)
+    ]
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Records                                   #
+# ---------------------------------------------------------------------------- #
+
+def records(columns, n):
+    '''Convert columns {key: values} into n dicts. Columns that are None are left out.'''
+    columns = {k: v for k, v in columns.items() if v is not None}
+    if not columns:
+        return [{} for _ in range(n)]
+    keys = list(columns)
+    return [dict(zip(keys, row)) for row in zip(*columns.values())]
+
+
+def _column(x, decimals=None):
+    # numpy scalars are kept for orjson (float32 prints shorter than float64). Rounded values are floats.
+    if x is None:
+        return None
+    x = np.asarray(x)
+    if decimals is not None and x.dtype.kind == 'f':
+        return x.astype(float).round(decimals).tolist()
+    return x.tolist() if x.dtype.kind in 'iub' else list(x)
+
+
+def serialize_columns(
+        boxes, labels, shape, scores=None, track_ids=None, states=None,
+        hand_object=None, topk_labels=None, topk_scores=None, masks=None,
+        epsilon=0, decimals=None, pixels=False, mode=cv2.RETR_TREE):
+    '''Build per-detection records from columnar (numpy) outputs.
+
+    Arguments:
+        boxes (np.ndarray): (n, 4) xyxy pixel boxes.
+        labels (list): (n,) labels.
+        shape (tuple): The frame shape (h, w, ...).
+        scores (np.ndarray): (n,) confidences.
+        track_ids (np.ndarray): (n,) track ids.
+        states (list): (n,) state dicts.
+        hand_object (dict): {hand: (n,) interaction scores}.
+        topk_labels, topk_scores (np.ndarray): (n, k) possible labels and their scores.
+        masks (np.ndarray): (n, h, w) masks. If given, each record gets a ``segment``.
+        epsilon, decimals, pixels, mode: See ``mask_contours`` and ``encode_contours``.
+    '''
+    n = len(boxes)
+    boxes = np.asarray(boxes, dtype=np.float32)
+    xyxyn = boxes / np.array(tuple(shape[:2][::-1]) * 2, dtype=np.float32)
+
+    hand_object = {k: np.asarray(v) for k, v in (hand_object or {}).items()}
+    possible_labels = None
+    if topk_scores is not None:
+        topk_labels = np.asarray(topk_labels)
+        topk_scores = np.asarray(topk_scores)
+        keep = topk_scores > 0
+        possible_labels = [
+            dict(zip(ls[k].tolist(), ss[k].tolist()))
+            for ls, ss, k in zip(topk_labels, topk_scores, keep)
+        ]
+
+    segments = None
+    if masks is not None:
+        segments = mask_polygons(masks, boxes, shape, epsilon=epsilon, decimals=decimals, pixels=pixels, mode=mode)
+        if not pixels:
+            # keep the (n, 1, 2) layout that findContours gives
+            segments = [[c.reshape(-1, 1, 2) for c in cs] for cs in segments]
+
+    return records({
+        'xyxyn': _column(xyxyn, decimals) if decimals is not None else xyxyn.tolist(),
+        'label': list(labels),
+        'confidence': _column(scores, decimals),
+        'hand_object': records({k: _column(v) for k, v in hand_object.items()}, n) if hand_object else None,
+        'hand_object_interaction': _column(np.max(list(hand_object.values()), axis=0)) if hand_object else None,
+        'possible_labels': possible_labels or None,
+        'segment': segments or None,
+        'state': states,
+        'segment_track_id': _column(track_ids),
+    }, n)
+
+
+def serialize_instances(detections, frame_shape, include_mask=False, **kw):
+    '''Serialize detectron2 ``Instances``. See ``serialize_columns`` for the options.'''
+    if detections is None:
+        return None
+    detections = detections.to('cpu')
+    get = lambda k: detections.get(k) if detections.has(k) else None
+    arr = lambda k: detections.get(k).numpy() if detections.has(k) else None
+    hand_object = {
+        k: detections.get(kk).numpy()
+        for k, kk in ((k, f'{k}_hand_interaction') for k in ['left', 'right', 'both'])
+        if detections.has(kk)}
+    return serialize_columns(
+        detections.pred_boxes.tensor.numpy(),
+        detections.pred_labels,
+        frame_shape,
+        scores=arr('scores'),
+        track_ids=arr('track_ids'),
+        states=get('pred_states'),
+        hand_object=hand_object,
+        topk_labels=get('topk_labels'),
+        topk_scores=arr('topk_scores'),
+        masks=arr('pred_masks') if include_mask else None,
+        **kw)
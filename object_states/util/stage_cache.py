@@ -0,0 +1,271 @@
+'''An on-disk cache of per-frame Detic / EgoHOS outputs, so tracking sweeps don't re-run detection.
+
+Each entry is keyed by the video's content hash, the stage's identity (model, config,
+vocabulary hash, input size) and the frame index::
+
+    {root}/{video hash}/{stage}-{identity hash}/identity.json
+    {root}/{video hash}/{stage}-{identity hash}/{frame:07d}.npz
+
+Entries are compressed ``.npz`` files of the stage's arrays (boxes, scores, label ids, ...).
+Boolean masks are cropped to their box and bit-packed, which (with the zlib on top) takes a
+(n, H, W) mask stack down to a few KB.
+
+.. code-block:: python
+
+    cache = StageCache('/datasets/stage_cache')
+    cache.set_video('video.mp4')
+    identity = {'model': 'detic', 'conf_threshold': 0.3, 'vocab': config_hash(vocab), 'shape': frame.shape}
+    instances = get_instances(cache, 'detic', identity, i)
+    if instances is None:
+        instances = detic(frame)['instances']
+        put_instances(cache, 'detic', identity, i, instances)
+'''
+import os
+import uuid
+import hashlib
+import logging
+import orjson
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def config_hash(*objs, n=12):
+    '''A short, stable hash of some json-able config (dict keys are sorted).'''
+    data = orjson.dumps(objs, option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS, default=str)
+    return hashlib.sha1(data).hexdigest()[:n]
+
+
+_video_hashes = {}
+
+def video_hash(path, chunk_size=1 << 20, n=16):
+    '''A content hash of a video: its size plus its first, middle and last ``chunk_size`` bytes.
+
+    This is enough to tell videos apart (and doesn't care about renames), without reading multi-GB files.
+    '''
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime)
+    if key not in _video_hashes:
+        h = hashlib.sha1(str(st.st_size).encode())
+        with open(path, 'rb') as f:
+            for offset in sorted({0, max(st.st_size // 2 - chunk_size // 2, 0), max(st.st_size - chunk_size, 0)}):
+                f.seek(offset)
+                h.update(f.read(chunk_size))
+        _video_hashes[key] = h.hexdigest()[:n]
+    return _video_hashes[key]
+
+
+# ---------------------------------------------------------------------------- #
+#                                     Masks                                    #
+# ---------------------------------------------------------------------------- #
+
+
+def pack_masks(masks):
+    '''Pack (n, H, W) boolean masks into their (n, 4) x0,y0,x1,y1 crops and the bit-packed crops.'''
+    masks = np.asarray(masks, dtype=bool)
+    n = len(masks)
+    crop = np.zeros((n, 4), dtype=np.int32)
+    bits = []
+    ys, xs = masks.any(2), masks.any(1)
+    for i in range(n):
+        y, x = np.flatnonzero(ys[i]), np.flatnonzero(xs[i])
+        if not len(y):
+            continue
+        crop[i] = x[0], y[0], x[-1] + 1, y[-1] + 1
+        bits.append(np.packbits(masks[i, y[0]:y[-1] + 1, x[0]:x[-1] + 1], axis=None))
+    return crop, (np.concatenate(bits) if bits else np.zeros(0, dtype=np.uint8))
+
+
+def unpack_masks(crop, bits, shape):
+    '''The inverse of ``pack_masks``.'''
+    masks = np.zeros((len(crop), *shape), dtype=bool)
+    offset = 0
+    for i, (x0, y0, x1, y1) in enumerate(crop.tolist()):
+        size = (x1 - x0) * (y1 - y0)
+        if not size:
+            continue
+        nbytes = (size + 7) // 8
+        masks[i, y0:y1, x0:x1] = np.unpackbits(bits[offset:offset + nbytes], count=size).reshape(y1 - y0, x1 - x0)
+        offset += nbytes
+    return masks
+
+
+def encode_arrays(data):
+    '''Prepare a dict of arrays for ``np.savez``: (n, H, W) boolean arrays are packed.'''
+    out = {}
+    for k, v in data.items():
+        v = np.asarray(v)
+        if v.dtype == bool and v.ndim == 3:
+            out[f'{k}.crop'], out[f'{k}.bits'] = pack_masks(v)
+            out[f'{k}.shape'] = np.array(v.shape[1:])
+        else:
+            if v.dtype == object:  # e.g. label arrays built from python strings
+                assert all(isinstance(x, str) for x in v.flat), f"Can't cache {k}: object arrays aren't supported"
+                v = v.astype(str)
+            out[k] = v
+    return out
+
+
+def decode_arrays(data):
+    '''The inverse of ``encode_arrays``.'''
+    out = {}
+    for k in data:
+        if k.endswith('.shape'):
+            name = k[:-len('.shape')]
+            out[name] = unpack_masks(data[f'{name}.crop'], data[f'{name}.bits'], tuple(data[k]))
+        elif not k.endswith(('.crop', '.bits')):
+            out[k] = data[k]
+    return out
+
+
+# ---------------------------------------------------------------------------- #
+#                                     Cache                                    #
+# ---------------------------------------------------------------------------- #
+
+
+class StageCache:
+    '''Cache per-frame stage outputs on disk.
+
+    Arguments:
+        root (str): The cache directory (shared between runs / configs).
+        readonly (bool): Only read from the cache, don't add to it.
+    '''
+    enabled = True
+
+    def __init__(self, root, readonly=False):
+        self.root = root
+        self.readonly = readonly
+        self.video = None
+        self.hits = self.misses = 0
+        self._dirs = {}
+
+    def __repr__(self):
+        return f'StageCache({self.root!r}, video={self.video}, hits={self.hits}, misses={self.misses})'
+
+    @classmethod
+    def from_config(cls, cfg=None):
+        '''Create a cache from ``None``, a directory, a dict, or an existing cache.'''
+        if isinstance(cfg, (cls, NoStageCache)):
+            return cfg
+        if not cfg:
+            return NoStageCache()
+        if isinstance(cfg, str):
+            return cls(cfg)
+        return cls(**cfg)
+
+    def set_video(self, video, content_hash=True):
+        '''Set the video that frames are looked up for. This is the file's content hash, or ``video`` itself as an ID.'''
+        self.video = video_hash(video) if content_hash and os.path.isfile(video) else str(video)
+        return self.video
+
+    def path(self, stage, identity, frame=None):
+        assert self.video is not None, "Call set_video first"
+        key = (self.video, stage, config_hash(identity))
+        d = self._dirs.get(key)
+        if d is None:
+            d = self._dirs[key] = os.path.join(self.root, self.video, f'{stage}-{key[-1]}')
+            meta = os.path.join(d, 'identity.json')
+            if not self.readonly and not os.path.isfile(meta):
+                os.makedirs(d, exist_ok=True)
+                with open(meta, 'wb') as f:
+                    f.write(orjson.dumps(identity, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS, default=str))
+        return d if frame is None else os.path.join(d, f'{int(frame):07d}.npz')
+
+    def get(self, stage, identity, frame):
+        '''The cached arrays for a frame, or None.'''
+        fname = self.path(stage, identity, frame)
+        try:
+            with np.load(fname) as data:
+                out = decode_arrays(data)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:  # e.g. a partial write from a crash - recompute it
+            log.warning("Ignoring bad cache entry %s: %s", fname, e)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return out
+
+    def put(self, stage, identity, frame, data):
+        '''Cache the arrays for a frame.'''
+        if self.readonly:
+            return
+        fname = self.path(stage, identity, frame)
+        # unique per writer, so runs sharing a cache don't clobber each other's partial writes
+        tmp = f'{fname[:-4]}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp.npz'
+        np.savez_compressed(tmp, **encode_arrays(data))
+        os.replace(tmp, fname)
+
+
+class NoStageCache:
+    '''The default: always compute.'''
+    enabled = False
+    video = None
+
+    def __repr__(self):
+        return 'NoStageCache()'
+
+    def set_video(self, video, content_hash=True):
+        pass
+
+    def get(self, stage, identity, frame):
+        return None
+
+    def put(self, stage, identity, frame, data):
+        pass
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Instances                                  #
+# ---------------------------------------------------------------------------- #
+
+
+def instances_to_arrays(instances):
+    '''Convert detectron2 Instances to a dict of numpy arrays (remembering which fields were Boxes / tensors).'''
+    from detectron2.structures import Boxes
+    import torch
+    data, boxes, tensors = {}, [], []
+    for k, v in instances.get_fields().items():
+        if isinstance(v, Boxes):
+            boxes.append(k)
+            v = v.tensor
+        if isinstance(v, torch.Tensor):
+            tensors.append(k)
+            v = v.detach().cpu().numpy()
+        data[k] = v
+    data['__image_size__'] = np.array(instances.image_size)
+    data['__boxes__'] = np.array(boxes, dtype=str)
+    data['__tensors__'] = np.array(tensors, dtype=str)
+    return data
+
+
+def arrays_to_instances(data, device=None):
+    '''The inverse of ``instances_to_arrays``.'''
+    from detectron2.structures import Boxes, Instances
+    import torch
+    data = dict(data)
+    size = tuple(int(x) for x in data.pop('__image_size__'))
+    boxes = set(data.pop('__boxes__').tolist())
+    tensors = set(data.pop('__tensors__').tolist())
+    fields = {}
+    for k, v in data.items():
+        if k in tensors:
+            v = torch.as_tensor(v, device=device)
+        fields[k] = Boxes(v) if k in boxes else v
+    return Instances(size, **fields)
+
+
+def get_instances(cache, stage, identity, frame, device=None):
+    '''Get cached Instances, or None.'''
+    if frame is None or not cache.enabled:
+        return None
+    data = cache.get(stage, identity, frame)
+    return arrays_to_instances(data, device) if data is not None else None
+
+
+def put_instances(cache, stage, identity, frame, instances):
+    '''Cache Instances.'''
+    if frame is None or not cache.enabled:
+        return
+    cache.put(stage, identity, frame, instances_to_arrays(instances))
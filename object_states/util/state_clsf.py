@@ -0,0 +1,316 @@
+'''NumPy-only state classifiers.
+
+The state classifiers trained in ``eval.py`` are sklearn pipelines of a ``StandardScaler``
+followed by a ``LogisticRegression`` or ``KNeighborsClassifier``. Calling sklearn on a few
+rows per frame is dominated by its input validation, so we compile the fitted pipelines
+down to a couple of matrix ops.
+
+    clsf = compile_pipeline(joblib.load('tortilla.joblib'))
+    clsf.predict_proba(Z)  # (n, n_classes)
+
+They can also be exported to a bundle of ``.npy`` files that loads (memory-mapped)
+without pickle or sklearn:
+
+    export_bundle(pipeline, 'state_clsfs/tortilla', labels=labels)
+    clsf = load_bundle('state_clsfs/tortilla')
+
+'''
+import os
+import json
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class NumpyStateClassifier:
+    '''A fitted ``[scaler +] (logreg | knn)`` pipeline with a NumPy ``predict_proba``.
+
+    Arguments:
+        kind (str): ``'logreg'`` or ``'knn'``.
+        classes (np.ndarray): The class for each column of ``predict_proba``.
+        mean, scale (np.ndarray): Standard scaler parameters. ``None`` to skip.
+        coef, intercept (np.ndarray): Logistic regression weights ``(n_classes|1, d)``, ``(n_classes|1,)``.
+        multinomial (bool): Softmax (multinomial) vs. one-vs-rest logistic regression.
+        X, y (np.ndarray): kNN prototypes ``(n, d)`` (already scaled) and their class indices ``(n,)``.
+        n_neighbors (int): Number of neighbours for kNN.
+        weights (str): kNN weighting, ``'uniform'`` or ``'distance'``.
+        X_sqnorm (np.ndarray): The precomputed squared norm of each kNN prototype.
+
+    Predictions are computed in the dtype of the weights/prototypes.
+    '''
+    def __init__(self, kind, classes, mean=None, scale=None, coef=None, intercept=None, multinomial=True,
+                 X=None, y=None, n_neighbors=5, weights='uniform', X_sqnorm=None):
+        assert kind in ('logreg', 'knn'), f"Unsupported classifier type {kind}"
+        self.kind = kind
+        self.classes_ = np.asarray(classes)
+        self.mean = mean
+        self.scale = scale
+        self.coef = coef
+        self.intercept = intercept
+        self.multinomial = multinomial
+        self.X = X
+        self.y = y
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        if X is not None and X_sqnorm is None:
+            X_sqnorm = (X ** 2).sum(1)
+        self.X_sqnorm = X_sqnorm
+        self.dtype = (coef if coef is not None else X).dtype
+
+    def __repr__(self):
+        d = self.coef.shape[1] if self.coef is not None else self.X.shape[1]
+        extra = f'k={self.n_neighbors}, n={len(self.X)}' if self.kind == 'knn' else f'multinomial={self.multinomial}'
+        return f'NumpyStateClassifier({self.kind}, d={d}, classes={len(self.classes_)}, {extra})'
+
+    def transform(self, X):
+        X = np.asarray(X, dtype=self.dtype)
+        if self.mean is not None:
+            X = X - self.mean
+        if self.scale is not None:
+            X = X / self.scale
+        return X
+
+    def predict_proba(self, X):
+        X = self.transform(np.atleast_2d(X))
+        if self.kind == 'logreg':
+            return self._logreg_proba(X)
+        return self._knn_proba(X)
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+    def _logreg_proba(self, X):
+        z = X @ self.coef.T + self.intercept
+        if z.shape[1] == 1:  # binary
+            p = _sigmoid(z[:, 0])
+            return np.stack([1 - p, p], axis=1)
+        if self.multinomial:
+            z = np.exp(z - z.max(1, keepdims=True))
+            return z / z.sum(1, keepdims=True)
+        p = _sigmoid(z)
+        return p / p.sum(1, keepdims=True)
+
+    def _knn_proba(self, X):
+        k = min(self.n_neighbors, len(self.X))
+        # squared euclidean distance to every prototype
+        d2 = (X ** 2).sum(1)[:, None] - 2 * X @ self.X.T + self.X_sqnorm[None]
+        idx = np.argpartition(d2, k - 1, axis=1)[:, :k]
+        if self.weights == 'distance':
+            dist = np.sqrt(np.maximum(np.take_along_axis(d2, idx, 1), 0))
+            with np.errstate(divide='ignore'):
+                w = 1. / dist
+            # exact matches get all of the weight
+            exact = np.isinf(w)
+            w[exact.any(1)] = exact[exact.any(1)]
+        else:
+            w = np.ones(idx.shape)
+        proba = np.zeros((len(X), len(self.classes_)))
+        np.add.at(proba, (np.arange(len(X))[:, None], self.y[idx]), w)
+        return proba / proba.sum(1, keepdims=True)
+
+    def arrays(self):
+        return {k: getattr(self, k) for k in BUNDLE_ARRAYS if getattr(self, k) is not None}
+
+
+def _sigmoid(z):
+    return 1. / (1. + np.exp(-z))
+
+
+# ---------------------------------------------------------------------------- #
+#                              Compiling sklearn                               #
+# ---------------------------------------------------------------------------- #
+
+
+def compile_pipeline(pipeline):
+    '''Convert a fitted sklearn ``[StandardScaler +] LogisticRegression|KNeighborsClassifier``
+    (pipeline or bare estimator) to a ``NumpyStateClassifier``.
+
+    Raises:
+        TypeError: if the pipeline contains something we can't compile.
+    '''
+    steps = [s for _, s in pipeline.steps] if hasattr(pipeline, 'steps') else [pipeline]
+    steps = [s for s in steps if s is not None and s != 'passthrough']
+    *pre, model = steps
+
+    mean = scale = None
+    for s in pre:
+        if type(s).__name__ != 'StandardScaler' or mean is not None or scale is not None:
+            raise TypeError(f"Can't compile preprocessing step {s}")
+        mean = s.mean_ if s.with_mean else None
+        scale = s.scale_ if s.with_std else None
+
+    name = type(model).__name__
+    if name == 'LogisticRegression':
+        multi = getattr(model, 'multi_class', 'auto')
+        ovr = multi == 'ovr' or (multi in ('auto', 'deprecated', None) and model.solver == 'liblinear')
+        return NumpyStateClassifier(
+            'logreg', model.classes_, mean, scale,
+            coef=np.asarray(model.coef_, dtype=np.float64),
+            intercept=np.asarray(model.intercept_, dtype=np.float64),
+            multinomial=not ovr)
+    if name == 'KNeighborsClassifier':
+        if model.effective_metric_ != 'euclidean' or callable(model.weights):
+            raise TypeError(f"Can't compile kNN with metric={model.effective_metric_} weights={model.weights}")
+        if np.ndim(model._y) != 1:
+            raise TypeError("Can't compile multi-output kNN")
+        return NumpyStateClassifier(
+            'knn', model.classes_, mean, scale,
+            X=np.asarray(model._fit_X, dtype=np.float64),
+            y=np.asarray(model._y),
+            n_neighbors=model.n_neighbors,
+            weights=model.weights)
+    raise TypeError(f"Can't compile model {model}")
+
+
+def parity_inputs(compiled, n=256, seed=0):
+    '''Probe inputs that look like the training data.'''
+    rng = np.random.default_rng(seed)
+    d = compiled.coef.shape[1] if compiled.coef is not None else compiled.X.shape[1]
+    X = rng.normal(size=(n, d))
+    if compiled.kind == 'knn':
+        # jitter the prototypes so we're testing realistic neighbourhoods
+        X = compiled.X[rng.integers(0, len(compiled.X), n)] + 0.1 * X
+    mean = compiled.mean if compiled.mean is not None else 0
+    scale = compiled.scale if compiled.scale is not None else 1
+    return X * scale + mean
+
+
+def check_parity(pipeline, compiled, X=None):
+    '''Compare the compiled classifier against the original sklearn outputs.
+
+    Returns:
+        max_err (float): The max absolute difference in probabilities.
+        agreement (float): The fraction of argmax predictions that match.
+    '''
+    X = parity_inputs(compiled) if X is None else X
+    p_ref = pipeline.predict_proba(X)
+    p = compiled.predict_proba(X)
+    assert p.shape == p_ref.shape, f"Shape mismatch {p.shape} != {p_ref.shape}"
+    return np.abs(p - p_ref).max(), (p.argmax(1) == p_ref.argmax(1)).mean()
+
+
+def compile_state_classifier(pipeline, X=None, atol=1e-5, min_agreement=0.99):
+    '''Compile a pipeline and check it against sklearn. Falls back to the sklearn pipeline
+    if it can't be compiled or if the outputs don't match.'''
+    try:
+        compiled = compile_pipeline(pipeline)
+    except (TypeError, AttributeError) as e:
+        log.warning("Using sklearn: %s", e)
+        return pipeline
+    err, agreement = check_parity(pipeline, compiled, X)
+    # kNN ties can be broken differently, so allow a little disagreement there
+    if err > atol and (compiled.kind != 'knn' or agreement < min_agreement):
+        log.warning("Using sklearn: compiled %s differs (max err %.2g, agreement %.3f)", compiled, err, agreement)
+        return pipeline
+    log.info("Compiled %s (max err %.2g)", compiled, err)
+    return compiled
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Bundles                                   #
+# ---------------------------------------------------------------------------- #
+
+BUNDLE_VERSION = 1
+BUNDLE_META = 'bundle.json'
+BUNDLE_ARRAYS = ['mean', 'scale', 'coef', 'intercept', 'X', 'y', 'X_sqnorm']
+
+
+def export_bundle(pipeline, out_dir, labels=None, dtype=np.float32, check=True):
+    '''Export a fitted pipeline to a bundle directory:
+
+        {out_dir}/bundle.json    version, classifier type, hyperparameters, labels
+        {out_dir}/{array}.npy    scaler, weights / prototypes
+
+    Arguments:
+        pipeline: A sklearn pipeline (see ``compile_pipeline``) or a ``NumpyStateClassifier``.
+        out_dir (str): The bundle directory.
+        labels (list): The state label for each class. Defaults to the classes.
+        dtype: The dtype to store float arrays as.
+        check (bool): Compare the exported bundle with the sklearn outputs.
+    '''
+    clsf = pipeline if isinstance(pipeline, NumpyStateClassifier) else compile_pipeline(pipeline)
+    labels = clsf.classes_ if labels is None else labels
+    assert len(labels) == len(clsf.classes_), f"Expected {len(clsf.classes_)} labels, got {len(labels)}"
+
+    os.makedirs(out_dir, exist_ok=True)
+    arrays = {}
+    for k, x in clsf.arrays().items():
+        x = np.ascontiguousarray(x, dtype=dtype if x.dtype.kind == 'f' else None)
+        np.save(os.path.join(out_dir, f'{k}.npy'), x, allow_pickle=False)
+        arrays[k] = [list(x.shape), x.dtype.str]
+    meta = {
+        'version': BUNDLE_VERSION,
+        'kind': clsf.kind,
+        'classes': np.asarray(clsf.classes_).tolist(),
+        'labels': np.asarray(labels).tolist(),
+        'multinomial': clsf.multinomial,
+        'n_neighbors': clsf.n_neighbors,
+        'weights': clsf.weights,
+        'arrays': arrays,
+    }
+    with open(os.path.join(out_dir, BUNDLE_META), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    if check and not isinstance(pipeline, NumpyStateClassifier):
+        err, agreement = check_parity(pipeline, load_bundle(out_dir))
+        log.info("Exported %s to %s (max err %.2g, agreement %.3f)", clsf, out_dir, err, agreement)
+    return out_dir
+
+
+def load_bundle(bundle_dir, mmap_mode='r'):
+    '''Load a bundle exported with ``export_bundle``. The arrays are memory-mapped by default.'''
+    with open(os.path.join(bundle_dir, BUNDLE_META)) as f:
+        meta = json.load(f)
+    if meta['version'] > BUNDLE_VERSION:
+        raise ValueError(f"{bundle_dir} is bundle version {meta['version']} but we only support <= {BUNDLE_VERSION}")
+    arrays = {
+        k: np.load(os.path.join(bundle_dir, f'{k}.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+        for k in meta['arrays']
+    }
+    clsf = NumpyStateClassifier(
+        meta['kind'], meta['classes'],
+        multinomial=meta['multinomial'],
+        n_neighbors=meta['n_neighbors'],
+        weights=meta['weights'],
+        **arrays)
+    clsf.labels = np.asarray(meta['labels'])
+    clsf.version = meta['version']
+    return clsf
+
+
+def is_bundle(path):
+    return os.path.isfile(os.path.join(path, BUNDLE_META))
+
+
+def export(*fnames, out_dir=None, dtype='float32'):
+    '''Export saved pipelines to bundles next to them (or in ``out_dir``). Labels are read
+    from ``{name}.txt`` if it exists, like ``custom_state_clsf_fname``.
+
+    ``python -m object_states.util.state_clsf export state_clsfs/*.joblib``
+    '''
+    import joblib
+    logging.basicConfig(level=logging.INFO)
+    for f in fnames:
+        base = os.path.splitext(f)[0]
+        labels = None
+        if os.path.isfile(f'{base}.txt'):
+            labels = [l.strip() for l in open(f'{base}.txt').readlines() if l.strip()]
+        out = os.path.join(out_dir, os.path.basename(base)) if out_dir else base
+        export_bundle(joblib.load(f), out, labels=labels, dtype=np.dtype(dtype))
+        print(f'{f} -> {out}')
+
+
+def parity(*fnames):
+    '''Check parity for saved pipelines: ``python -m object_states.util.state_clsf parity models/*.joblib``'''
+    import joblib
+    for f in fnames:
+        pipeline = joblib.load(f)
+        compiled = compile_pipeline(pipeline)
+        err, agreement = check_parity(pipeline, compiled)
+        print(f'{f}: {compiled} max err={err:.2g} agreement={agreement:.3f}')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire()
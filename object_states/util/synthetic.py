@@ -0,0 +1,125 @@
+import os
+import cv2
+import numpy as np
+
+
+# ---------------------------------------------------------------------------- #
+#                                Synthetic Video                               #
+# ---------------------------------------------------------------------------- #
+
+
+class SyntheticScene:
+    '''A deterministic scene of colored blobs bouncing around a textured background.
+
+    Useful for benchmarking the pipeline without needing real recordings.
+
+    Arguments:
+        size (tuple): The frame size (w, h).
+        n_objects (int): The number of moving objects.
+        seed (int): The random seed. The same seed always gives the same video.
+    '''
+    def __init__(self, size=(640, 480), n_objects=5, seed=0):
+        self.size = W, H = tuple(size)
+        self.n_objects = n_objects
+        rng = np.random.default_rng(seed)
+        # static textured background
+        self.background = cv2.GaussianBlur(rng.integers(0, 255, (H, W, 3), dtype=np.uint8), (0, 0), 5)
+        # object motion and appearance
+        s = min(W, H)
+        self.radius = rng.uniform(0.04, 0.12, (n_objects, 2)) * s
+        self.start = rng.uniform(0.2, 0.8, (n_objects, 2)) * [W, H]
+        self.velocity = rng.uniform(-0.01, 0.01, (n_objects, 2)) * s
+        self.colors = rng.integers(0, 255, (n_objects, 3))
+        self.track_ids = np.arange(1, n_objects + 1)
+
+    def centers(self, i):
+        W, H = self.size
+        lo, hi = self.radius, np.array([W, H]) - self.radius
+        # bounce off of the frame edges
+        p = self.start + self.velocity * i - lo
+        span = np.maximum(hi - lo, 1)
+        p = np.abs((p + span) % (2 * span) - span)
+        return p + lo
+
+    def objects(self, i):
+        '''Get the boxes (n, 4) xyxy, masks (n, h, w) and track ids (n,) for frame i.'''
+        W, H = self.size
+        c = self.centers(i)
+        xyxy = np.concatenate([c - self.radius, c + self.radius], axis=1)
+        xyxy = np.clip(xyxy, 0, [W - 1, H - 1, W - 1, H - 1]).astype(np.float32)
+        masks = np.zeros((self.n_objects, H, W), dtype=bool)
+        for m, (x, y), (rx, ry) in zip(masks, c.astype(int), self.radius.astype(int)):
+            cv2.ellipse(m.view(np.uint8), (x, y), (rx, ry), 0, 0, 360, 1, -1)
+        return xyxy, masks, self.track_ids.copy()
+
+    def frame(self, i):
+        '''Render frame i (BGR, uint8).'''
+        frame = self.background.copy()
+        c = self.centers(i).astype(int)
+        for (x, y), (rx, ry), color in zip(c, self.radius.astype(int), self.colors.tolist()):
+            cv2.ellipse(frame, (x, y), (rx, ry), 0, 0, 360, color, -1)
+        return frame
+
+    def __iter__(self):
+        i = 0
+        while True:
+            yield self.frame(i)
+            i += 1
+
+
+def synthetic_frames(n_frames, **kw):
+    scene = SyntheticScene(**kw)
+    for i in range(n_frames):
+        yield scene.frame(i)
+
+
+def synthetic_video(path, n_frames=300, fps=30, size=(640, 480), **kw):
+    '''Write a synthetic video to disk (if it doesn't already exist) and return its path.'''
+    if os.path.isfile(path):
+        return path
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, tuple(size))
+    try:
+        for frame in synthetic_frames(n_frames, size=size, **kw):
+            writer.write(frame)
+    finally:
+        writer.release()
+    return path
+
+
+def synthetic_recording(n_frames=90, fps=15, depth_fps=5, size=(640, 480), depth_size=(160, 120), distance=2., n_objects=5, seed=0, t0=1700000000000):
+    '''A recorded HoloLens-style session: ``main`` frames, ``depthlt`` frames and one ``depthltCal``.
+
+    The cameras sit at the world origin looking down -Z at a wall ``distance`` meters away, so the
+    true 3D point of every box center is known. Yields (stream_id, time (ms), message) in time order.
+    ``main`` messages also have the ground truth ``xyxy`` boxes and their ``xyz`` centers.
+    '''
+    W, H = size
+    scene = SyntheticScene(size=size, n_objects=n_objects, seed=seed)
+    rng = np.random.default_rng(seed)
+    focal, principal = np.array([W, W], dtype=float), np.array([W / 2, H / 2])
+
+    # depth camera: unit rays and the (radial) depth to the wall
+    dw, dh = depth_size
+    j, i = np.meshgrid(np.arange(dw), np.arange(dh))
+    rays = np.stack([(j - dw / 2) / (dw / 2), -(i - dh / 2) / (dw / 2), -np.ones_like(j, dtype=float)], -1).reshape(-1, 3)
+    norm = np.linalg.norm(rays, axis=1)
+    depth = (distance * norm * 1000).astype(np.uint16).reshape(dh, dw)
+    yield 'depthltCal', t0, {'lut': rays / norm[:, None], 'rig2cam': np.eye(4)}
+
+    messages = []
+    for k in range(n_frames):
+        t = t0 + int(1000 * k / fps)
+        xyxy, _, track_ids = scene.objects(k)
+        c = (xyxy[:, :2] + xyxy[:, 2:]) / 2
+        xyz = np.stack([(c[:, 0] - principal[0]) / focal[0], -(c[:, 1] - principal[1]) / focal[1], -np.ones(len(c))], 1) * distance
+        messages.append((t, 'main', {
+            'image': scene.frame(k)[:, :, ::-1], 'focalX': focal[0], 'focalY': focal[1],
+            'principalX': principal[0], 'principalY': principal[1], 'cam2world': np.eye(4),
+            'xyxy': xyxy, 'xyz': xyz, 'track_ids': track_ids,
+        }))
+    for k in range(int(n_frames * depth_fps / fps)):
+        t = t0 + int(1000 * k / depth_fps + rng.uniform(-20, 20))
+        messages.append((t, 'depthlt', {'image': depth, 'rig2world': np.eye(4)}))
+    for t, sid, msg in sorted(messages, key=lambda x: x[0]):
+        yield sid, t, msg
@@ -0,0 +1,235 @@
+'''Align timestamped streams (e.g. main + depthlt + depthltCal) and lift 2D boxes into 3D with depth.
+
+``TimeBuffer`` keeps a stream's messages sorted by time so lookups are a bisect, not a scan.
+``StreamAligner`` holds a buffer per stream and finds each stream's message for a reference time.
+``DepthLifter`` projects a depth frame into the RGB camera and finds a 3D point for every box
+at once. The depth camera's ray grid (from the calibration ``lut``) is cached per calibration.
+'''
+import bisect
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+# ---------------------------------------------------------------------------- #
+#                                  Time Series                                 #
+# ---------------------------------------------------------------------------- #
+
+class TimeBuffer:
+    '''A bounded buffer of (time, value) sorted by time.
+
+    Arguments:
+        maxlen (int): How many values to keep (the oldest are dropped). 0 for no limit.
+    '''
+    def __init__(self, maxlen=0):
+        self.maxlen = maxlen
+        self.times = []
+        self.values = []
+
+    def __len__(self):
+        return len(self.times)
+
+    def __contains__(self, t):
+        i = bisect.bisect_left(self.times, t)
+        return i < len(self.times) and self.times[i] == t
+
+    def add(self, t, value):
+        if not self.times or t >= self.times[-1]:
+            # the usual case: messages arrive in order
+            self.times.append(t)
+            self.values.append(value)
+        else:
+            i = bisect.bisect_right(self.times, t)
+            self.times.insert(i, t)
+            self.values.insert(i, value)
+        if self.maxlen and len(self.times) > self.maxlen:
+            del self.times[:-self.maxlen], self.values[:-self.maxlen]
+
+    def _index(self, t, side):
+        if side == 'before':
+            i = bisect.bisect_right(self.times, t) - 1
+            return i if i >= 0 else None
+        if side == 'after':
+            i = bisect.bisect_left(self.times, t)
+            return i if i < len(self.times) else None
+        i = bisect.bisect_left(self.times, t)
+        if i == len(self.times) or i and t - self.times[i - 1] <= self.times[i] - t:
+            i -= 1
+        return i if i >= 0 else None
+
+    def get(self, t, tol=None, side='closest'):
+        '''Get the (time, value) closest to t (or the last ``before`` / first ``after`` it).
+
+        Returns None if there's nothing within ``tol`` of t.
+        '''
+        i = self._index(t, side)
+        if i is None or tol is not None and abs(self.times[i] - t) > tol:
+            return None
+        return self.times[i], self.values[i]
+
+    def window(self, t0, t1):
+        '''Get the (time, value) pairs with t0 <= time <= t1.'''
+        i, j = bisect.bisect_left(self.times, t0), bisect.bisect_right(self.times, t1)
+        return list(zip(self.times[i:j], self.values[i:j]))
+
+    def prune(self, t):
+        '''Drop everything before t.'''
+        i = bisect.bisect_left(self.times, t)
+        del self.times[:i], self.values[:i]
+
+
+class StreamAligner:
+    '''Buffer several streams and get each one's message for a time.
+
+    .. code-block:: python
+
+        align = StreamAligner({'depthlt': 300, 'depthltCal': None}, maxlen={'depthltCal': 1})
+        for sid, t, msg in player:
+            if sid == 'main':
+                depth, cal = align.align(t, ['depthlt', 'depthltCal'])
+            else:
+                align.add(sid, t, msg)
+
+    Arguments:
+        tolerance (dict): The max time difference for each stream. None means any time.
+        maxlen (dict, int): How many messages to keep for each stream.
+        side (dict): ``closest`` (default), ``before`` (e.g. calibration, or to never look ahead) or ``after``.
+    '''
+    def __init__(self, tolerance=None, maxlen=16, side=None):
+        self.tolerance = tolerance or {}
+        self.maxlen = maxlen
+        self.side = side or {}
+        self.buffers = {}
+
+    def buffer(self, sid):
+        if sid not in self.buffers:
+            maxlen = self.maxlen.get(sid, 16) if isinstance(self.maxlen, dict) else self.maxlen
+            self.buffers[sid] = TimeBuffer(maxlen)
+        return self.buffers[sid]
+
+    def add(self, sid, t, value):
+        self.buffer(sid).add(t, value)
+
+    def get(self, sid, t, tol=None, side=None):
+        '''Get the (time, value) for a stream, or None if there isn't one within tolerance.'''
+        tol = tol if tol is not None else self.tolerance.get(sid)
+        return self.buffer(sid).get(t, tol, side or self.side.get(sid, 'closest'))
+
+    def align(self, t, streams=None):
+        '''Get the values of several streams for time t (None for a stream without one in tolerance).'''
+        return [(x[1] if x is not None else None) for x in (self.get(s, t) for s in streams or self.buffers)]
+
+
+# ---------------------------------------------------------------------------- #
+#                                   3D Lifting                                 #
+# ---------------------------------------------------------------------------- #
+
+
+class DepthLifter:
+    '''Find a world point for each 2D box using a depth frame.
+
+    Each depth pixel is lifted with its calibration ray and projected into the RGB image.
+    For every box the depth point closest to the box center (and inside the box) is picked.
+
+    Arguments:
+        max_dist (float): Boxes whose closest depth point is further than this (RGB pixels)
+            from their center are not valid.
+        depth_scale (float): Depth units per meter.
+        max_depth (float): Ignore depth beyond this (meters).
+        opengl (bool): The RGB camera looks down -Z with +Y up (HoloLens), instead of +Z / +Y down.
+        stride (int): Only use every Nth depth pixel.
+    '''
+    def __init__(self, max_dist=None, depth_scale=1000, max_depth=None, opengl=True, stride=1, max_cached=4):
+        self.max_dist = max_dist
+        self.depth_scale = depth_scale
+        self.max_depth = max_depth
+        self.opengl = opengl
+        self.stride = stride
+        self.max_cached = max_cached
+        self._rays = {}
+
+    def rays(self, calib):
+        '''The calibration's (n, 3) unit-depth rays and cam2rig transform. Cached per calibration.'''
+        key = id(calib['lut'])
+        if key not in self._rays:
+            if len(self._rays) >= self.max_cached:
+                self._rays.pop(next(iter(self._rays)))
+            rays = np.asarray(calib['lut'], dtype=np.float32).reshape(-1, 3)
+            cam2rig = np.linalg.inv(np.asarray(calib['rig2cam'], dtype=np.float64))
+            self._rays[key] = (calib['lut'], rays[::self.stride], cam2rig)
+            log.debug("Cached %d depth rays", len(rays))
+        return self._rays[key][1:]
+
+    def camera_points(self, depth, calib, image_params):
+        '''Lift a depth frame to (n, 3) points in the RGB camera's frame (+Z forward), in one transform.'''
+        rays, cam2rig = self.rays(calib)
+        z = np.asarray(depth['image'], dtype=np.float32).reshape(-1)[::self.stride] * np.float32(1 / self.depth_scale)
+        if self.max_depth:
+            z[z >= self.max_depth] = 0
+        # depth camera -> rig -> world -> rgb camera
+        world2rgb = np.linalg.inv(np.asarray(image_params['cam2world'], dtype=np.float64))
+        T = world2rgb @ np.asarray(depth['rig2world'], dtype=np.float64) @ cam2rig
+        if self.opengl:
+            T = np.diag([1, -1, -1, 1]) @ T
+        p = (rays * z[:, None]) @ T[:3, :3].T.astype(np.float32) + T[:3, 3].astype(np.float32)
+        p[z <= 0, 2] = 0  # no depth reading
+        return p
+
+    def project(self, p, image_params):
+        '''Project camera points into the RGB image. Returns (n, 2) pixels and a mask of the points in front of the camera.'''
+        front = p[:, 2] > 1e-6
+        p = p[front]
+        uv = p[:, :2] / p[:, 2:]
+        uv = uv * np.asarray(image_params['focal'], dtype=np.float32) + np.asarray(image_params['principal'], dtype=np.float32)
+        return uv, front
+
+    def to_world(self, p, image_params):
+        '''Convert RGB camera points (+Z forward) back to world points.'''
+        T = np.asarray(image_params['cam2world'], dtype=np.float64)
+        if self.opengl:
+            T = T @ np.diag([1, -1, -1, 1])
+        return p @ T[:3, :3].T.astype(np.float32) + T[:3, 3].astype(np.float32)
+
+    def lift(self, xyxy, image_params, depth, calib):
+        '''Get a world point for each box.
+
+        Arguments:
+            xyxy (np.ndarray): (n, 4) boxes in RGB pixels.
+            image_params (dict): The RGB camera's ``cam2world``, ``focal`` and ``principal``.
+            depth (dict): The depth frame's ``image`` and ``rig2world``.
+            calib (dict): The depth camera's ``lut`` and ``rig2cam``.
+
+        Returns:
+            xyz (n, 3) world points (NaN if there's no depth in the box), the distance (pixels) from
+            each box center to its point, and which boxes are valid.
+        '''
+        xyxy = np.asarray(xyxy, dtype=np.float32).reshape(-1, 4)
+        n = len(xyxy)
+        xyz = self.camera_points(depth, calib, image_params)
+        uv, front = self.project(xyz, image_params)
+        xyz = xyz[front]
+
+        # only keep points that land in some box
+        lo, hi = xyxy[:, :2].min(0, initial=np.inf), xyxy[:, 2:].max(0, initial=-np.inf)
+        keep = np.all((uv >= lo) & (uv <= hi), axis=1)
+        xyz, uv = xyz[keep], uv[keep]
+
+        # (boxes, points) squared distance to each box center, inf outside the box
+        center = (xyxy[:, :2] + xyxy[:, 2:]) / 2
+        inside = (
+            (uv[None, :, 0] >= xyxy[:, None, 0]) & (uv[None, :, 0] <= xyxy[:, None, 2]) &
+            (uv[None, :, 1] >= xyxy[:, None, 1]) & (uv[None, :, 1] <= xyxy[:, None, 3]))
+        d2 = ((uv[None] - center[:, None]) ** 2).sum(-1)
+        d2[~inside] = np.inf
+        out = np.full((n, 3), np.nan, dtype=np.float32)
+        dist = np.full(n, np.inf, dtype=np.float32)
+        if len(uv):
+            i = d2.argmin(1)
+            found = np.isfinite(d2[np.arange(n), i])
+            out[found] = self.to_world(xyz[i[found]], image_params)
+            dist[found] = np.sqrt(d2[np.arange(n), i][found])
+        valid = np.isfinite(dist)
+        if self.max_dist is not None:
+            valid &= dist < self.max_dist
+        return out, dist, valid
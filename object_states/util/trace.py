@@ -0,0 +1,239 @@
+'''Lightweight per-frame tracing.
+
+.. code-block:: python
+
+    from object_states.util import trace
+
+    tracer = trace.enable(memory_every=30)
+    for i, frame in enumerate(frames):
+        trace.set_frame(i)
+        with trace.span('detect'):
+            dets = detect(frame)
+            trace.annotate(n=len(dets))
+    tracer.save_chrome('trace.json')  # open in chrome://tracing or ui.perfetto.dev
+    print(tracer.summary())
+    trace.disable()
+
+When tracing is disabled (the default), ``span`` returns a shared no-op context and
+``annotate`` / ``set_frame`` return immediately, so the spans can stay in the hot loop.
+'''
+import os
+import time
+import bisect
+import threading
+import contextlib
+import orjson
+import numpy as np
+
+NULL = contextlib.nullcontext()
+_tracer = None
+
+
+def enable(**kw):
+    '''Start tracing. Returns the ``Tracer``.'''
+    global _tracer
+    _tracer = Tracer(**kw)
+    return _tracer
+
+
+def disable():
+    '''Stop tracing. Returns the ``Tracer`` that was recording (if any).'''
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def span(name, **args):
+    '''Time a block. ``args`` (and the current frame) are attached to the span.'''
+    if _tracer is None:
+        return NULL
+    return _tracer.span(name, **args)
+
+
+def annotate(**args):
+    '''Add args (e.g. object counts) to the innermost open span on this thread.'''
+    if _tracer is not None:
+        _tracer.annotate(**args)
+
+
+def set_frame(i):
+    '''Set the frame index that's attached to new spans. Also samples memory every ``memory_every`` frames.'''
+    if _tracer is not None:
+        _tracer.set_frame(i)
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Tracer                                    #
+# ---------------------------------------------------------------------------- #
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'args', 't0', 'c0')
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.tracer._stack().append(self)
+        if self.tracer.cpu:
+            self.c0 = time.process_time()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *a):
+        t1 = time.perf_counter()
+        if self.tracer.cpu:
+            self.args['cpu_ms'] = (time.process_time() - self.c0) * 1000
+        self.tracer._stack().pop()
+        self.tracer.events.append((self.name, self.t0, t1 - self.t0, threading.get_ident(), self.args))
+
+
+class Tracer:
+    '''Record spans and memory samples.
+
+    Arguments:
+        memory_every (int): Sample RSS and torch memory every N frames. 0 to disable.
+        cpu (bool): Also record each span's process CPU time (all threads, so only meaningful
+            for spans that aren't running alongside other busy threads).
+    '''
+    def __init__(self, memory_every=30, cpu=False):
+        self.memory_every = memory_every
+        self.cpu = cpu
+        self.frame = None
+        self.events = []   # (name, start, duration, thread, args)
+        self.memory = []   # (time, frame, {name: bytes})
+        self.t0 = time.perf_counter()
+        self._local = threading.local()
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def span(self, name, **args):
+        if self.frame is not None:
+            args.setdefault('frame', self.frame)
+        return Span(self, name, args)
+
+    def annotate(self, **args):
+        stack = self._stack()
+        if stack:
+            stack[-1].args.update(args)
+
+    def set_frame(self, i):
+        self.frame = i
+        if self.memory_every and i is not None and not i % self.memory_every:
+            self.sample_memory()
+
+    def sample_memory(self):
+        '''Record the process RSS and (if torch is loaded) tensor memory.'''
+        self.memory.append((time.perf_counter(), self.frame, memory_usage()))
+
+    # --------------------------------- Export --------------------------------- #
+
+    def chrome_events(self):
+        pid = os.getpid()
+        us = lambda t: (t - self.t0) * 1e6
+        events = [
+            {'name': name, 'ph': 'X', 'ts': us(t), 'dur': dt * 1e6, 'pid': pid, 'tid': tid, 'args': args}
+            for name, t, dt, tid, args in self.events
+        ]
+        events += [
+            {'name': 'memory', 'ph': 'C', 'ts': us(t), 'pid': pid, 'args': {k: v / 2**20 for k, v in mem.items()}}
+            for t, frame, mem in self.memory
+        ]
+        return events
+
+    def save_chrome(self, fname):
+        '''Write a Chrome trace (chrome://tracing, ui.perfetto.dev).'''
+        os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+        with open(fname, 'wb') as f:
+            f.write(orjson.dumps({'traceEvents': self.chrome_events(), 'displayTimeUnit': 'ms'}, option=orjson.OPT_SERIALIZE_NUMPY))
+        return fname
+
+    def durations(self):
+        '''{span name: durations in ms}'''
+        out = {}
+        for name, _, dt, _, _ in self.events:
+            out.setdefault(name, []).append(dt * 1000)
+        return {k: np.array(v) for k, v in out.items()}
+
+    def cpu_times(self):
+        '''{span name: total CPU seconds} (if ``cpu=True``)'''
+        out = {}
+        for name, _, _, _, args in self.events:
+            if 'cpu_ms' in args:
+                out[name] = out.get(name, 0) + args['cpu_ms'] / 1000
+        return out
+
+    def summary(self):
+        '''Per-stage latency percentiles (ms) as a DataFrame.'''
+        import pandas as pd
+        rows = [
+            {'stage': k, 'count': len(v), 'total_s': v.sum() / 1000, 'mean': v.mean(),
+             'p50': np.percentile(v, 50), 'p90': np.percentile(v, 90), 'p99': np.percentile(v, 99), 'max': v.max()}
+            for k, v in self.durations().items()
+        ]
+        df = pd.DataFrame(rows, columns=['stage', 'count', 'total_s', 'mean', 'p50', 'p90', 'p99', 'max']).set_index('stage')
+        cpu = self.cpu_times()
+        if cpu:
+            df['cpu_s'] = pd.Series(cpu)
+        if self.memory:
+            peak = {}
+            for _, _, mem in self.memory:
+                for k, v in mem.items():
+                    peak[k] = max(peak.get(k, 0), v)
+            df.attrs['peak_memory_mb'] = {k: v / 2**20 for k, v in peak.items()}
+        return df.sort_values('total_s', ascending=False)
+
+    def histogram(self, bins=(0.1, 0.3, 1, 3, 10, 30, 100, 300, 1000, 3000), width=30):
+        '''A text histogram of each stage's latency (ms).'''
+        lines = []
+        labels = [f'<{b:g}' for b in bins] + [f'>={bins[-1]:g}']
+        for name, v in self.durations().items():
+            counts = np.bincount([bisect.bisect_right(bins, x) for x in v], minlength=len(bins) + 1)
+            lines.append(f'{name} (n={len(v)}, ms)')
+            top = counts.max() or 1
+            lines += [
+                f'  {l:>7} {"#" * int(np.ceil(width * c / top)):<{width}} {c}'
+                for l, c in zip(labels, counts) if c
+            ]
+        return '\n'.join(lines)
+
+    def report(self, out_dir=None, name='trace'):
+        '''Print the summary + histograms and (optionally) save the chrome trace and summary csv.'''
+        df = self.summary()
+        print(df.to_string(float_format='%.2f'))
+        if df.attrs.get('peak_memory_mb'):
+            print('peak memory (MB):', {k: round(v, 1) for k, v in df.attrs['peak_memory_mb'].items()})
+        print(self.histogram())
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+            df.to_csv(os.path.join(out_dir, f'{name}_summary.csv'))
+            print('Wrote', self.save_chrome(os.path.join(out_dir, f'{name}.json')))
+        return df
+
+
+def memory_usage():
+    '''{rss, cuda_allocated, cuda_reserved} in bytes (cuda only if torch is already imported and has a GPU).'''
+    mem = {}
+    try:
+        with open('/proc/self/statm') as f:
+            mem['rss'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        mem['rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    import sys
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available():
+        mem['cuda_allocated'] = torch.cuda.memory_allocated()
+        mem['cuda_reserved'] = torch.cuda.memory_reserved()
+    return mem
@@ -1,11 +1,15 @@
 import os
 import glob
+import shutil
+import subprocess
 import tqdm
-from collections import Counter
+from collections import Counter, OrderedDict
 import cv2
 import numpy as np
 import supervision as sv
 
+from .data_output import BackgroundWriter
+
 
 
 # ---------------------------------------------------------------------------- #
@@ -25,16 +29,202 @@ class DetectionAnnotator:
         return frame
 
 
+# supervision's default palette (BGR)
+DEFAULT_PALETTE = np.array([
+    [int(c[i:i+2], 16) for i in (4, 2, 0)] for c in [
+        'e6194b', '3cb44b', 'ffe119', '0082c8', 'f58231', '911eb4', '46f0f0', 'f032e6',
+        'd2f53c', 'fabebe', '008080', 'e6beff', 'aa6e28', 'fffac8', '800000', 'aaffc3',
+    ]
+], dtype=np.uint8)
+
+
+class FastDetectionAnnotator:
+    '''A drop-in for ``DetectionAnnotator`` that only touches each detection's bounding box.
+
+    Masks are alpha-blended inside their box (instead of blending a full-frame layer per
+    detection), colors come from a lookup table by class/track id, and boxes and labels
+    are drawn in the same pass.
+
+    Arguments:
+        opacity (float): The mask opacity.
+        thickness (int): The box line thickness.
+        text_scale (float): The label font scale.
+        text_padding (int): The label background padding.
+        palette (np.ndarray): The (n, 3) BGR colors.
+    '''
+    def __init__(self, opacity=0.5, thickness=2, text_scale=0.4, text_padding=1, text_thickness=1, palette=DEFAULT_PALETTE):
+        self.opacity = opacity
+        self.thickness = thickness
+        self.text_scale = text_scale
+        self.text_padding = text_padding
+        self.text_thickness = text_thickness
+        self.palette = np.asarray(palette, dtype=np.uint8)
+        self.palette_list = self.palette.tolist()
+
+    def annotate(self, frame, detections, labels=None, by_track=False, out=None):
+        '''Draw detections on a frame.
+
+        Arguments:
+            frame (np.ndarray): The BGR frame. This is drawn on in place unless ``out`` is given.
+            detections (sv.Detections): The detections.
+            labels (list): The label text for each detection. None to skip labels.
+            by_track (bool): Color by track id instead of class id.
+            out (np.ndarray): A canvas region (the same shape as frame) to copy the frame into and draw on.
+
+        Returns:
+            The annotated frame (``out`` if given).
+        '''
+        if out is not None:
+            if out is not frame:
+                out[:] = frame
+            frame = out
+        if by_track:
+            detections.class_id = detections.tracker_id
+        if not len(detections):
+            return frame
+
+        H, W = frame.shape[:2]
+        ids = detections.class_id if detections.class_id is not None else np.arange(len(detections))
+        colors = self.palette_list
+        color_idx = np.asarray(ids, dtype=int) % len(colors)
+        boxes = np.clip(np.asarray(detections.xyxy), 0, [W, H, W, H]).astype(int)
+        masks = detections.mask
+        a = self.opacity
+
+        # masks
+        if masks is not None:
+            for (x1, y1, x2, y2), m, ci in zip(boxes, masks, color_idx):
+                if x2 <= x1 or y2 <= y1:
+                    continue
+                region = frame[y1:y2, x1:x2]
+                m = m[y1:y2, x1:x2]
+                blended = cv2.addWeighted(region, 1 - a, np.full_like(region, self.palette[ci]), a, 0)
+                np.copyto(region, blended, where=m[..., None].astype(bool))
+
+        # boxes + labels
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        for i, ((x1, y1, x2, y2), ci) in enumerate(zip(boxes, color_idx)):
+            color = colors[ci]
+            cv2.rectangle(frame, (x1, y1), (x2, y2), color, self.thickness)
+            if labels is None:
+                continue
+            text = str(labels[i])
+            (tw, th), _ = cv2.getTextSize(text, font, self.text_scale, self.text_thickness)
+            p = self.text_padding
+            tx, ty = x1 + p, y1 - p
+            cv2.rectangle(frame, (x1, y1 - 2 * p - th), (x1 + 2 * p + tw, y1), color, -1)
+            cv2.putText(frame, text, (tx, ty), font, self.text_scale, (0, 0, 0), self.text_thickness, cv2.LINE_AA)
+        return frame
+
+
 # ---------------------------------------------------------------------------- #
 #                                 Video Writers                                #
 # ---------------------------------------------------------------------------- #
 
-class VideoSink(sv.VideoSink):
+# ffmpeg if it's installed, otherwise opencv. Override with OBJECT_STATES_VIDEO_BACKEND=opencv
+VIDEO_BACKEND = os.getenv('OBJECT_STATES_VIDEO_BACKEND') or 'ffmpeg'
+
+
+class VideoSink:
+    '''Write a video with ffmpeg (``FFmpegVideoSink``) if it's available, otherwise with opencv (``sv.VideoSink``).
+
+    Arguments:
+        target_path (str): The output video path.
+        video_info (sv.VideoInfo): The output video size and fps.
+        backend (str): ``ffmpeg`` or ``opencv``. Defaults to ``VIDEO_BACKEND``.
+        **kw: Encoder options for ``FFmpegVideoSink``.
+    '''
+    def __init__(self, target_path, video_info, backend=None, **kw):
+        self.target_path = target_path
+        self.video_info = video_info
+        self.backend = backend or VIDEO_BACKEND
+        if self.backend == 'ffmpeg' and not has_ffmpeg():
+            self.backend = 'opencv'
+        self.sink = (
+            FFmpegVideoSink(target_path, video_info, **kw) if self.backend == 'ffmpeg' else 
+            sv.VideoSink(target_path, video_info))
+
+    def __enter__(self):
+        self.sink.__enter__()
+        return self
+
+    def __exit__(self, *a):
+        return self.sink.__exit__(*a)
+
     def write_frame(self, frame):
         sh = frame.shape[:2]
         she = (self.video_info.height, self.video_info.width)
         assert sh == she, f"Frame must be size: {sh}. Got {she}"
-        return super().write_frame(frame)
+        return self.sink.write_frame(frame)
+
+
+def has_ffmpeg():
+    return shutil.which('ffmpeg') is not None
+
+
+class FFmpegVideoSink(BackgroundWriter):
+    '''Write a video by piping raw frames to an ffmpeg subprocess.
+
+    Frames are copied onto a bounded queue and written to ffmpeg's stdin from a
+    background thread, so encoding (which ffmpeg does with its own threads) runs
+    alongside the main loop.
+
+    Arguments:
+        target_path (str): The output video path.
+        video_info (sv.VideoInfo): The output video size and fps.
+        codec (str): The ffmpeg video codec.
+        preset (str): The encoder preset (for x264/x265).
+        crf (int): The encoder quality (for x264/x265).
+        threads (int): Encoder threads. 0 lets ffmpeg decide.
+        pix_fmt (str): The output pixel format. Odd frame sizes are padded to even ones.
+        maxsize (int): How many frames can be waiting to be encoded before ``write_frame`` blocks.
+    '''
+    def __init__(self, target_path, video_info, codec='libx264', preset='veryfast', crf=23, threads=0, pix_fmt='yuv420p', maxsize=32):
+        super().__init__(maxsize=maxsize)
+        self.target_path = target_path
+        self.video_info = video_info
+        self.codec = codec
+        self.preset = preset
+        self.crf = crf
+        self.threads = threads
+        self.pix_fmt = pix_fmt
+        self.proc = None
+
+    def command(self):
+        W, H = self.video_info.width, self.video_info.height
+        return [
+            'ffmpeg', '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{W}x{H}', '-r', str(self.video_info.fps), '-i', '-',
+            '-an', '-c:v', self.codec,
+            # yuv420p (and x264) need even sizes - pad odd ones by a pixel
+            *(['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2'] if W % 2 or H % 2 else []),
+            *(['-preset', self.preset] if self.preset else []),
+            *(['-crf', str(self.crf)] if self.crf is not None else []),
+            '-threads', str(self.threads),
+            '-pix_fmt', self.pix_fmt,
+            self.target_path,
+        ]
+
+    def write_frame(self, frame):
+        # copy now - the caller is free to reuse the frame buffer
+        self.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.target_path) or '.', exist_ok=True)
+        self.proc = subprocess.Popen(self.command(), stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def _write(self, data):
+        self.proc.stdin.write(data)
+
+    def _close(self):
+        if self.proc is None:
+            return
+        self.proc.stdin.close()
+        err = self.proc.stderr.read()
+        code = self.proc.wait()
+        self.proc = None
+        if code:
+            raise RuntimeError(f"ffmpeg exited with code {code} writing {self.target_path}: {err.decode(errors='replace')}")
 
 
 class DetectionSink(VideoSink):
@@ -73,19 +263,55 @@ class XMemSink(VideoSink):
 
 class TrackSink:
     '''Create videos cropped to each track bounding box.
+
+    Crops are buffered in memory and written ``flush_every`` frames at a time once a track
+    has ``min_frames`` frames, so short-lived tracks are dropped without ever being encoded.
+    Until then they're kept compressed (jpeg, or lossless png in ``array`` mode). After that
+    they're kept as they are. At most ``max_open`` writers are open at once (least recently used
+    are closed). A track whose writer was closed continues in a new part, and the parts
+    are joined at the end. Tracks that haven't been seen for ``evict_after`` frames are
+    finished early (or dropped if they're too short), so a long video doesn't hold on to every track.
+
+    With ffmpeg, each writer encodes with ``threads`` threads and ``preset``, so up to ``max_open``
+    encoders don't end up running ``max_open`` x cores threads between them.
+
+    Arguments:
+        out_dir (str): The output directory.
+        video_info (sv.VideoInfo): The source video info (for the fps).
+        size (int): The size of the (square) crops.
+        padding (int): Padding around the box.
+        min_frames (int): Drop tracks with fewer frames than this.
+        max_open (int): The maximum number of open video writers.
+        flush_every (int): How many crops to buffer for a track before writing them.
+        evict_after (int): Finish tracks that haven't been seen for this many frames (needs ``frame_idx``). None to keep them until the end.
+        mode (str): ``mp4`` for a video per track, or ``array`` for all of the crops in a
+            single memory-mappable array file (``tracks.u8`` + ``tracks.npz``, see ``load_track_crops``).
+        threads (int): Encoder threads per track video (ffmpeg only).
+        preset (str): The encoder preset for the track videos (ffmpeg only).
     '''
-    def __init__(self, out_dir, video_info, size=200, padding=0, min_frames=10, remove_existing=True):
+    def __init__(self, out_dir, video_info, size=200, padding=0, min_frames=10, remove_existing=True, max_open=32, flush_every=60, evict_after=300, mode='mp4', threads=1, preset='ultrafast'):
+        assert mode in {'mp4', 'array'}, f"Unknown track sink mode: {mode}"
         self.out_dir = out_dir
         self.video_info = sv.VideoInfo(width=size, height=size, fps=video_info.fps)
         self.size = (self.video_info.height, self.video_info.width)
         self.padding = padding
         self.min_frames = min_frames
-        self.writers = {}
+        self.max_open = max_open
+        self.flush_every = flush_every
+        self.evict_after = evict_after
+        self.mode = mode
+        self.threads = threads
+        self.preset = preset
+        self.tracks = {}
+        self.writers = OrderedDict()
+        self.array_file = None
+        # labels of the tracks that were already finished (for the array index)
+        self.finished_labels = {}
         if remove_existing:
             self.remove_track_videos()
 
     def remove_track_videos(self):
-        for f in glob.glob(f'{self.out_dir}track_*.mp4'):
+        for f in glob.glob(os.path.join(self.out_dir, 'track_*.mp4')):
             print(f"Deleting existing track video {f}")
             os.remove(f)
 
@@ -93,53 +319,186 @@ class TrackSink:
         return self
 
     def __exit__(self, *a):
+        for t in self.tracks.values():
+            if t.count >= self.min_frames:
+                self._flush(t)
         for w in self.writers.values():
             w.__exit__(*a)
-            if w.count < self.min_frames:
-                os.remove(w.target_path)
-            else:
-                f = w.target_path
-                label = w.label_counts.most_common()
-                label = (label or [[None]])[0][0]
-                f2 = '{}_{l}_{s}-{e}{}'.format(
-                    *os.path.splitext(f), 
-                    s=w.first_seen, 
-                    e=w.last_seen,
-                    l=label or 'noclass')
-                os.rename(f, f2)
+        self.writers.clear()
+        if self.array_file is not None:
+            self._close_array()
+        for t in self.tracks.values():
+            if t.count < self.min_frames:
+                continue  # never written
+            self._finish_track(t)
+        self.tracks.clear()
+        self.finished_labels.clear()
 
     def write_frame(self, frame, detections, labels=None, frame_idx=None):
         if labels is None:
             labels = [None]*len(detections)
         for tid, bbox, label in zip(detections.tracker_id, detections.xyxy, labels):
-            self._write_frame(self._get_writer(tid, frame_idx), frame, bbox, label, frame_idx)
-
-    def _get_writer(self, tid, frame_idx):
-        if tid in self.writers:
-            return self.writers[tid]
-        fname = f'{self.out_dir}/track_{tid}.mp4' #self.out_format.format(tid)
-        os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
-        self.writers[tid] = w = VideoSink(fname, self.video_info)
-        w.__enter__()
-        w.count = 0
-        w.track_id = tid
-        w.label_counts = Counter()
-        w.first_seen = frame_idx or -1
-        w.last_seen = frame_idx or -1
-        return w
-
-    def _write_frame(self, writer, frame=None, bbox=None, label=None, frame_idx=None):
+            self._write_frame(self._get_track(tid, frame_idx), frame, bbox, label, frame_idx)
+        if self.evict_after is not None and frame_idx is not None:
+            self.evict(frame_idx - self.evict_after)
+
+    def evict(self, before):
+        '''Finish the tracks last seen before frame ``before``. Tracks shorter than ``min_frames`` are dropped.'''
+        for tid in [tid for tid, t in self.tracks.items() if t.last_seen < before]:
+            t = self.tracks.pop(tid)
+            if t.count < self.min_frames:
+                continue  # never written
+            self._flush(t)
+            w = self.writers.pop(tid, None)
+            if w is not None:
+                w.__exit__(None, None, None)
+            self._finish_track(t)
+
+    def _get_track(self, tid, frame_idx):
+        if tid not in self.tracks:
+            self.tracks[tid] = TrackInfo(tid, frame_idx)
+        return self.tracks[tid]
+
+    def _write_frame(self, track, frame=None, bbox=None, label=None, frame_idx=None):
         if frame is None:
-            frame = np.zeros(self.size, dtype='uint8')
+            frame = np.zeros((*self.size, 3), dtype='uint8')
         elif bbox is not None:
             frame = crop_box(frame, bbox, self.padding)
         frame = resize_with_pad(frame, self.size)
-        writer.write_frame(frame)
-        writer.count += 1
+        track.count += 1
         if frame_idx is not None:
-            writer.last_seen = frame_idx
+            track.last_seen = frame_idx
         if label is not None:
-            writer.label_counts.update([label])
+            track.label_counts.update([label])
+
+        # hold on to it until we know the track is long enough, and then write in chunks
+        if track.count < self.min_frames:
+            # it might get dropped, so keep it small
+            frame = cv2.imencode('.png' if self.mode == 'array' else '.jpg', frame)[1]
+        track.buffer.append((frame_idx, frame))
+        if track.count >= self.min_frames and len(track.buffer) >= self.flush_every:
+            self._flush(track)
+
+    def _flush(self, track):
+        for i, crop in track.buffer:
+            self._write_crop(track, crop if crop.ndim == 3 else cv2.imdecode(crop, cv2.IMREAD_COLOR), i)
+        track.buffer.clear()
+
+    def _finish_track(self, track):
+        if self.mode == 'mp4':
+            self._finish_video(track)
+        else:
+            self.finished_labels[track.track_id] = track_label(track)
+
+    def _write_crop(self, track, frame, frame_idx):
+        if self.mode == 'array':
+            return self._write_array(track, frame, frame_idx)
+        self._get_writer(track).write_frame(frame)
+
+    # ------------------------------- mp4 per track ------------------------------ #
+
+    def _get_writer(self, track):
+        tid = track.track_id
+        if tid in self.writers:
+            self.writers.move_to_end(tid)
+            return self.writers[tid]
+        # close the least recently used writer
+        while len(self.writers) >= self.max_open:
+            _, w = self.writers.popitem(last=False)
+            w.__exit__(None, None, None)
+        fname = os.path.join(self.out_dir, f'track_{tid}.mp4' if not track.parts else f'track_{tid}.part{len(track.parts)}.mp4')
+        os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+        track.parts.append(fname)
+        self.writers[tid] = w = VideoSink(fname, self.video_info, threads=self.threads, preset=self.preset)
+        w.__enter__()
+        return w
+
+    def _finish_video(self, track):
+        f = track.parts[0]
+        if len(track.parts) > 1:
+            tmp = '{}.joined{}'.format(*os.path.splitext(f))
+            concat_videos(track.parts, tmp)
+            for fi in track.parts:
+                os.remove(fi)
+            os.rename(tmp, f)
+        f2 = '{}_{l}_{s}-{e}{}'.format(
+            *os.path.splitext(f), 
+            s=track.first_seen, 
+            e=track.last_seen,
+            l=track_label(track))
+        os.rename(f, f2)
+
+    # ---------------------------- single array file ----------------------------- #
+
+    def _write_array(self, track, frame, frame_idx):
+        if self.array_file is None:
+            os.makedirs(self.out_dir, exist_ok=True)
+            self.array_file = open(os.path.join(self.out_dir, 'tracks.u8'), 'wb')
+            self.array_index = []
+        self.array_file.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        self.array_index.append((track.track_id, -1 if frame_idx is None else frame_idx))
+
+    def _close_array(self):
+        self.array_file.close()
+        self.array_file = None
+        index = np.array(self.array_index, dtype=int).reshape(-1, 2)
+        labels = {**self.finished_labels, **{t.track_id: track_label(t) for t in self.tracks.values()}}
+        np.savez(
+            os.path.join(self.out_dir, 'tracks.npz'),
+            track_id=index[:, 0],
+            frame_index=index[:, 1],
+            label=np.array([labels[t] for t in index[:, 0]], dtype=str),
+            shape=np.array([len(index), *self.size, 3]))
+
+
+class TrackInfo:
+    def __init__(self, track_id, frame_idx=None):
+        self.track_id = track_id
+        self.count = 0
+        self.label_counts = Counter()
+        self.first_seen = frame_idx if frame_idx is not None else -1
+        self.last_seen = frame_idx if frame_idx is not None else -1
+        self.buffer = []
+        self.parts = []
+
+
+def track_label(track):
+    '''The most common label of a track.'''
+    return (track.label_counts.most_common(1) or [[None]])[0][0] or 'noclass'
+
+
+def load_track_crops(out_dir):
+    '''Load the crops written by ``TrackSink(mode='array')``.
+
+    Returns:
+        crops (np.memmap): The (n, size, size, 3) BGR crops.
+        index (dict): The ``track_id``, ``frame_index`` and ``label`` of each crop.
+    '''
+    index = dict(np.load(os.path.join(out_dir, 'tracks.npz')))
+    crops = np.memmap(os.path.join(out_dir, 'tracks.u8'), dtype=np.uint8, mode='r', shape=tuple(index.pop('shape')))
+    return crops, index
+
+
+def concat_videos(fs, out_path):
+    '''Concatenate videos. Uses ffmpeg (no re-encoding) if it's available.'''
+    fs = [f for f in fs if os.path.isfile(f)]
+    if shutil.which('ffmpeg'):
+        list_fname = f'{out_path}.txt'
+        with open(list_fname, 'w') as f:
+            f.writelines(f"file '{os.path.abspath(fi)}'\n" for fi in fs)
+        subprocess.run([
+            'ffmpeg', '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+            '-i', list_fname, '-c', 'copy', out_path], check=True)
+        os.remove(list_fname)
+        return out_path
+
+    # fall back to re-encoding with opencv
+    info = sv.VideoInfo.from_video_path(fs[0])
+    with sv.VideoSink(out_path, info) as s:
+        for f in fs:
+            for frame in sv.get_video_frames_generator(f):
+                s.write_frame(frame)
+    return out_path
 
 
 def crop_box(frame, bbox, padding=0):
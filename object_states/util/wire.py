@@ -0,0 +1,294 @@
+'''A compact binary format for detection messages, and a writer for recorded streams.
+
+Detections (the records from ``Perception.serialize_detections``) are packed as a header
+followed by numeric arrays::
+
+    header        '<4sHI'  magic b'OSD1', flags, n detections
+    labels        u32 byte length + '\0'-joined utf-8 label table (labels, state and possible label names)
+    boxes         (n, 4) f32 xyxyn
+    label         (n,) u16 index into the label table
+    scores        (n,) f32                                  if HAS_SCORES
+    track ids     (n,) i32                                  if HAS_TRACK_IDS
+    hand object   (n, 3) f32 left/right/both, NaN if missing if HAS_HAND_OBJECT
+    states        (n,) u16 counts, (m,) u16 labels, (m,) f32 if HAS_STATES
+    possible      (n,) u16 counts, (m,) u16 labels, (m,) f32 if HAS_POSSIBLE_LABELS
+    segments      (n,) u16 contours per detection, (c,) u32 points per contour,
+                  (p, 2) u16 normalized points * 65535       if HAS_SEGMENTS
+
+Recorded messages are framed in an envelope that carries the timestamp, so adding one
+never means parsing (or re-encoding) the payload::
+
+    '<4sBHI'  magic b'OSE1', kind, timestamp length, payload length; timestamp; payload
+
+usage: python -m object_states.util.wire to_json 'recordings/*/*.osw'
+'''
+import os
+import glob
+import struct
+import orjson
+import numpy as np
+
+from .data_output import BackgroundWriter, OPTIONS
+
+
+DETECTIONS_MAGIC = b'OSD1'
+HEADER = struct.Struct('<4sHI')
+U32 = struct.Struct('<I')
+
+HAS_SCORES = 1
+HAS_TRACK_IDS = 2
+HAS_HAND_OBJECT = 4
+HAS_STATES = 8
+HAS_POSSIBLE_LABELS = 16
+HAS_SEGMENTS = 32
+
+HANDS = ['left', 'right', 'both']
+Q = 65535  # segment point quantization
+
+
+# ---------------------------------------------------------------------------- #
+#                                  Detections                                  #
+# ---------------------------------------------------------------------------- #
+
+def encode_detections(objects):
+    '''Pack a list of detection records into bytes.
+
+    Arguments:
+        objects (list): The records from ``serialize_detections`` (segments normalized, not ``pixels``).
+    '''
+    n = len(objects)
+    table = {}
+    intern = lambda x: table.setdefault(x, len(table))
+    dist = lambda key: (
+        np.array([len(o.get(key) or ()) for o in objects], dtype=np.uint16),
+        np.array([intern(k) for o in objects for k in (o.get(key) or ())], dtype=np.uint16),
+        np.array([v for o in objects for v in (o.get(key) or {}).values()], dtype=np.float32))
+    has = lambda key: n and all(key in o for o in objects)
+
+    labels = np.array([intern(o['label']) for o in objects], dtype=np.uint16)
+    flags = 0
+    parts = [
+        np.array([o['xyxyn'] for o in objects], dtype=np.float32).reshape(n, 4),
+        labels,
+    ]
+    if has('confidence'):
+        flags |= HAS_SCORES
+        parts.append(np.array([o['confidence'] for o in objects], dtype=np.float32))
+    if has('segment_track_id'):
+        flags |= HAS_TRACK_IDS
+        parts.append(np.array([o['segment_track_id'] for o in objects], dtype=np.int32))
+    if has('hand_object'):
+        flags |= HAS_HAND_OBJECT
+        parts.append(np.array([[o['hand_object'].get(k, np.nan) for k in HANDS] for o in objects], dtype=np.float32))
+    if has('state'):
+        flags |= HAS_STATES
+        parts.extend(dist('state'))
+    if has('possible_labels'):
+        flags |= HAS_POSSIBLE_LABELS
+        parts.extend(dist('possible_labels'))
+    if has('segment'):
+        flags |= HAS_SEGMENTS
+        contours = [np.asarray(c, dtype=np.float64).reshape(-1, 2) for o in objects for c in o['segment']]
+        parts.append(np.array([len(o['segment']) for o in objects], dtype=np.uint16))
+        parts.append(np.array([len(c) for c in contours], dtype=np.uint32))
+        points = np.concatenate(contours) if contours else np.zeros((0, 2))
+        parts.append((np.clip(points, 0, 1) * Q).round().astype(np.uint16))
+
+    names = '\0'.join(table).encode()
+    return b''.join([HEADER.pack(DETECTIONS_MAGIC, flags, n), U32.pack(len(names)), names] + [np.ascontiguousarray(p).tobytes() for p in parts])
+
+
+def decode_detections(buf):
+    '''Unpack ``encode_detections`` bytes back into a list of records.'''
+    magic, flags, n = HEADER.unpack_from(buf)
+    assert magic == DETECTIONS_MAGIC, f'Not a detections message: {magic}'
+    offset = HEADER.size
+    size, = U32.unpack_from(buf, offset)
+    offset += U32.size
+    names = buf[offset:offset + size].decode().split('\0') if size else []
+    offset += size
+
+    def read(dtype, count, shape=None):
+        nonlocal offset
+        x = np.frombuffer(buf, dtype=dtype, count=count, offset=offset)
+        offset += x.nbytes
+        return x.reshape(shape) if shape else x
+
+    def read_dist():
+        counts = read('<u2', n)
+        m = int(counts.sum())
+        keys, values = read('<u2', m), read('<f4', m)
+        idx = np.cumsum(counts)[:-1]
+        return [
+            {names[k]: v for k, v in zip(ks.tolist(), vs)}
+            for ks, vs in zip(np.split(keys, idx), np.split(values, idx))
+        ]
+
+    boxes = read('<f4', 4 * n, (n, 4))
+    columns = {'xyxyn': list(boxes), 'label': [names[i] for i in read('<u2', n).tolist()]}
+    scores = read('<f4', n) if flags & HAS_SCORES else None
+    track_ids = read('<i4', n).tolist() if flags & HAS_TRACK_IDS else None
+    hand = read('<f4', 3 * n, (n, 3)) if flags & HAS_HAND_OBJECT else None
+    states = read_dist() if flags & HAS_STATES else None
+    possible_labels = read_dist() if flags & HAS_POSSIBLE_LABELS else None
+    segments = None
+    if flags & HAS_SEGMENTS:
+        n_contours = read('<u2', n)
+        n_points = read('<u4', int(n_contours.sum()))
+        points = read('<u2', 2 * int(n_points.sum()), (-1, 2)) / Q
+        contours = np.split(points.round(5).reshape(-1, 1, 2), np.cumsum(n_points)[:-1])
+        ends = np.cumsum(n_contours)
+        segments = [contours[s:e] for s, e in zip((ends - n_contours).tolist(), ends.tolist())]
+
+    # same key order as serialize_detections
+    if scores is not None:
+        columns['confidence'] = list(scores)
+    if hand is not None:
+        columns['hand_object'] = [{k: v for k, v in zip(HANDS, h) if not np.isnan(v)} for h in hand]
+        columns['hand_object_interaction'] = list(np.where(np.isnan(hand), 0, hand).max(axis=1))
+    if possible_labels is not None:
+        columns['possible_labels'] = possible_labels
+    if segments is not None:
+        columns['segment'] = segments
+    if states is not None:
+        columns['state'] = states
+    if track_ids is not None:
+        columns['segment_track_id'] = track_ids
+    keys = list(columns)
+    return [dict(zip(keys, row)) for row in zip(*columns.values())]
+
+
+def decode(data):
+    '''Decode a message payload, binary detections or JSON.'''
+    if data[:4] == DETECTIONS_MAGIC:
+        return decode_detections(data)
+    return orjson.loads(data)
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Envelopes                                  #
+# ---------------------------------------------------------------------------- #
+
+ENVELOPE_MAGIC = b'OSE1'
+ENVELOPE = struct.Struct('<4sBHI')
+JSON, DETECTIONS = 0, 1
+
+
+def pack(ts, payload, kind=None):
+    '''Frame a payload with its timestamp.'''
+    ts = str(ts or '').encode()
+    if kind is None:
+        kind = DETECTIONS if payload[:4] == DETECTIONS_MAGIC else JSON
+    return ENVELOPE.pack(ENVELOPE_MAGIC, kind, len(ts), len(payload)) + ts + payload
+
+
+def iter_envelopes(fname):
+    '''Read (timestamp, kind, payload) from a file of envelopes. A truncated last message (from a crash) is skipped.'''
+    with open(fname, 'rb') as f:
+        while True:
+            head = f.read(ENVELOPE.size)
+            if len(head) < ENVELOPE.size:
+                return
+            magic, kind, n_ts, n = ENVELOPE.unpack(head)
+            assert magic == ENVELOPE_MAGIC, f'Bad envelope in {fname} at {f.tell() - ENVELOPE.size}'
+            ts, payload = f.read(n_ts), f.read(n)
+            if len(payload) < n:
+                return
+            yield ts.decode() or None, kind, payload
+
+
+def add_timestamp(data, ts):
+    '''Add a timestamp to a JSON message without parsing it.
+
+    Objects get a ``timestamp`` key unless they already have one (only then is the
+    message parsed), anything else is wrapped as ``{"data": ..., "timestamp": ...}``.
+    '''
+    if ts is None:
+        return data
+    ts = orjson.dumps(ts)
+    data = data.strip()
+    if data[:1] == b'{':
+        if b'"timestamp"' in data and 'timestamp' in orjson.loads(data):
+            return data
+        rest = data[1:].lstrip()
+        return b'{"timestamp":' + ts + (b'' if rest[:1] == b'}' else b',') + rest
+    return b'{"data":' + data + b',"timestamp":' + ts + b'}'
+
+
+def to_json(*fnames, out_dir=None):
+    '''Convert envelope files to JSON lists (the same as ``format='json'``), decoding binary detections.'''
+    for pattern in fnames:
+        for fname in glob.glob(pattern) if '*' in pattern else [pattern]:
+            out = os.path.join(out_dir or os.path.dirname(fname), os.path.splitext(os.path.basename(fname))[0] + '.json')
+            with open(out, 'wb') as f:
+                f.write(b'[\n')
+                for i, (ts, kind, payload) in enumerate(iter_envelopes(fname)):
+                    if kind == DETECTIONS:
+                        payload = orjson.dumps(decode_detections(payload), option=OPTIONS)
+                    f.write((b',\n' if i else b'') + add_timestamp(payload, ts))
+                f.write(b'\n]\n')
+            print(out)
+
+
+# ---------------------------------------------------------------------------- #
+#                                    Writer                                    #
+# ---------------------------------------------------------------------------- #
+
+class StreamWriter(BackgroundWriter):
+    '''Write recorded messages to one file per stream from a background thread.
+
+    Payloads are bytes (or anything orjson can dump) and are written as-is with the
+    timestamp added outside of them.
+
+    Arguments:
+        out_dir (str): The output directory.
+        format (str): ``json`` writes ``{sid}.json`` lists, with the timestamp spliced into
+            each message. ``wire`` writes ``{sid}.osw`` envelopes (see ``to_json``).
+    '''
+    def __init__(self, out_dir, format='json', **kw):
+        super().__init__(**kw)
+        assert format in {'json', 'wire'}, f"Unknown format: {format}"
+        self.out_dir = out_dir
+        self.format = format
+        self.files = {}
+
+    def write_message(self, sid, ts, data):
+        if not isinstance(data, bytes):
+            data = orjson.dumps(data, option=OPTIONS)
+        self.write((sid, ts, data))
+
+    def _open(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+
+    def _write(self, item):
+        sid, ts, data = item
+        f = self.files.get(sid)
+        if self.format == 'wire':
+            if f is None:
+                f = self.files[sid] = open(os.path.join(self.out_dir, f'{sid}.osw'), 'wb')
+            f.write(pack(ts, data))
+            return
+        if f is None:
+            f = self.files[sid] = open(os.path.join(self.out_dir, f'{sid}.json'), 'wb')
+            f.write(b'[\n')
+        elif f.tell() > 2:
+            f.write(b',\n')
+        if data[:4] == DETECTIONS_MAGIC:
+            data = orjson.dumps(decode_detections(data), option=OPTIONS)
+        f.write(add_timestamp(data, ts))
+
+    def _flush(self):
+        for f in self.files.values():
+            f.flush()
+
+    def _close(self):
+        for f in self.files.values():
+            if self.format == 'json':
+                f.write(b'\n]\n')
+            f.close()
+        self.files.clear()
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire()
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('sklearn')
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.linear_model import LogisticRegression
+from sklearn.neighbors import KNeighborsClassifier
+
+from object_states.util.state_clsf import compile_pipeline, export_bundle, load_bundle, compile_state_classifier, NumpyStateClassifier
+
+
+def data(n_classes=3, n=300, d=16, seed=0):
+    rng = np.random.default_rng(seed)
+    y = rng.integers(0, n_classes, n)
+    centers = rng.normal(0, 2, (n_classes, d))
+    # an offset and uneven scale so the scaler matters
+    X = (centers[y] + rng.normal(size=(n, d))) * rng.uniform(0.5, 5, d) + 10
+    labels = np.array([f'state{i}' for i in range(n_classes)])
+    return X, labels[y]
+
+
+# name: (pipeline, number of classes)
+PIPELINES = {
+    'logreg': (lambda: make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000)), 3),
+    'logreg_binary': (lambda: make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000)), 2),
+    'logreg_liblinear': (lambda: make_pipeline(StandardScaler(), LogisticRegression(solver='liblinear')), 2),
+    'logreg_no_scaler': (lambda: LogisticRegression(max_iter=1000), 3),
+    'knn': (lambda: make_pipeline(StandardScaler(), KNeighborsClassifier(5)), 3),
+    'knn_distance': (lambda: make_pipeline(StandardScaler(), KNeighborsClassifier(7, weights='distance')), 3),
+}
+
+
+@pytest.fixture(params=list(PIPELINES))
+def fitted(request):
+    make, n_classes = PIPELINES[request.param]
+    X, y = data(n_classes)
+    pipeline = make().fit(X, y)
+    X_test, _ = data(n_classes, n=100, seed=1)
+    return pipeline, X_test
+
+
+def test_compile_pipeline_matches_sklearn(fitted):
+    pipeline, X = fitted
+    compiled = compile_pipeline(pipeline)
+    assert isinstance(compiled, NumpyStateClassifier)
+    np.testing.assert_array_equal(compiled.classes_, pipeline.classes_)
+    np.testing.assert_allclose(compiled.predict_proba(X), pipeline.predict_proba(X), atol=1e-6)
+    np.testing.assert_array_equal(compiled.predict(X), pipeline.predict(X))
+    # a single row
+    np.testing.assert_allclose(compiled.predict_proba(X[0]), pipeline.predict_proba(X[:1]), atol=1e-6)
+
+
+def test_bundle_matches_sklearn(fitted, tmp_path):
+    pipeline, X = fitted
+    labels = [f'{c}_label' for c in pipeline.classes_]
+    clsf = load_bundle(export_bundle(pipeline, str(tmp_path / 'bundle'), labels=labels))
+    assert isinstance(clsf.X if clsf.kind == 'knn' else clsf.coef, np.memmap)
+    np.testing.assert_array_equal(clsf.labels, labels)
+    # stored as float32
+    np.testing.assert_allclose(clsf.predict_proba(X), pipeline.predict_proba(X), atol=1e-4)
+    np.testing.assert_array_equal(clsf.predict(X), pipeline.predict(X))
+
+
+def test_float64_bundle_is_exact(fitted, tmp_path):
+    pipeline, X = fitted
+    clsf = load_bundle(export_bundle(pipeline, str(tmp_path / 'bundle'), dtype=np.float64))
+    np.testing.assert_allclose(clsf.predict_proba(X), pipeline.predict_proba(X), atol=1e-6)
+
+
+def test_compile_state_classifier_falls_back_to_sklearn():
+    from sklearn.preprocessing import MinMaxScaler
+    X, y = data()
+    pipeline = make_pipeline(MinMaxScaler(), LogisticRegression(max_iter=1000)).fit(X, y)
+    assert compile_state_classifier(pipeline) is pipeline
+    with pytest.raises(TypeError):
+        compile_pipeline(pipeline)
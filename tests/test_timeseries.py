@@ -0,0 +1,187 @@
+import numpy as np
+import pytest
+
+from object_states.util.timeseries import TimeBuffer, StreamAligner, DepthLifter
+from object_states.util.synthetic import synthetic_recording
+
+
+# ---------------------------------------------------------------------------- #
+#                                  TimeBuffer                                  #
+# ---------------------------------------------------------------------------- #
+
+
+@pytest.fixture
+def buf():
+    b = TimeBuffer()
+    for t in [10, 20, 30, 40]:
+        b.add(t, f'v{t}')
+    return b
+
+
+def test_closest(buf):
+    assert buf.get(21) == (20, 'v20')
+    assert buf.get(29) == (30, 'v30')
+    assert buf.get(25) == (20, 'v20')  # ties go to the earlier one
+    assert buf.get(0) == (10, 'v10')
+    assert buf.get(100) == (40, 'v40')
+    assert buf.get(30) == (30, 'v30')
+
+
+def test_before_after(buf):
+    assert buf.get(29, side='before') == (20, 'v20')
+    assert buf.get(30, side='before') == (30, 'v30')
+    assert buf.get(5, side='before') is None
+    assert buf.get(21, side='after') == (30, 'v30')
+    assert buf.get(20, side='after') == (20, 'v20')
+    assert buf.get(41, side='after') is None
+
+
+def test_tolerance(buf):
+    assert buf.get(23, tol=3) == (20, 'v20')
+    assert buf.get(24, tol=3) is None
+    assert buf.get(100, tol=10) is None
+    assert buf.get(29, tol=5, side='before') is None
+    assert buf.get(29, tol=10, side='before') == (20, 'v20')
+
+
+def test_empty():
+    b = TimeBuffer()
+    assert len(b) == 0
+    for side in ['closest', 'before', 'after']:
+        assert b.get(1, side=side) is None
+    assert b.window(0, 10) == []
+
+
+def test_out_of_order(buf):
+    buf.add(25, 'v25')
+    buf.add(5, 'v5')
+    buf.add(40, 'v40b')  # same time: after the existing one
+    assert buf.times == [5, 10, 20, 25, 30, 40, 40]
+    assert buf.values == ['v5', 'v10', 'v20', 'v25', 'v30', 'v40', 'v40b']
+    assert buf.get(24) == (25, 'v25')
+    assert 25 in buf and 26 not in buf
+
+
+def test_maxlen():
+    b = TimeBuffer(maxlen=3)
+    for t in range(10):
+        b.add(t, t)
+    assert b.times == [7, 8, 9]
+    # an old message that arrives late is dropped again
+    b.add(1, 1)
+    assert b.times == [7, 8, 9]
+    b.add(8.5, 8.5)
+    assert b.times == [8, 8.5, 9]
+
+
+def test_window_prune(buf):
+    assert buf.window(15, 30) == [(20, 'v20'), (30, 'v30')]
+    buf.prune(25)
+    assert buf.times == [30, 40]
+
+
+# ---------------------------------------------------------------------------- #
+#                                 StreamAligner                                #
+# ---------------------------------------------------------------------------- #
+
+
+def test_align():
+    align = StreamAligner({'depthlt': 50}, maxlen={'depthlt': 4, 'depthltCal': 1}, side={'depthltCal': 'before'})
+    align.add('depthltCal', 0, 'cal0')
+    for t in [100, 200, 300, 400, 500]:
+        align.add('depthlt', t, f'd{t}')
+    assert len(align.buffer('depthlt')) == 4
+    assert len(align.buffer('depthltCal')) == 1
+
+    assert align.align(310, ['depthlt', 'depthltCal']) == ['d300', 'cal0']
+    assert align.align(460, ['depthlt', 'depthltCal']) == ['d500', 'cal0']
+    # d100 was dropped (maxlen) and d200 is out of tolerance
+    assert align.align(120, ['depthlt', 'depthltCal']) == [None, 'cal0']
+    # before the calibration
+    assert align.align(-10, ['depthltCal']) == [None]
+    # a stream we've never seen
+    assert align.align(300, ['depthlt', 'missing']) == ['d300', None]
+    assert align.get('depthlt', 260, tol=100) == (300, 'd300')
+
+
+def test_align_synthetic_recording():
+    '''Every main frame gets the depth frame closest in time (the depth frames are jittered).'''
+    align = StreamAligner({'depthlt': 300}, maxlen={'depthlt': 16, 'depthltCal': 1})
+    depth_times = []
+    n = 0
+    for sid, t, msg in synthetic_recording(n_frames=45, n_objects=2, depth_size=(32, 24)):
+        if sid != 'main':
+            align.add(sid, t, t)
+            if sid == 'depthlt':
+                depth_times.append(t)
+            continue
+        depth_t, cal_t = align.align(t, ['depthlt', 'depthltCal'])
+        assert cal_t is not None
+        if depth_times:
+            # nothing later has arrived yet, so it's the closest of what we've seen
+            assert depth_t == min(depth_times[-16:], key=lambda d: (abs(d - t), d))
+            n += 1
+    assert n > 30
+
+
+# ---------------------------------------------------------------------------- #
+#                                  DepthLifter                                 #
+# ---------------------------------------------------------------------------- #
+
+
+def lift_recording(lifter, **kw):
+    align = StreamAligner({'depthlt': 300}, maxlen={'depthltCal': 1})
+    results = []
+    for sid, t, msg in synthetic_recording(**kw):
+        if sid != 'main':
+            align.add(sid, t, msg)
+            continue
+        depth, calib = align.align(t, ['depthlt', 'depthltCal'])
+        if depth is None:
+            continue
+        image_params = {'cam2world': msg['cam2world'], 'focal': [msg['focalX'], msg['focalY']], 'principal': [msg['principalX'], msg['principalY']]}
+        results.append((msg, *lifter.lift(msg['xyxy'], image_params, depth, calib)))
+    return results
+
+
+def test_lift_synthetic_geometry():
+    results = lift_recording(DepthLifter(), n_frames=30, n_objects=5, depth_size=(160, 120))
+    assert results
+    for msg, xyz, dist, valid in results:
+        assert xyz.shape == (len(msg['xyxy']), 3)
+        assert valid.all()
+        err = np.linalg.norm(xyz - msg['xyz'], axis=1)
+        # the wall is 2m away, the depth is quantized to mm and the pixels are coarse
+        assert err.max() < 0.05, err
+
+
+def test_lift_stride_and_cache():
+    lifter = DepthLifter(stride=4)
+    results = lift_recording(lifter, n_frames=15, n_objects=3, depth_size=(160, 120))
+    assert len(lifter._rays) == 1  # one calibration
+    for msg, xyz, dist, valid in results:
+        assert np.linalg.norm(xyz - msg['xyz'], axis=1)[valid].max() < 0.1
+
+
+def test_lift_no_depth():
+    '''Boxes without depth (beyond max_depth / outside the depth frame) are NaN and not valid.'''
+    results = lift_recording(DepthLifter(max_depth=1), n_frames=5, n_objects=3, depth_size=(32, 24))
+    for msg, xyz, dist, valid in results:
+        assert not valid.any()
+        assert np.isnan(xyz).all()
+
+    msgs = {}
+    for sid, t, msg in synthetic_recording(n_frames=15, n_objects=1, depth_size=(32, 24)):
+        msgs.setdefault(sid, msg)
+    image_params = {'cam2world': np.eye(4), 'focal': [640, 640], 'principal': [320, 240]}
+    # the depth camera sees about 2x wider than the rgb camera
+    boxes = [[-5000, -5000, -4000, -4000], [300, 220, 340, 260]]
+    xyz, dist, valid = DepthLifter().lift(boxes, image_params, msgs['depthlt'], msgs['depthltCal'])
+    assert valid.tolist() == [False, True]
+    assert np.isnan(xyz[0]).all() and np.isinf(dist[0])
+
+
+def test_lift_max_dist():
+    results = lift_recording(DepthLifter(max_dist=1e-3), n_frames=5, n_objects=3, depth_size=(16, 12))
+    for msg, xyz, dist, valid in results:
+        np.testing.assert_array_equal(valid, dist < 1e-3)